@@ -0,0 +1,326 @@
+import asyncio
+import collections
+import json
+
+from aiopipeline import AsyncPipeline
+from config import getConfig
+from detections import DetectionTable
+from kraken import KrakenManager, KrakenObject, MAP_WORKERS, \
+  describeScene, pruneTiles, sceneTimestamp, storeResults, \
+  validateOperations
+from manifest import getManifest
+from metrics import getMetrics, logSampled
+from mosaic import Mosaic
+from os import makedirs, path
+from scheduler import creditBudget, released
+from tiledecode import getTileDecoder
+from tileset import Tile, TileSet, asTile
+from utils import SpaceKnowError, buildURL, spaceKnowLogger
+
+
+async def iterRelease(transport, scheduler, mapType, scenes, credits,
+                      alongside=()):
+  """ CreditScheduler.iterRelease on the event loop: the scenes priced by
+      scheduler are released in priority order within `credits`, at most
+      scheduler.workers at a time, and every map is yielded as soon as its
+      release resolves, with jsonMap['alongside'] holding {mapType: Task of
+      its map}. The budget and the skipped scenes are kept in scheduler.
+  """
+  scheduler.checkPriced((mapType,) + tuple(alongside))
+  scheduler.budget = creditBudget(credits)
+  pending = collections.deque(scheduler.order(scenes))
+  skipped, running, companions = [], {}, {}
+
+  def release(mapType, scene):
+    return asyncio.ensure_future(downloadMap(transport, mapType,
+                                             scene['sceneId'],
+                                             scheduler.extent,
+                                             scheduler.token))
+
+  while pending or running:
+    while pending and len(running) < scheduler.workers:
+      scene = pending.popleft()
+      cost = scheduler.costs[scene['sceneId']]['allocatedCredits']
+      if not scheduler.budget.reserve(cost):
+        skipped.append(scene)
+        continue
+      running[release(mapType, scene)] = (scene, cost)
+      companions[scene['sceneId']] = {other: release(other, scene)
+                                      for other in alongside}
+    if not running:
+      break
+    done, _ = await asyncio.wait(running,
+                                 return_when=asyncio.FIRST_COMPLETED)
+    for task in done:
+      scene, cost = running.pop(task)
+      try:
+        jsonMap = task.result()
+      except Exception as e:
+        spaceKnowLogger.error("Unknown error during release of scene %s: %s" %
+                              (scene['sceneId'], e))
+        jsonMap = None
+      others = companions.pop(scene['sceneId'])
+      if jsonMap:
+        if alongside:
+          jsonMap['alongside'] = others
+        yield describeScene(jsonMap, scene)
+        continue
+      # an initiated release can not be taken back: wait for the others
+      if others:
+        await asyncio.wait(others.values())
+      charged = [name for name, other in others.items() if released(other)]
+      if charged:
+        spaceKnowLogger.error("Scene %s: %s released without its %s map, its "
+                              "credits stay spent" %
+                              (scene['sceneId'], ', '.join(charged), mapType))
+        continue
+      scheduler.budget.refund(cost)
+      pending.extendleft(reversed(skipped))
+      skipped = []
+  scheduler.skipped = skipped
+
+async def downloadMap(transport, mapType, scene, extent, token):
+  url = buildURL(getConfig().krakenApi, 'release', mapType, 'geojson')
+  data = json.dumps({'sceneId': scene,
+                     'extent': extent})
+  try:
+    spaceKnowLogger.info('Making Request for scene %s' % scene)
+    jsonMap = await AsyncPipeline(transport, url, token, data).run()
+    if not jsonMap or 'mapId' not in jsonMap or 'maxZoom' not in jsonMap or \
+      'tiles' not in jsonMap:
+      raise SpaceKnowError('Receive invalid map for scene %s' % scene, 500)
+    jsonMap['tiles'] = TileSet.fromList(jsonMap['tiles'])
+    return pruneTiles(jsonMap, extent, mapType)
+  except SpaceKnowError as e:
+    spaceKnowLogger.error('Error %d: %s' % (e.status_code, e.error))
+
+
+def journalRows(analysis):
+  """ Manifest rows (str(Tile), vehicles, features as JSON) of the parsed
+      detections of a map
+  """
+  return [(key, sum(feature.get('properties', {}).get('count', 0)
+                    for feature in features), json.dumps(features))
+          for key, features in analysis.items()]
+
+
+class AsyncKrakenObject(KrakenObject):
+  """ KrakenObject whose tiles are downloaded on the event loop, at most
+      transport.tiles at the same time. Reading and writing the tile cache
+      and parsing the tiles run off the loop, on the decoder pool for the
+      PNG files and on the default executor otherwise.
+  """
+  def __init__(self, transport, mapType, geometry_id='-', outputDir='output',
+               store=None):
+    super().__init__(mapType, geometry_id, outputDir, store=store)
+    self.transport = transport
+
+  async def download_content(self, mapId, tile, resource):
+    """ Raw bytes of a resource from the caches or SpaceKnow
+    """
+    metrics = getMetrics()
+    content = await asyncio.to_thread(self.cached_content, mapId, tile,
+                                      resource)
+    if content is not None:
+      metrics.add('sk_tiles_total', resource=resource, source='cache')
+      return content
+    tileUrl = self.resource_url(mapId, tile, resource)
+    logSampled('GET %s', tileUrl)
+    async with self.transport.tiles:
+      with metrics.timer('sk_tile_seconds', stage='fetch', resource=resource):
+        status, content = await self.transport.request('GET', tileUrl)
+    if status >= 400:
+      raise SpaceKnowError("Tile unavailable at %s" % tileUrl, status)
+    metrics.add('sk_bytes_received_total', len(content), kind='tile',
+                resource=resource)
+    metrics.add('sk_tiles_total', resource=resource, source='network')
+    await asyncio.to_thread(self.cache_content, mapId, tile, resource, content)
+    return content
+
+  async def download_resource(self, mapId, tile, resource):
+    try:
+      self.check_resource(resource)
+      content = await self.download_content(mapId, tile, resource)
+      return await self.parse_content(self.resource_url(mapId, tile, resource),
+                                      resource, content)
+    except Exception as e:
+      spaceKnowLogger.error("Error downloading resource %s: %s" %(resource, e))
+
+  async def parse_content(self, tileUrl, resource, content):
+    """ parse_resource without blocking the event loop
+    """
+    if resource.endswith('.png'):
+      return await asyncio.wrap_future(getTileDecoder().submit(content))
+    return await asyncio.to_thread(self.parse_resource, tileUrl, resource,
+                                   content)
+
+  async def located_resource(self, mapId, tile, resource):
+    return tile, await self.download_resource(mapId, tile, resource)
+
+  async def fetch_tiles(self, mapId, tiles, resource):
+    """ Same contract of KrakenObject.fetch_tiles: results follow the order
+        of tiles and a failed tile is None.
+    """
+    requests = []
+    for tile in tiles:
+      if type(tile) == list:
+        if len(tile) != 3:
+          spaceKnowLogger.error('Invalid tile %s for map %s' % (tile, mapId))
+          requests.append(asyncio.sleep(0, result=None))
+          continue
+        tile = Tile(tile)
+      requests.append(self.download_resource(mapId, tile, resource))
+    return await asyncio.gather(*requests)
+
+  async def download_tiles(self, mapId, tiles, resource):
+    tilesResource = {}
+    results = await self.fetch_tiles(mapId, tiles, resource)
+    for tile, tileRes in zip(tiles, results):
+      if tileRes is not None:
+        tilesResource[str(asTile(tile))] = tileRes
+    return tilesResource
+
+  async def build_png(self, mapId, tiles, resource, outputFile):
+    makedirs(self.outputDir, exist_ok=True)
+    if len(tiles) == 0:
+      spaceKnowLogger.error('No tiles available for %s' % outputFile)
+      return
+    mosaic = Mosaic(tiles)
+    try:
+      decoder = getTileDecoder()
+      requests = [self.located_resource(mapId, asTile(tile), resource)
+                  for tile in tiles]
+      with getMetrics().timer('sk_map_seconds', stage='build_png',
+                              resource=resource):
+        for request in asyncio.as_completed(requests):
+          tile, pixels = await request
+          mosaic.paste(tile, pixels)
+          decoder.recycle(pixels)
+        await asyncio.to_thread(mosaic.save,
+                                path.join(self.outputDir, outputFile))
+    finally:
+      mosaic.close()
+
+
+class AsyncCarsObject(AsyncKrakenObject):
+  def __init__(self, transport, mapType='cars', store=None):
+    super().__init__(transport, mapType, store=store)
+    self.detections = None
+
+  async def detectCars(self, mapId, tiles):
+    """ Coroutine version of CarsObject.detectCars; the DetectionTable of
+        the map is kept in self.detections
+    """
+    with getMetrics().timer('sk_map_seconds', stage='detect'):
+      self.detections = await self.analyseDetections(mapId, tiles)
+    return self.detections.total, \
+      TileSet(self.detections.tiles[self.detections.tilesWithDetections()])
+
+  async def analyseDetections(self, mapId, tiles):
+    """ CarsObject.analyseDetections on the event loop: the tiles already
+        processed according to the run manifest are not downloaded again,
+        the others are journaled once the map is downloaded
+    """
+    manifest = getManifest()
+    processed = await asyncio.to_thread(manifest.tiles, mapId) \
+      if manifest else {}
+    missing = [tile for tile in tiles if str(asTile(tile)) not in processed] \
+      if processed else tiles
+    if processed:
+      spaceKnowLogger.info("Map %s: %d tiles already processed" %
+                           (mapId, len(tiles) - len(missing)))
+    analysis = await self.download_tiles(mapId, missing, 'detections.geojson')
+    if manifest and analysis:
+      await asyncio.to_thread(
+        lambda: manifest.addTiles(mapId, journalRows(analysis)))
+    analysis.update(processed)
+    with getMetrics().timer('sk_map_seconds', stage='aggregate'):
+      return await asyncio.to_thread(DetectionTable.fromAnalysis, tiles,
+                                     analysis)
+
+
+class AsyncKrakenManager(KrakenManager):
+  """ KrakenManager whose maps run as coroutines on the event loop of the
+      AsyncTransport. It keeps the run store, the DetectionIndex, the
+      summary and the result store of KrakenManager, and the imagery PNG
+      of a map released with its imagery alongside only covers the tiles
+      around its cars.
+  """
+  def __init__(self, transport, logger=spaceKnowLogger, operations=(),
+               store=None, margin=None, outputDir='output'):
+    super().__init__(logger, operations, store, processes=0, margin=margin,
+                     outputDir=outputDir)
+    self.transport = transport
+
+  async def run_map(self, imagery, operations):
+    """ Coroutine version of KrakenManager.run_map
+    """
+    mapId, tiles, cars = imagery['mapId'], imagery['tiles'], None
+    if 'CAR_DETECTION' in operations:
+      self.logger.info("Detecting cars for map %s"% mapId)
+      detector = AsyncCarsObject(self.transport, store=self.store)
+      cars, tiles = await detector.detectCars(mapId, imagery['tiles'])
+      self.detections[mapId] = detector.detections
+      await asyncio.to_thread(self.index.add, detector.detections,
+                              sceneTimestamp(imagery), mapId)
+      await asyncio.to_thread(storeResults, imagery, detector.detections,
+                              self.logger)
+    if 'BUILD_CARS_PNG' in operations and (cars is None or cars > 0):
+      await self.build_image(mapId, tiles, 'BUILD_CARS_PNG')
+    if 'BUILD_PNG' in operations:
+      companion = imagery.get('alongside', {}).get('imagery')
+      if companion is not None:
+        await asyncio.wait([companion])
+      imageryMap, imageryTiles = self.imagery_for(
+        imagery, tiles if cars is not None else None)
+      if imageryMap and len(imageryTiles) > 0:
+        await self.build_image(imageryMap['mapId'], imageryTiles, 'BUILD_PNG')
+    return mapId, cars, tiles
+
+  async def stream(self, maps, operations, callback=None, workers=None):
+    """ KrakenManager.stream over an async iterable of maps, e.g. the
+        generator of iterRelease: at most `workers` maps (SK_MAP_WORKERS)
+        are processed at the same time
+    """
+    for operation in operations:
+      validateOperations(operation)
+    workers = workers or MAP_WORKERS
+    pending = {}
+    async for imagery in maps:
+      pending[asyncio.ensure_future(self.run_map(imagery, operations))] = \
+        imagery.get('mapId')
+      if len(pending) < workers:
+        continue
+      done, _ = await asyncio.wait(pending,
+                                   return_when=asyncio.FIRST_COMPLETED)
+      for result in self._results(done, pending, callback):
+        yield result
+    while pending:
+      done, _ = await asyncio.wait(pending,
+                                   return_when=asyncio.FIRST_COMPLETED)
+      for result in self._results(done, pending, callback):
+        yield result
+
+  async def build_image(self, mapId, tiles, operation):
+    validateOperations(operation)
+    manifest = getManifest()
+    stage = '%s/%s' % (operation, mapId)
+    self.built.append((operation, mapId))
+    if manifest and manifest.done(stage):
+      self.logger.info("PNG file for %s already built" % mapId[-10:])
+      return
+    self.logger.info("Creating PNG file for %s"% mapId[-10:])
+    if operation == 'BUILD_CARS_PNG':
+      imageGenerator = AsyncKrakenObject(self.transport, 'cars',
+                                         outputDir=self.outputDir,
+                                         store=self.store)
+      await imageGenerator.build_png(mapId, tiles, 'cars.png',
+                                     mapId[-10:]+'_detection.png')
+    elif operation == 'BUILD_PNG':
+      imageGenerator = AsyncKrakenObject(self.transport, 'imagery',
+                                         outputDir=self.outputDir,
+                                         store=self.store)
+      await imageGenerator.build_png(mapId, tiles, 'truecolor.png',
+                                     mapId[-10:]+'_imagery.png')
+    if manifest:
+      manifest.complete(stage)
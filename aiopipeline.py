@@ -0,0 +1,113 @@
+import asyncio
+import json
+import utils
+
+from aioutils import process
+from config import getConfig
+from manifest import getManifest
+from utils import SpaceKnowError
+
+
+class AsyncPipeline():
+  """ Coroutine version of pipeline.Pipeline: it waits the nextTry delays on
+      the event loop instead of sleeping inside a dedicated thread. Like
+      Pipeline, it returns the result recorded by the run manifest for a
+      pipeline already RESOLVED and reattaches a pipeline still PROCESSING.
+
+      Usage:
+        result = await AsyncPipeline(transport, url, token, request).run()
+  """
+  def __init__(self, transport, url, token, request, manifest=None):
+    self.transport = transport
+    self.url = url
+    self.token = token
+    self.request = request
+    self.manifest = manifest if manifest is not None else getManifest()
+    self.id = None
+    self.nextTry = 0
+    self.error = None
+
+  async def __initiate(self):
+    utils.spaceKnowLogger.debug("Initiate pipeline at %s" % self.url)
+    response = await process(self.transport, self.url+'/initiate',
+                             data=self.request, token=self.token)
+    if 'pipelineId' not in response or 'nextTry' not in response or \
+      'status' not in response:
+      raise SpaceKnowError('Invalid response', 500)
+    if response['status'] == 'FAILED':
+      raise SpaceKnowError('Error during pipeline processing', 500)
+    elif response['status'] == 'PROCESSING' or response['status'] == 'NEW':
+      return response['nextTry'], response['pipelineId']
+    else:
+      raise SpaceKnowError('Invalid status {}'.format(response['status']), 500)
+
+  async def __isReady(self):
+    url = getConfig().taskApi + '/get-status'
+    pipelineId = json.dumps({"pipelineId": self.id})
+    response = await process(self.transport, url, data=pipelineId,
+                             token=self.token)
+    if 'status' not in response or \
+      (response['status']!='RESOLVED' and 'nextTry' not in response):
+      raise SpaceKnowError('Invalid response during checking the pipeline\'s '
+                           'status: %s' % pipelineId, 500)
+    if response['status'] == 'RESOLVED':
+      return True
+    elif response['status'] == 'FAILED':
+      raise SpaceKnowError('Error during pipeline processing', 500)
+    self.nextTry = response['nextTry']
+    return False
+
+  async def __retrieve(self):
+    pipelineId = json.dumps({"pipelineId": self.id})
+    utils.spaceKnowLogger.debug("Retrieve pipeline at %s" % self.url)
+    return await process(self.transport, self.url+'/retrieve', data=pipelineId,
+                         token=self.token)
+
+  async def run(self):
+    """ Runs the whole pipeline and returns the retrieved result.
+        The pipeline holds a slot of transport.pipelines while it is alive.
+    """
+    entry = await asyncio.to_thread(self.manifest.pipeline, self.url,
+                                    self.request) if self.manifest else None
+    if entry and entry[1] == 'RESOLVED':
+      utils.spaceKnowLogger.debug("Pipeline %s already resolved" % entry[0])
+      self.id = entry[0]
+      return entry[2]
+    async with self.transport.pipelines:
+      try:
+        if entry:
+          try:
+            utils.spaceKnowLogger.debug("Reattaching pipeline %s" % entry[0])
+            self.id = entry[0]
+            return await self.__resolve()
+          except SpaceKnowError as e:
+            # the pipeline of the previous run is gone: start a new one
+            utils.spaceKnowLogger.info("Pipeline %s can not be resumed: %s" %
+                                       (self.id, e.error))
+            await asyncio.to_thread(self.manifest.forgetPipeline, self.url,
+                                    self.request)
+        self.nextTry, self.id = await self.__initiate()
+        if self.manifest:
+          await asyncio.to_thread(self.manifest.startPipeline, self.url,
+                                  self.request, self.id)
+        await asyncio.sleep(self.nextTry)
+        return await self.__resolve()
+      except SpaceKnowError as e:
+        utils.spaceKnowLogger.error("Error %d at pipeline %s: %s" %
+                                    (e.status_code, self.url, e.error))
+        self.error = e
+        raise e
+
+  async def __resolve(self):
+    """ Waits until the pipeline is RESOLVED, retrieves and records its
+        result
+    """
+    while not await self.__isReady():
+      utils.spaceKnowLogger.debug("Pipeline %s is not ready. Retry in %d" %
+                                  (self.id, self.nextTry))
+      await asyncio.sleep(self.nextTry)
+    result = await self.__retrieve()
+    if self.manifest:
+      await asyncio.to_thread(self.manifest.resolvePipeline, self.url,
+                              self.request, self.id, result)
+    return result
@@ -0,0 +1,63 @@
+import asyncio
+
+from aiokraken import AsyncKrakenManager, iterRelease
+from aiopipeline import AsyncPipeline
+from aioutils import AsyncTransport
+from config import getConfig
+from spaceknow import logger, logFound, planRun, prepare_searchReq, \
+  reportRun, runOperations
+from utils import SpaceKnowError, validateAccessRights
+
+
+async def searchImagery(transport, permissions, token, extent):
+  validateAccessRights([getConfig().imgAvailability], permissions)
+  url = getConfig().imageApi + '/search'
+  logger.info("Created Pipeline. Waiting for results...")
+  response = await AsyncPipeline(transport, url, token,
+                                 prepare_searchReq(extent)).run()
+  if not response or 'results' not in response or len(response['results'])==0:
+    raise SpaceKnowError('Any imagery found in the response', 500)
+  return response['results']
+
+async def analyseAreaAsync(token, permissions, area, buildImages=True,
+                           callback=None, outputDir='output'):
+  """ spaceknow.analyseArea driven by a single event loop: the scenes are
+      priced and released by the CreditScheduler of the run (planRun), the
+      maps are processed by an AsyncKrakenManager as soon as they are
+      released and the run manifest, the run store, the DetectionIndex and
+      the result store are the ones of analyseArea. The work queue is not
+      available with this engine. Returns the same result of analyseArea.
+  """
+  async with AsyncTransport() as transport:
+    logger.info("Downloading imagery for Staff Parking Lot...")
+    scenes = await searchImagery(transport, permissions, token, area)
+    logger.info("Downloaded %d scenes"% len(scenes))
+    # the dry-runs run on the threads of the scheduler
+    scheduler, budget = await asyncio.to_thread(planRun, token, permissions,
+                                                area, scenes, buildImages)
+    operations = runOperations(buildImages)
+    logger.info("Downloading Imagery Maps and detecting cars...")
+    skippedTiles = {'cars': 0, 'imagery': 0}
+    companions = []
+    released = []
+    krakenManager = AsyncKrakenManager(transport, operations=operations,
+                                       outputDir=outputDir)
+
+    async def carMaps():
+      alongside = ('imagery',) if buildImages else ()
+      async for carMap in iterRelease(transport, scheduler, 'cars', scenes,
+                                      budget, alongside):
+        released.append(carMap['sceneId'])
+        skippedTiles['cars'] += carMap['skippedTiles']
+        companions.extend(carMap.get('alongside', {}).values())
+        yield carMap
+
+    total = 0
+    async for mapId, cars, tiles in krakenManager.stream(carMaps(), operations,
+                                                         callback):
+      total += cars
+      logFound(mapId, cars, buildImages)
+    # the imagery of the maps which failed is still released
+    await asyncio.gather(*companions, return_exceptions=True)
+    return reportRun(krakenManager, area, scheduler, budget, released, total,
+                     skippedTiles, companions, 0, buildImages)
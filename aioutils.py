@@ -0,0 +1,195 @@
+import aiohttp
+import asyncio
+import json
+import random
+import time
+
+from config import getConfig
+from json import JSONDecodeError
+from metrics import endpoint, getMetrics
+from transport import endpointGroup, getTransport, idempotent, \
+  parseRetryAfter, RETRY_STATUS
+from utils import prepare_auth_header, spaceKnowLogger, validateResponse, \
+  SpaceKnowError
+
+
+class AsyncTransport():
+  """ aiohttp counterpart of transport.Transport used by the asyncio engine.
+
+      A single ClientSession keeps the connections alive for the whole event
+      loop; `requests` bounds the requests in flight, `tiles` and `pipelines`
+      are semaphores that callers use to bound tile downloads and pipelines
+      running at the same time.
+
+      The rate limit and the EndpointLimiters (AIMD) are the ones of the
+      Transport of the process by default, so both engines adapt to the same
+      capacity of the API, and the retries follow the same caps: 429
+      answers have maxThrottled retries of their own and a Retry-After
+      delay is bounded by retryAfterMax.
+
+      Arguments:
+      maxRequests -- requests in flight at the same time (SK_ASYNC_REQUESTS)
+      maxTiles -- tile downloads at the same time (SK_ASYNC_TILES)
+      maxPipelines -- pipelines running at the same time (SK_ASYNC_PIPELINES)
+      endpoints -- EndpointLimiters, None for the ones of getTransport()
+      limiter -- RateLimiter of every request, None for the one of
+                 getTransport()
+      maxThrottled -- 429 answers retried on top of maxRetries
+                      (SK_MAX_THROTTLED)
+      retryAfterMax -- upper bound of a Retry-After delay in seconds
+                       (SK_RETRY_AFTER_MAX)
+  """
+  # seconds between two checks of an endpoint at its limit, for the
+  # requests released outside the event loop
+  POLL_INTERVAL = 0.05
+
+  def __init__(self, maxRequests=None, maxTiles=None, maxPipelines=None,
+               connectTimeout=None, readTimeout=None, maxRetries=None,
+               backoffBase=None, backoffMax=None, endpoints=None, limiter=None,
+               maxThrottled=None, retryAfterMax=None):
+    config = getConfig()
+    self.maxRequests = maxRequests or config.asyncRequests
+    self.maxTiles = maxTiles or config.asyncTiles
+    self.maxPipelines = maxPipelines or config.asyncPipelines
+    self.timeout = aiohttp.ClientTimeout(
+      sock_connect=connectTimeout or config.connectTimeout,
+      sock_read=readTimeout or config.readTimeout)
+    self.maxRetries = maxRetries if maxRetries is not None else \
+      config.maxRetries
+    self.backoffBase = backoffBase or config.backoffBase
+    self.backoffMax = backoffMax or config.backoffMax
+    self.maxThrottled = maxThrottled if maxThrottled is not None else \
+      config.maxThrottled
+    self.retryAfterMax = retryAfterMax if retryAfterMax is not None else \
+      config.retryAfterMax
+    if endpoints is None or limiter is None:
+      transport = getTransport()
+      endpoints = transport.endpoints if endpoints is None else endpoints
+      limiter = transport.limiter if limiter is None else limiter
+    self.endpoints = endpoints
+    self.limiter = limiter
+    self._session = None
+
+  async def __aenter__(self):
+    self.requests = asyncio.Semaphore(self.maxRequests)
+    self.tiles = asyncio.Semaphore(self.maxTiles)
+    self.pipelines = asyncio.Semaphore(self.maxPipelines)
+    self._released = asyncio.Condition()
+    connector = aiohttp.TCPConnector(limit=self.maxRequests)
+    self._session = aiohttp.ClientSession(connector=connector,
+                                          timeout=self.timeout)
+    return self
+
+  async def __aexit__(self, *exc):
+    await self._session.close()
+
+  def backoff(self, attempt):
+    return random.uniform(0, min(self.backoffMax,
+                                 self.backoffBase * (2 ** attempt)))
+
+  async def throttle(self, bucket):
+    """ RateLimiter.acquire on the event loop
+    """
+    while True:
+      wait = bucket.tryAcquire()
+      if not wait:
+        return
+      await asyncio.sleep(wait)
+
+  async def acquire(self, endpoint):
+    """ EndpointLimiter.acquire on the event loop; returns the start time
+    """
+    async with self._released:
+      while True:
+        wait = endpoint.tryAcquire()
+        if wait == 0:
+          break
+        try:
+          await asyncio.wait_for(self._released.wait(),
+                                 wait if wait is not None else
+                                 self.POLL_INTERVAL)
+        except asyncio.TimeoutError:
+          pass
+    if endpoint.bucket:
+      await self.throttle(endpoint.bucket)
+    return time.monotonic()
+
+  async def release(self, endpoint, started, congested, retryAfter):
+    endpoint.release(started, congested, retryAfter)
+    async with self._released:
+      self._released.notify_all()
+
+  async def request(self, method, url, **kwargs):
+    """ Sends a request and returns (status, body as bytes), retrying on
+        connection errors, 429 and 5xx like transport.Transport (after the
+        delay of their Retry-After, if any, up to retryAfterMax). 429
+        answers have maxThrottled retries of their own. The POSTs which
+        initiate a pipeline are only retried on 429 and when no connection
+        was made.
+    """
+    retryable = idempotent(method, url)
+    endpoint = self.endpoints.get(url) if self.endpoints else None
+    attempt = throttled = 0
+    while True:
+      if self.limiter:
+        await self.throttle(self.limiter)
+      started = await self.acquire(endpoint) if endpoint else 0
+      congested, retryAfter = True, None
+      try:
+        async with self.requests:
+          async with self._session.request(method, url, **kwargs) as response:
+            body = await response.read()
+            congested = response.status in RETRY_STATUS
+            if congested:
+              retryAfter = parseRetryAfter(
+                response.headers.get('Retry-After'))
+              if retryAfter is not None:
+                retryAfter = min(retryAfter, self.retryAfterMax)
+            throttle = response.status == 429 and \
+              throttled < self.maxThrottled
+            retry = congested and (retryable or response.status == 429)
+            if not retry or (attempt >= self.maxRetries and not throttle):
+              return response.status, body
+      except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+        throttle = False
+        if attempt >= self.maxRetries or \
+          not (retryable or isinstance(e, aiohttp.ClientConnectorError)):
+          raise
+      finally:
+        if endpoint:
+          await self.release(endpoint, started, congested, retryAfter)
+      if congested:
+        getMetrics().add('sk_congested_total', endpoint=endpointGroup(url))
+      if retryAfter is not None:
+        await asyncio.sleep(retryAfter)
+      else:
+        await asyncio.sleep(self.backoff(attempt + throttled))
+      if throttle:
+        throttled += 1
+      else:
+        attempt += 1
+
+
+async def process(transport, url, data='', token='', isGET=False):
+  """ Sends a request at SpaceKnow API on the event loop.
+    Arguments:
+    transport -- AsyncTransport opened by the caller
+    url -- SpaceKnow endpoint
+    data -- json object to provide at the endpoint
+    token -- user token to fill up Authorization field
+  """
+  headers = prepare_auth_header(token) if token else None
+  metrics = getMetrics()
+  try:
+    with metrics.timer('sk_request_seconds', endpoint=endpoint(url)):
+      status, body = await transport.request('GET' if isGET else 'POST', url,
+                                             data=data or None,
+                                             headers=headers)
+    metrics.add('sk_bytes_received_total', len(body), kind='api')
+    return validateResponse(status, json.loads(body))
+  except (aiohttp.ClientError, asyncio.TimeoutError):
+    spaceKnowLogger.error("Impossible to connect at %s" % url)
+    raise SpaceKnowError('Impossible to connect at %s' % url, -1)
+  except (JSONDecodeError, UnicodeDecodeError):
+    spaceKnowLogger.error("Invalid JSON received from %s" % url)
+    raise SpaceKnowError('Response is not a valid JSON', -1)
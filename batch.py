@@ -0,0 +1,319 @@
+import argparse
+import concurrent.futures
+import csv
+import geojson
+import json
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from config import getConfig, initLogging
+from datetime import datetime, timedelta
+from detections import DETECTION_CLASSES
+from geo import pointsInGeometry
+from geojson import GeometryCollection
+from kraken import CarsObject, sceneTimestamp, storeResults
+from manifest import closeManifest, openManifest
+from metrics import startInstrumentation, stopInstrumentation
+from results import closeResults, openResults
+from scheduler import CreditBudget, CreditScheduler
+from spaceknow import areaFromGeoJSON, getCreditsAvailable, loadArea, \
+  logger, releasePermissions, searchScenes
+from transport import getTransport
+from utils import authenticate, getPermissions, SpaceKnowError, \
+  validateAccessRights
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+WINDOW_DAYS = getConfig().batchWindowDays
+BATCH_WORKERS = getConfig().batchWorkers
+
+TIME_SERIES_DTYPE = [('area', object), ('sceneId', object),
+                     ('datetime', 'datetime64[s]'), ('count', np.int64)] + \
+  [(name, np.int64) for name in DETECTION_CLASSES]
+
+
+def parseDatetime(value):
+  """ Accepts 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS'
+  """
+  if isinstance(value, datetime):
+    return value
+  for fmt in (DATETIME_FORMAT, '%Y-%m-%d'):
+    try:
+      return datetime.strptime(value, fmt)
+    except ValueError:
+      pass
+  raise SpaceKnowError('Invalid date %s' % value, 400)
+
+
+def splitWindows(start, end, days=WINDOW_DAYS):
+  """ Splits [start, end] in consecutive windows of at most `days` days,
+      as (startDatetime, endDatetime) strings of imagery/search
+  """
+  start, end = parseDatetime(start), parseDatetime(end)
+  if end < start:
+    raise SpaceKnowError('Invalid date range %s - %s' % (start, end), 400)
+  windows = []
+  while start <= end:
+    stop = min(start + timedelta(days=days) - timedelta(seconds=1), end)
+    windows.append((start.strftime(DATETIME_FORMAT),
+                    stop.strftime(DATETIME_FORMAT)))
+    start = stop + timedelta(seconds=1)
+  return windows
+
+
+class BatchJob():
+  """ An area analysed over a date range.
+      An `end` given as a date includes the whole day.
+  """
+  def __init__(self, name, area, start, end):
+    self.name = name
+    self.area = area
+    self.start = parseDatetime(start)
+    self.end = parseDatetime(end)
+    if isinstance(end, str) and len(end.strip()) == 10:
+      self.end += timedelta(days=1) - timedelta(seconds=1)
+    self.key = json.dumps(area, sort_keys=True)
+
+
+def loadJobs(filename):
+  """ Reads the jobs from a JSON list of objects with name, start, end and
+      either area (a GeoJSON Feature) or geojson (a GeoJSON file)
+  """
+  try:
+    with open(filename) as fp:
+      specs = json.load(fp)
+  except FileNotFoundError:
+    raise SpaceKnowError("File %s not found" % filename, 404)
+  jobs = []
+  for spec in specs:
+    if 'area' in spec:
+      area = areaFromGeoJSON(geojson.loads(json.dumps(spec['area'])))
+    else:
+      area = loadArea(spec.get('geojson', ''))
+    jobs.append(BatchJob(spec.get('name', 'area-%d' % len(jobs)), area,
+                         spec['start'], spec['end']))
+  return jobs
+
+
+class BatchRunner():
+  """ Counts the cars of many areas over many date windows in one run.
+
+      Every job's date range is split in windows of `windowDays` and
+      searched concurrently. A scene found by several jobs is evaluated and
+      released once, over the union of their areas, and its detections are
+      then split by area. The scenes of every group of areas are priced and
+      released by a CreditScheduler, in priority order, and the groups
+      share the credits of the run: a scene over the budget is skipped
+      (self.skipped) instead of failing the run. Searches and the groups
+      run on `workers` threads; the global request rate is the one of the
+      shared Transport (SK_RATE_LIMIT).
+
+      Arguments:
+      token, permissions -- of an authenticated user
+      windowDays -- days of a search window (SK_BATCH_WINDOW_DAYS)
+      workers -- pipelines in flight (SK_BATCH_WORKERS)
+  """
+  def __init__(self, token, permissions, windowDays=None, workers=None):
+    self.token = token
+    self.permissions = permissions
+    self.windowDays = windowDays or WINDOW_DAYS
+    self.workers = workers or BATCH_WORKERS
+    self.releases = 0
+    self.searches = 0
+    self.skipped = []
+
+  def _map(self, function, tasks, pool):
+    futures = {pool.submit(function, *task): task for task in tasks}
+    for done in concurrent.futures.as_completed(futures):
+      yield futures[done], done.result()
+
+  def search(self, jobs, pool):
+    """ Returns {sceneId: (scene, indexes of the jobs which found it)}
+    """
+    tasks = [(index, start, end) for index, job in enumerate(jobs)
+             for start, end in splitWindows(job.start, job.end,
+                                            self.windowDays)]
+    self.searches = len(tasks)
+    found = {}
+    for (index, _, _), scenes in self._map(
+        lambda index, start, end: searchScenes(self.permissions, self.token,
+                                               jobs[index].area, start, end),
+        tasks, pool):
+      for scene in scenes:
+        found.setdefault(scene['sceneId'], (scene, set()))[1].add(index)
+    return found
+
+  def groups(self, jobs, found):
+    """ Groups the scenes by the set of distinct areas they are released
+        over: returns {area keys: (extent, scenes, job indexes)}
+    """
+    groups = {}
+    for scene, indexes in found.values():
+      areas = {}
+      for index in sorted(indexes):
+        areas.setdefault(jobs[index].key, jobs[index].area)
+      key = tuple(sorted(areas))
+      if key not in groups:
+        geometries = [geometry for area in areas.values()
+                      for geometry in area['geometries']]
+        groups[key] = (GeometryCollection(geometries), [], set())
+      groups[key][1].append(scene)
+      groups[key][2].update(indexes)
+    return groups
+
+  def evaluate(self, groups, pool):
+    """ Prices the scenes of every group; returns a list of (scheduler,
+        scenes) of the groups with at least one scene priced
+    """
+    def estimate(extent, scenes):
+      scheduler = CreditScheduler(self.token, self.permissions, extent)
+      try:
+        scheduler.estimate(scenes)
+      except SpaceKnowError as e:
+        logger.error("Error %d: %d scenes not priced: %s" %
+                     (e.status_code, len(scenes), e.error))
+        return None
+      return scheduler
+
+    planned = [(scheduler, scenes) for (_, scenes), scheduler in
+               self._map(estimate, [(extent, scenes) for extent, scenes, _ in
+                                    groups.values()], pool) if scheduler]
+    if not planned:
+      raise SpaceKnowError('Cost analysis is not available for any scene',
+                           503)
+    return planned
+
+  def releaseGroup(self, scheduler, scenes, budget, jobs, found):
+    """ Releases the scenes of a group within the budget and counts their
+        detections; returns ([(jsonMap, counts of release)], skipped scenes)
+    """
+    results = [(jsonMap, self.release(jsonMap, jobs,
+                                      found[jsonMap['sceneId']][1]))
+               for jsonMap in scheduler.iterRelease('cars', scenes, budget)]
+    return results, scheduler.skipped
+
+  def release(self, jsonMap, jobs, indexes):
+    """ Counts the detections of a released cars map (see
+        CreditScheduler.iterRelease) inside the area of every job; returns
+        a list of (job, counts per class)
+    """
+    table = CarsObject().analyseDetections(jsonMap['mapId'], jsonMap['tiles'])
+    storeResults(jsonMap, table)
+    counts, byArea = [], {}
+    for index in sorted(indexes):
+      job = jobs[index]
+      if job.key not in byArea:
+        inside = pointsInGeometry(table.lon, table.lat, job.area)
+        byArea[job.key] = np.bincount(table.cls[inside],
+                                      weights=table.count[inside],
+                                      minlength=len(DETECTION_CLASSES)) \
+          .astype(np.int64)
+      counts.append((job, byArea[job.key]))
+    return counts
+
+  def run(self, jobs):
+    """ Returns the time series of every job as a structured array with one
+        row per (area, scene): area, sceneId, datetime, count and one
+        column per detection class, sorted by area and datetime
+    """
+    with ThreadPoolExecutor(max_workers=self.workers,
+                            thread_name_prefix='Batch') as pool:
+      found = self.search(jobs, pool)
+      groups = self.groups(jobs, found)
+      if len(groups) == 0:
+        return np.zeros(0, dtype=TIME_SERIES_DTYPE)
+      planned = self.evaluate(groups, pool)
+      credits = sum(scheduler.totals()['allocatedCredits']
+                    for scheduler, _ in planned)
+      logger.info("Credits required: %.4f" % credits)
+      userCredits = getCreditsAvailable(self.token, self.permissions)
+      logger.info("My credits: %.2f" % userCredits)
+      if getConfig().creditBudget is not None:
+        userCredits = min(userCredits, getConfig().creditBudget)
+      validateAccessRights(releasePermissions(), self.permissions)
+      budget = CreditBudget(userCredits)
+      rows = []
+      for _, (released, skipped) in self._map(
+          lambda scheduler, scenes: self.releaseGroup(scheduler, scenes,
+                                                      budget, jobs, found),
+          planned, pool):
+        self.skipped.extend(skipped)
+        self.releases += len(released)
+        for scene, counts in released:
+          timestamp = sceneTimestamp(scene)
+          for job, classes in counts:
+            # seconds since the epoch in UTC: datetime64 has no timezone
+            rows.append((job.name, scene['sceneId'],
+                         np.datetime64(int(timestamp), 's'),
+                         int(classes.sum())) +
+                        tuple(int(count) for count in classes))
+      if self.skipped:
+        logger.info("Skipped %d scenes over the budget of %.2f credits" %
+                    (len(self.skipped), userCredits))
+        if self.releases == 0:
+          raise SpaceKnowError("Impossible to make analysis! The user does "
+                               "not have enough credits. Available credits: "
+                               "%.2f" % userCredits, 402)
+    series = np.zeros(len(rows), dtype=TIME_SERIES_DTYPE)
+    for row, values in enumerate(rows):
+      series[row] = values
+    order = np.lexsort((series['sceneId'].astype(str), series['datetime'],
+                        series['area'].astype(str)))
+    return series[order]
+
+
+def saveTimeSeries(filename, series):
+  """ Writes the time series as CSV, one column per field
+  """
+  with open(filename, 'w', newline='') as fp:
+    writer = csv.writer(fp)
+    writer.writerow(series.dtype.names)
+    for row in series:
+      writer.writerow([str(value) for value in row.tolist()])
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Car counts of many areas over many date windows')
+  parser.add_argument('jobs', help='JSON list of {name, geojson or area, '
+                      'start, end}')
+  parser.add_argument('output', help='CSV file of the time series')
+  parser.add_argument('--window-days', type=int, default=WINDOW_DAYS)
+  parser.add_argument('--workers', type=int, default=BATCH_WORKERS)
+  parser.add_argument('--rate', type=float, default=0,
+                      help='requests per second at SpaceKnow API')
+  args = parser.parse_args()
+
+  initLogging()
+  if args.rate:
+    getTransport().setRateLimit(args.rate)
+  startInstrumentation()
+  try:
+    config = getConfig()
+    token = authenticate(config.username, config.password)
+    if not token:
+      raise SpaceKnowError('Authentication failed', 401)
+    permissions = getPermissions(token)
+    if not permissions:
+      raise SpaceKnowError('Impossible to check permission available for the '
+                           'users', 403)
+    runner = BatchRunner(token, permissions, args.window_days, args.workers)
+    openManifest()
+    openResults()
+    series = runner.run(loadJobs(args.jobs))
+  except SpaceKnowError as e:
+    logger.error("Error {}: {}".format(str(e.status_code), e.error))
+    # the manifest is kept: the next run resumes the pipelines and tiles
+    closeManifest()
+    closeResults()
+    stopInstrumentation()
+    raise SystemExit(1)
+  saveTimeSeries(args.output, series)
+  closeManifest(completed=True)
+  closeResults()
+  stopInstrumentation()
+  logger.info("%d searches, %d releases, %d rows written in %s" %
+              (runner.searches, runner.releases, len(series), args.output))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,257 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from mockserver import MockSpaceKnow
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# name: (scenes, tiles per map)
+SCALES = {'1x10': (1, 10),
+          '10x100': (10, 100),
+          '50x200': (50, 200),
+          '100x1000': (100, 1000),
+          '500x200': (500, 200)}
+DEFAULT_SCALES = ['1x10', '10x100', '50x200']
+# modules the CLI entry point loads on first use only, never at import
+LAZY_MODULES = ('numpy', 'PIL', 'requests', 'geojson', 'flask', 'aiohttp',
+                'multiprocessing', 'kraken', 'scheduler')
+
+
+def runClient(filename):
+  """ Runs spaceknow.runCarDetections in this process and prints wall time,
+      peak RSS and peak thread count as JSON on the last line of stdout.
+  """
+  import resource
+  import threading
+
+  sys.path.insert(0, PROJECT_DIR)
+  import spaceknow
+
+  peakThreads = [threading.active_count()]
+  running = threading.Event()
+  running.set()
+
+  def sampleThreads():
+    while running.is_set():
+      peakThreads[0] = max(peakThreads[0], threading.active_count())
+      time.sleep(0.05)
+
+  sampler = threading.Thread(target=sampleThreads, daemon=True)
+  sampler.start()
+  start = time.perf_counter()
+  completed = True
+  try:
+    spaceknow.runCarDetections('benchmark', 'benchmark', filename)
+  except SystemExit:
+    completed = False
+  wall = time.perf_counter() - start
+  running.clear()
+  print(json.dumps({'wall': wall,
+                    'completed': completed,
+                    # ru_maxrss is in KiB on Linux
+                    'peakRssMiB': resource.getrusage(resource.RUSAGE_SELF)
+                    .ru_maxrss / 1024.0,
+                    'peakThreads': peakThreads[0] - 1}))
+
+
+def startWorkers(nodes, workDir, env, timeout=60):
+  """ Starts `nodes` worker processes of the distributed engine, each one
+      in its own directory like on separate hosts, and waits until they
+      are all waiting for jobs: the run measures the engine, not the
+      start of the workers (long-running on real hosts) competing with
+      the client for the CPU.
+  """
+  workers = []
+  for node in range(nodes):
+    nodeDir = os.path.join(workDir, 'node%d' % node)
+    os.makedirs(nodeDir)
+    shutil.copy(os.path.join(PROJECT_DIR, 'logging.conf'), nodeDir)
+    workers.append((subprocess.Popen(
+      [sys.executable, os.path.join(PROJECT_DIR, 'workqueue.py'), 'worker',
+       '--exit'], cwd=nodeDir, env=env, stdout=subprocess.DEVNULL,
+      stderr=subprocess.PIPE, text=True), os.path.join(nodeDir,
+                                                       'spaceknow.log')))
+  deadline = time.monotonic() + timeout
+  for worker, logFile in workers:
+    while True:
+      if os.path.exists(logFile):
+        with open(logFile) as fp:
+          if 'waiting for jobs' in fp.read():
+            break
+      if worker.poll() is not None or time.monotonic() > deadline:
+        worker.kill()
+        raise RuntimeError('Worker did not start:\n%s' %
+                           worker.communicate()[1])
+      time.sleep(0.05)
+  return [worker for worker, _ in workers]
+
+
+def runScale(name, scenes, tiles, latency, nextTry, errorRate, engine,
+             nodes=0):
+  """ Starts the mock API, runs the client in a fresh process (so RSS,
+      threads and process-wide pools are measured from zero) and returns
+      the measures of the run. With `nodes`, the client coordinates that
+      many worker processes through a SQLite queue (SK_ENGINE=distributed).
+  """
+  workDir = tempfile.mkdtemp(prefix='skbench')
+  shutil.copy(os.path.join(PROJECT_DIR, 'logging.conf'), workDir)
+  if nodes:
+    engine = 'distributed'
+  with MockSpaceKnow(scenes=scenes, tilesPerMap=tiles, latency=latency,
+                     nextTry=nextTry, errorRate=errorRate) as server:
+    env = dict(os.environ)
+    env.update(server.environ())
+    env.update({'SK_TILE_CACHE_DIR': '', 'SK_ENGINE': engine,
+                'SK_BACKOFF_BASE': '0.05', 'SK_PRUNE_TILES': '0',
+                'SK_QUEUE': os.path.join(workDir, 'queue.sqlite'),
+                'PYTHONPATH': PROJECT_DIR})
+    workers = startWorkers(nodes, workDir, env)
+    geojsonFile = os.path.join(PROJECT_DIR, 'over_brisbane_airport.geojson')
+    process = subprocess.run([sys.executable, os.path.abspath(__file__),
+                              '--client', geojsonFile],
+                             cwd=workDir, env=env, capture_output=True,
+                             text=True)
+    for worker in workers:
+      _, errors = worker.communicate()
+      if worker.returncode != 0:
+        raise RuntimeError('Worker of %s failed:\n%s' % (name, errors))
+    requests = server.totalRequests
+    endpoints = dict(server.requests)
+  shutil.rmtree(workDir, ignore_errors=True)
+  lines = process.stdout.strip().splitlines()
+  if process.returncode != 0 or not lines:
+    raise RuntimeError('Benchmark %s failed:\n%s' % (name, process.stderr))
+  result = json.loads(lines[-1])
+  result.update({'scale': name, 'scenes': scenes, 'tiles': scenes * tiles,
+                 'engine': engine, 'nodes': nodes, 'requests': requests,
+                 'requestsPerSec': requests / result['wall'],
+                 'endpoints': endpoints})
+  return result
+
+
+def parseImportTime(output):
+  """ [(name, depth, self us, cumulative us)] of the stderr of
+      python -X importtime
+  """
+  imports = []
+  for line in output.splitlines():
+    if not line.startswith('import time:'):
+      continue
+    fields = line[len('import time:'):].split('|')
+    if len(fields) != 3 or not fields[0].strip().isdigit():
+      continue
+    name = fields[2].rstrip()
+    imports.append((name.strip(), (len(name) - len(name.lstrip())) // 2,
+                    int(fields[0]), int(fields[1])))
+  return imports
+
+
+def measureStartup(module, runs, top=10):
+  """ Imports `module` in `runs` fresh interpreters with -X importtime and
+      returns the median run: import time of the module in ms, its slowest
+      imports (self time) and the LAZY_MODULES it loaded
+  """
+  measures = []
+  for _ in range(runs):
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                              'import %s' % module], cwd=PROJECT_DIR,
+                             capture_output=True, text=True)
+    if process.returncode != 0:
+      raise RuntimeError('Import of %s failed:\n%s' % (module, process.stderr))
+    imports = parseImportTime(process.stderr)
+    total = sum(cumulative for name, depth, _, cumulative in imports
+                if depth == 0 and name == module)
+    measures.append((total, imports))
+  total, imports = sorted(measures, key=lambda measure: measure[0])[runs // 2]
+  names = {name.split('.')[0] for name, _, _, _ in imports}
+  slowest = sorted(imports, key=lambda item: item[2], reverse=True)[:top]
+  return {'module': module, 'importMs': total / 1000.0,
+          'slowest': [{'name': name, 'selfMs': selfUs / 1000.0}
+                      for name, _, selfUs, _ in slowest],
+          'eager': sorted(name for name in LAZY_MODULES if name in names)}
+
+
+def runStartup(args):
+  """ Startup benchmark; returns 1 when the import is over the budget or
+      loads a module which should be lazy
+  """
+  result = measureStartup(args.startup_module, args.runs)
+  print('import %s: %.1f ms (median of %d)' % (result['module'],
+                                              result['importMs'], args.runs))
+  for item in result['slowest']:
+    print('  %8.2f ms  %s' % (item['selfMs'], item['name']))
+  if args.json:
+    with open(args.json, 'w') as fp:
+      json.dump(result, fp, indent=2)
+  failed = 0
+  if result['eager']:
+    print('Loaded at import: %s' % ', '.join(result['eager']))
+    failed = 1
+  if args.budget_ms and result['importMs'] > args.budget_ms:
+    print('Over the budget of %.1f ms' % args.budget_ms)
+    failed = 1
+  return failed
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='End-to-end benchmark of runCarDetections on the mock API')
+  parser.add_argument('--scales', nargs='+', default=DEFAULT_SCALES,
+                      help='scales to run (%s) or "all"' % ', '.join(SCALES))
+  parser.add_argument('--latency', type=float, default=0.0,
+                      help='seconds added by the mock to every response')
+  parser.add_argument('--next-try', type=float, default=0.0,
+                      help='nextTry of every mock pipeline')
+  parser.add_argument('--error-rate', type=float, default=0.0,
+                      help='probability of a 503 from the mock')
+  parser.add_argument('--engine', default='threads',
+                      choices=['threads', 'async'])
+  parser.add_argument('--nodes', nargs='+', type=int, default=[0],
+                      help='worker processes of the distributed engine, e.g. '
+                      '1 2 4 to measure its scaling; 0 runs --engine')
+  parser.add_argument('--json', help='also write the results in this file')
+  parser.add_argument('--startup', action='store_true',
+                      help='measure the import time of the entry point '
+                      '(-X importtime) instead of running the scales')
+  parser.add_argument('--startup-module', default='spaceknow')
+  parser.add_argument('--runs', type=int, default=5,
+                      help='fresh interpreters of the startup benchmark')
+  parser.add_argument('--budget-ms', type=float, default=0,
+                      help='fail the startup benchmark over this import time')
+  parser.add_argument('--client', help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.client:
+    runClient(args.client)
+    return
+  if args.startup:
+    sys.exit(runStartup(args))
+
+  names = list(SCALES) if 'all' in args.scales else args.scales
+  results = []
+  print('%-10s %5s %7s %8s %9s %9s %9s %8s' % ('scale', 'nodes', 'scenes',
+                                               'tiles', 'wall s', 'req/s',
+                                               'RSS MiB', 'threads'))
+  for name in names:
+    scenes, tiles = SCALES[name]
+    for nodes in args.nodes:
+      result = runScale(name, scenes, tiles, args.latency, args.next_try,
+                        args.error_rate, args.engine, nodes)
+      results.append(result)
+      print('%-10s %5s %7d %8d %9.2f %9.0f %9.1f %8d%s' %
+            (name, nodes or '-', scenes, result['tiles'], result['wall'],
+             result['requestsPerSec'], result['peakRssMiB'],
+             result['peakThreads'], '' if result['completed'] else ' (exit)'))
+  if args.json:
+    with open(args.json, 'w') as fp:
+      json.dump(results, fp, indent=2)
+
+
+if __name__ == "__main__":
+  main()
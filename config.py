@@ -0,0 +1,165 @@
+import os
+import threading
+
+LOGGING_CONF = 'logging.conf'
+
+# attribute: (environment variable, type, default)
+SETTINGS = {
+  # SpaceKnow API and credentials
+  'auth0': ('SPACEKNOW_AUTH0', str, None),
+  'clientId': ('SPACEKNOW_CLIENT_ID', str, None),
+  'userApi': ('SK_USER_API', str, None),
+  'imageApi': ('SK_IMAGE_API', str, None),
+  'taskApi': ('SK_TASK_API', str, None),
+  'krakenApi': ('SK_KRAKEN_API', str, None),
+  'creditApi': ('SK_CREDIT_API', str, None),
+  'username': ('USERNAME', str, None),
+  'password': ('PASSWORD', str, None),
+  'geojsonFile': ('GEOJSON_FILE', str, None),
+  # permissions needed by the operations
+  'imgAvailability': ('IMG_AVAILABILITY', str, None),
+  'krakenDryRun': ('KRAKEN_DRY_RUN', str, None),
+  'krakenRelease': ('KRAKEN_RELEASE', str, None),
+  'creditsAvailable': ('CREDITS_AVAILABLE', str, None),
+  'imageryImages': ('IMAGERY_IMAGES', str, None),
+  'provider': ('PROVIDER_GBDX', str, None),
+  'dataset': ('GBDX_IDAHO_DB', str, None),
+  # run
+  'engine': ('SK_ENGINE', str, 'threads'),
+  'creditBudget': ('SK_CREDIT_BUDGET', float, None),
+  'priority': ('SK_PRIORITY', str, 'newest'),
+  'schedulerWorkers': ('SK_SCHEDULER_WORKERS', int, 4),
+  'dryRunScenes': ('SK_DRY_RUN_SCENES', int, 50),
+  'mapWorkers': ('SK_MAP_WORKERS', int, 4),
+  'tileWorkers': ('SK_TILE_WORKERS', int, 8),
+  'imageryMargin': ('SK_IMAGERY_MARGIN', int, 1),
+  'pruneTiles': ('SK_PRUNE_TILES', int, 1),
+  'processWorkers': ('SK_PROCESS_WORKERS', int, 0),
+  'shardTiles': ('SK_SHARD_TILES', int, 256),
+  'processStart': ('SK_PROCESS_START', str, 'spawn'),
+  'decodeWorkers': ('SK_DECODE_WORKERS', int, os.cpu_count() or 2),
+  'mosaicMemory': ('SK_MOSAIC_MEMORY', int, 64 << 20),
+  'pollWorkers': ('SK_POLL_WORKERS', int, 4),
+  'dedupMeters': ('SK_DEDUP_METERS', float, 2.0),
+  'dedupSeconds': ('SK_DEDUP_SECONDS', float, 600.0),
+  'runStoreBytes': ('SK_RUN_STORE_BYTES', int, 256 << 20),
+  'tileCacheDir': ('SK_TILE_CACHE_DIR', str, 'tilecache'),
+  'tileCacheBytes': ('SK_TILE_CACHE_BYTES', int, 1 << 30),
+  'manifest': ('SK_MANIFEST', str, 'manifest.sqlite'),
+  'results': ('SK_RESULTS', str, 'results.sqlite'),
+  # distributed engine
+  'queue': ('SK_QUEUE', str, 'queue.sqlite'),
+  'queueName': ('SK_QUEUE_NAME', str, 'spaceknow'),
+  'queueLease': ('SK_QUEUE_LEASE', float, 60.0),
+  'queueAttempts': ('SK_QUEUE_ATTEMPTS', int, 3),
+  'queuePoll': ('SK_QUEUE_POLL', float, 0.2),
+  'queueShardTiles': ('SK_QUEUE_SHARD_TILES', int, 1024),
+  'queueThreads': ('SK_QUEUE_THREADS', int, 4),
+  'queueTimeout': ('SK_QUEUE_TIMEOUT', float, 300.0),
+  # metrics and profiling
+  'logSample': ('SK_LOG_SAMPLE', float, 0.01),
+  'traceSpans': ('SK_TRACE_SPANS', int, 100000),
+  'metrics': ('SK_METRICS', str, None),
+  'profile': ('SK_PROFILE', str, None),
+  'trace': ('SK_TRACE', str, None),
+  # transport
+  'connectTimeout': ('SK_CONNECT_TIMEOUT', float, 5.0),
+  'readTimeout': ('SK_READ_TIMEOUT', float, 30.0),
+  'maxRetries': ('SK_MAX_RETRIES', int, 3),
+  'backoffBase': ('SK_BACKOFF_BASE', float, 0.5),
+  'backoffMax': ('SK_BACKOFF_MAX', float, 30.0),
+  'poolSize': ('SK_POOL_SIZE', int, 16),
+  'rateLimit': ('SK_RATE_LIMIT', float, 0.0),
+  'endpointConcurrency': ('SK_ENDPOINT_CONCURRENCY', int, 4),
+  'endpointMaxConcurrency': ('SK_ENDPOINT_MAX_CONCURRENCY', int, 64),
+  'endpointRates': ('SK_ENDPOINT_RATES', str, None),
+  'maxThrottled': ('SK_MAX_THROTTLED', int, 10),
+  'retryAfterMax': ('SK_RETRY_AFTER_MAX', float, 120.0),
+  'asyncRequests': ('SK_ASYNC_REQUESTS', int, 64),
+  'asyncTiles': ('SK_ASYNC_TILES', int, 32),
+  'asyncPipelines': ('SK_ASYNC_PIPELINES', int, 256),
+  # batch and service
+  'batchWindowDays': ('SK_BATCH_WINDOW_DAYS', int, 31),
+  'batchWorkers': ('SK_BATCH_WORKERS', int, 8),
+  'tokenTTL': ('SK_TOKEN_TTL', float, 10 * 3600 - 300.0),
+  'permissionsTTL': ('SK_PERMISSIONS_TTL', float, 3600.0),
+  'serviceWorkers': ('SK_SERVICE_WORKERS', int, 2),
+  'serviceHost': ('SK_SERVICE_HOST', str, '127.0.0.1'),
+  'servicePort': ('SK_SERVICE_PORT', int, 5000),
+}
+
+# accepted values of the settings which are a choice
+CHOICES = {'engine': ('threads', 'async', 'distributed'),
+           'priority': ('newest', 'clearest'),
+           'processStart': ('spawn', 'forkserver', 'fork')}
+
+
+class Config():
+  """ Settings of the client, read once from the environment (and the .env
+      file of the working directory, whose values do not override the
+      environment) and validated together: a malformed value fails the
+      start of the run instead of the first request which reads it.
+
+      Every setting of SETTINGS is an attribute, e.g. config.tileWorkers
+      for SK_TILE_WORKERS; settings not set get their default.
+
+      Arguments:
+      environ -- mapping of the variables, os.environ by default
+      dotenv -- whether .env is loaded in os.environ first
+  """
+  def __init__(self, environ=None, dotenv=True):
+    if environ is None:
+      if dotenv:
+        from dotenv import load_dotenv
+        load_dotenv()
+      environ = os.environ
+    errors = []
+    for name, (variable, kind, default) in SETTINGS.items():
+      value = environ.get(variable)
+      if value is None or (value == '' and kind is not str):
+        value = default
+      elif kind is not str:
+        try:
+          value = kind(value)
+        except ValueError:
+          errors.append('%s=%r is not a valid %s' % (variable, value,
+                                                     kind.__name__))
+          continue
+      if name in CHOICES and value not in CHOICES[name]:
+        errors.append('%s=%r is not one of %s' % (variable, value,
+                                                  ', '.join(CHOICES[name])))
+      setattr(self, name, value)
+    if errors:
+      raise ValueError('Invalid configuration: %s' % '; '.join(errors))
+
+  def asdict(self):
+    return {name: getattr(self, name) for name in SETTINGS}
+
+
+_config = None
+_configLock = threading.Lock()
+
+def getConfig():
+  """ Returns the Config of the process, read on first use
+  """
+  global _config
+  with _configLock:
+    if _config is None:
+      _config = Config()
+    return _config
+
+
+_logging = False
+
+def initLogging(filename=LOGGING_CONF):
+  """ Configures logging from logging.conf once per process. Called by the
+      entry points only, so spawned worker processes never truncate the
+      log file of their parent.
+  """
+  global _logging
+  with _configLock:
+    if _logging:
+      return
+    import logging.config
+    logging.config.fileConfig(filename, disable_existing_loggers=False)
+    _logging = True
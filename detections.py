@@ -0,0 +1,187 @@
+import numpy as np
+
+from utils import SpaceKnowError
+
+DETECTION_CLASSES = ('cars', 'trucks', 'other')
+
+
+def _centroid(geometry):
+  """ Mean of the vertices of a detection geometry (lon, lat)
+  """
+  if not geometry or 'coordinates' not in geometry:
+    return np.nan, np.nan
+  coordinates = geometry['coordinates']
+  kind = geometry.get('type')
+  if kind == 'Point':
+    return coordinates[0], coordinates[1]
+  if kind == 'Polygon':
+    ring = coordinates[0]
+  elif kind == 'MultiPolygon':
+    ring = [point for polygon in coordinates for point in polygon[0]]
+  elif kind in ('LineString', 'MultiPoint'):
+    ring = coordinates
+  else:
+    return np.nan, np.nan
+  if len(ring) > 1 and ring[0] == ring[-1]:
+    ring = ring[:-1]
+  points = np.asarray(ring, dtype=np.float64)
+  return points[:, 0].mean(), points[:, 1].mean()
+
+
+class DetectionTable():
+  """ Columnar view of the detections of a map.
+
+      Every column has one entry per detection feature:
+      tile -- index of the feature's tile in `tiles`
+      count -- vehicles of the feature
+      lon, lat -- centroid of the feature
+      cls -- index of the feature's class in DETECTION_CLASSES
+      `tiles` is an int64 (N, 3) array of z, x, y.
+  """
+  def __init__(self, tiles, tile, count, lon, lat, cls):
+    self.tiles = tiles
+    self.tile = tile
+    self.count = count
+    self.lon = lon
+    self.lat = lat
+    self.cls = cls
+
+  @classmethod
+  def fromAnalysis(cls, tiles, detectionsAnalysis):
+    """ Builds the table from the features of every tile.
+        tiles is a TileSet or a list of Tile objects or [z, x, y] lists.
+        detectionsAnalysis maps str(Tile) to the features of its
+        detections.geojson; tiles not in it have no detections.
+    """
+    if hasattr(tiles, 'coords'):
+      coords = tiles.coords.astype(np.int64)
+    else:
+      coords = np.array([[int(v) for v in (t if type(t) == list else
+                                           t.aslist())]
+                         for t in tiles], dtype=np.int64).reshape(-1, 3)
+    tileIndex, counts, lons, lats, classes = [], [], [], [], []
+    for index, (z, x, y) in enumerate(coords.tolist()):
+      key = '%d_%d_%d' % (z, x, y)
+      for feature in detectionsAnalysis.get(key) or ():
+        if 'properties' not in feature:
+          raise SpaceKnowError('Invalid Resource for tile %s' % key, 500)
+        properties = feature['properties']
+        lon, lat = _centroid(feature.get('geometry'))
+        name = properties.get('class', 'cars')
+        tileIndex.append(index)
+        counts.append(properties.get('count', 0))
+        lons.append(lon)
+        lats.append(lat)
+        classes.append(DETECTION_CLASSES.index(name)
+                       if name in DETECTION_CLASSES else
+                       len(DETECTION_CLASSES) - 1)
+    return cls(coords,
+               np.array(tileIndex, dtype=np.int32),
+               np.array(counts, dtype=np.int32),
+               np.array(lons, dtype=np.float64),
+               np.array(lats, dtype=np.float64),
+               np.array(classes, dtype=np.int8))
+
+  @classmethod
+  def concatenate(cls, tiles, tables):
+    """ Table of the detections of several tables (e.g. the shards of a
+        map) over `tiles`, a TileSet holding the tiles of every table
+    """
+    columns = ([], [], [], [], [])
+    for table in tables:
+      if len(table) == 0:
+        continue
+      index = tiles.lookup(table.tiles[:, 0], table.tiles[:, 1],
+                           table.tiles[:, 2])
+      for column, values in zip(columns, (index[table.tile], table.count,
+                                          table.lon, table.lat, table.cls)):
+        column.append(values)
+    dtypes = (np.int32, np.int32, np.float64, np.float64, np.int8)
+    return cls(tiles.coords.astype(np.int64),
+               *[np.concatenate(column).astype(dtype) if column else
+                 np.zeros(0, dtype=dtype)
+                 for column, dtype in zip(columns, dtypes)])
+
+  @classmethod
+  def fromdict(cls, columns):
+    """ Table of the plain lists returned by asdict()
+    """
+    return cls(np.array(columns['tiles'], dtype=np.int64).reshape(-1, 3),
+               np.array(columns['tile'], dtype=np.int32),
+               np.array(columns['count'], dtype=np.int32),
+               np.array(columns['lon'], dtype=np.float64),
+               np.array(columns['lat'], dtype=np.float64),
+               np.array(columns['cls'], dtype=np.int8))
+
+  def asdict(self):
+    """ Columns as plain lists, e.g. to send the table as JSON. Missing
+        centroids are None.
+    """
+    lon, lat = (np.where(np.isnan(values), None, values).tolist()
+                for values in (self.lon, self.lat))
+    return {'tiles': self.tiles.tolist(), 'tile': self.tile.tolist(),
+            'count': self.count.tolist(), 'lon': lon, 'lat': lat,
+            'cls': self.cls.tolist()}
+
+  def __len__(self):
+    return len(self.count)
+
+  @property
+  def total(self):
+    return int(self.count.sum())
+
+  def tileCounts(self):
+    """ Vehicles of every tile, in the order of `tiles`
+    """
+    return np.bincount(self.tile, weights=self.count,
+                       minlength=len(self.tiles)).astype(np.int64)
+
+  def tileClassCounts(self):
+    """ (tiles, classes) matrix of vehicles
+    """
+    classes = len(DETECTION_CLASSES)
+    flat = np.bincount(self.tile.astype(np.int64) * classes + self.cls,
+                       weights=self.count,
+                       minlength=len(self.tiles) * classes)
+    return flat.reshape(len(self.tiles), classes).astype(np.int64)
+
+  def classCounts(self):
+    totals = np.bincount(self.cls, weights=self.count,
+                         minlength=len(DETECTION_CLASSES)).astype(np.int64)
+    return dict(zip(DETECTION_CLASSES, totals.tolist()))
+
+  def tilesWithDetections(self):
+    """ Indexes of the tiles with at least one vehicle
+    """
+    return np.flatnonzero(self.tileCounts() > 0)
+
+  def densityGrid(self, detectionClass=None):
+    """ Vehicles per tile laid out on the (y, x) grid of the map, the first
+        cell is the tile with the smallest x and y.
+    """
+    if len(self.tiles) == 0:
+      return np.zeros((0, 0), dtype=np.int64)
+    if detectionClass is None:
+      counts = self.tileCounts()
+    else:
+      counts = self.tileClassCounts()[:, DETECTION_CLASSES.index(detectionClass)]
+    xs, ys = self.tiles[:, 1], self.tiles[:, 2]
+    grid = np.zeros((ys.max() - ys.min() + 1, xs.max() - xs.min() + 1),
+                    dtype=np.int64)
+    np.add.at(grid, (ys - ys.min(), xs - xs.min()), counts)
+    return grid
+
+
+def summarise(tables):
+  """ Totals of several maps as a structured array with one row per map:
+      mapId, total and one column per detection class.
+  """
+  dtype = [('mapId', object), ('total', np.int64)] + \
+    [(name, np.int64) for name in DETECTION_CLASSES]
+  summary = np.zeros(len(tables), dtype=dtype)
+  for row, (mapId, table) in enumerate(tables.items()):
+    summary[row]['mapId'] = mapId
+    summary[row]['total'] = table.total
+    for name, count in table.classCounts().items():
+      summary[row][name] = count
+  return summary
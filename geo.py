@@ -0,0 +1,161 @@
+import numpy as np
+
+
+def polygons(geometry):
+  """ Returns the polygons of a GeoJSON object as lists of rings, every ring
+      an (N, 2) array of lon, lat. Supports Polygon, MultiPolygon,
+      GeometryCollection, Feature and FeatureCollection.
+  """
+  kind = geometry.get('type')
+  if kind == 'Polygon':
+    return [[np.asarray(ring, dtype=np.float64)[:, :2]
+             for ring in geometry['coordinates']]]
+  if kind == 'MultiPolygon':
+    return [[np.asarray(ring, dtype=np.float64)[:, :2] for ring in polygon]
+            for polygon in geometry['coordinates']]
+  if kind == 'GeometryCollection':
+    return [polygon for child in geometry['geometries']
+            for polygon in polygons(child)]
+  if kind == 'Feature':
+    return polygons(geometry['geometry'])
+  if kind == 'FeatureCollection':
+    return [polygon for feature in geometry['features']
+            for polygon in polygons(feature)]
+  return []
+
+
+def bbox(geometry):
+  """ (west, south, east, north) of the polygons of a GeoJSON object
+  """
+  points = np.concatenate([polygon[0] for polygon in polygons(geometry)])
+  return (points[:, 0].min(), points[:, 1].min(),
+          points[:, 0].max(), points[:, 1].max())
+
+
+def pointsInRings(lon, lat, rings):
+  """ Even-odd test of many points against the rings of one polygon,
+      so holes are excluded
+  """
+  inside = np.zeros(len(lon), dtype=bool)
+  for ring in rings:
+    x1, y1 = ring[:-1, 0], ring[:-1, 1]
+    x2, y2 = ring[1:, 0], ring[1:, 1]
+    for ax, ay, bx, by in zip(x1, y1, x2, y2):
+      crosses = (ay > lat) != (by > lat)
+      if not crosses.any():
+        continue
+      with np.errstate(divide='ignore', invalid='ignore'):
+        xCross = ax + (lat - ay) * (bx - ax) / (by - ay)
+      inside ^= crosses & (lon < xCross)
+  return inside
+
+
+def pointsInGeometry(lon, lat, geometry):
+  """ Boolean mask of the points (arrays of lon, lat) inside the polygons of
+      a GeoJSON object. Points out of the bounding box are rejected before
+      the exact test.
+  """
+  lon = np.asarray(lon, dtype=np.float64)
+  lat = np.asarray(lat, dtype=np.float64)
+  mask = np.zeros(len(lon), dtype=bool)
+  for polygon in polygons(geometry):
+    outer = polygon[0]
+    candidates = np.flatnonzero((lon >= outer[:, 0].min()) &
+                                (lon <= outer[:, 0].max()) &
+                                (lat >= outer[:, 1].min()) &
+                                (lat <= outer[:, 1].max()) & ~mask)
+    if len(candidates):
+      mask[candidates] = pointsInRings(lon[candidates], lat[candidates],
+                                       polygon)
+  return mask
+
+
+def tileBounds(z, x, y):
+  """ (west, south, east, north) arrays of the Web-Mercator footprints of
+      the (arrays of) tiles z, x, y
+  """
+  z, x, y = (np.asarray(v, dtype=np.float64) for v in (z, x, y))
+  n = np.exp2(z)
+  west = x / n * 360.0 - 180.0
+  east = (x + 1) / n * 360.0 - 180.0
+  north = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y / n))))
+  south = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + 1) / n))))
+  return west, south, east, north
+
+
+def lonLatToTile(lon, lat, z):
+  """ (x, y) of the Web-Mercator tiles of zoom z holding the (arrays of)
+      points lon, lat, clipped to the grid
+  """
+  lon = np.asarray(lon, dtype=np.float64)
+  lat = np.clip(np.asarray(lat, dtype=np.float64), -85.0511287798,
+                85.0511287798)
+  n = 2 ** int(z)
+  x = np.floor((lon + 180.0) / 360.0 * n)
+  y = np.floor((1.0 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2.0 * n)
+  return (np.clip(x, 0, n - 1).astype(np.int64),
+          np.clip(y, 0, n - 1).astype(np.int64))
+
+
+def segmentsCrossBoxes(ax, ay, bx, by, west, south, east, north):
+  """ Boolean mask of the boxes crossed by the segment (ax, ay)-(bx, by),
+      clipped against every box at once (Liang-Barsky)
+  """
+  dx, dy = bx - ax, by - ay
+  t0 = np.zeros(len(west))
+  t1 = np.ones(len(west))
+  crossed = np.ones(len(west), dtype=bool)
+  for p, q in ((-dx, ax - west), (dx, east - ax), (-dy, ay - south),
+               (dy, north - ay)):
+    if p == 0:
+      crossed &= q >= 0
+      continue
+    r = q / p
+    if p < 0:
+      t0 = np.maximum(t0, r)
+    else:
+      t1 = np.minimum(t1, r)
+  return crossed & (t0 <= t1)
+
+
+def boxesInGeometry(west, south, east, north, geometry):
+  """ Boolean mask of the boxes (arrays of bounds) which intersect the
+      polygons of a GeoJSON object. Boxes out of the bounding box of a
+      polygon are rejected first; the others intersect it when one of
+      their corners is inside the polygon or one of its edges crosses them.
+  """
+  west, south, east, north = (np.asarray(v, dtype=np.float64)
+                              for v in (west, south, east, north))
+  mask = np.zeros(len(west), dtype=bool)
+  for polygon in polygons(geometry):
+    outer = polygon[0]
+    candidates = np.flatnonzero((east >= outer[:, 0].min()) &
+                                (west <= outer[:, 0].max()) &
+                                (north >= outer[:, 1].min()) &
+                                (south <= outer[:, 1].max()) & ~mask)
+    if len(candidates) == 0:
+      continue
+    w, s, e, n = (west[candidates], south[candidates], east[candidates],
+                  north[candidates])
+    hit = np.zeros(len(candidates), dtype=bool)
+    for lon, lat in ((w, s), (w, n), (e, s), (e, n)):
+      hit |= pointsInRings(lon, lat, polygon)
+    for ring in polygon:
+      for ax, ay, bx, by in zip(ring[:-1, 0], ring[:-1, 1], ring[1:, 0],
+                                ring[1:, 1]):
+        rest = np.flatnonzero(~hit)
+        if len(rest) == 0:
+          break
+        hit[rest] = segmentsCrossBoxes(ax, ay, bx, by, w[rest], s[rest],
+                                       e[rest], n[rest])
+    mask[candidates] = hit
+  return mask
+
+
+def tilesInGeometry(coords, geometry):
+  """ Boolean mask of the tiles of an (N, 3) array of z, x, y whose
+      footprint intersects the polygons of a GeoJSON object
+  """
+  coords = np.asarray(coords).reshape(-1, 3)
+  return boxesInGeometry(*tileBounds(coords[:, 0], coords[:, 1], coords[:, 2]),
+                         geometry)
@@ -1,17 +1,28 @@
 import concurrent.futures
 import json
+import numpy as np
 import os
-import requests
-import utils
 
 from concurrent.futures import ThreadPoolExecutor
-from io import BytesIO
+from config import getConfig
+from detections import DetectionTable, summarise
+from geo import tilesInGeometry
+from manifest import getManifest
+from metrics import getMetrics, logSampled
+from mosaic import Mosaic
 from os import path
-from PIL import Image
 from pipeline import Pipeline
-from queue import Queue
-from threading import Thread
-from utils import SpaceKnowError, process, buildURL, spaceKnowLogger
+from results import getResults, toTimestamp
+from runstore import RunStore
+from spatialindex import DetectionIndex
+from threading import Lock
+from tilecache import getTileCache
+from tiledecode import getTileDecoder
+from tileset import asTile, Tile, TileSet
+from transport import getTransport
+from utils import SpaceKnowError, buildURL, spaceKnowLogger
+from workers import getProcessPool, parseDetections, PROCESS_WORKERS, \
+  SHARD_TILES
 
 KRAKEN_MAPS = {'imagery': ['truecolor.png', 
                            'imagery.ski',
@@ -28,6 +39,35 @@ KRAKEN_MAPS = {'imagery': ['truecolor.png',
 
 KRAKEN_OPERATIONS = ['CAR_DETECTION', 'BUILD_PNG', 'BUILD_CARS_PNG']
 
+# map type and tile resource read by every operation
+OPERATION_RESOURCES = {'CAR_DETECTION': ('cars', 'detections.geojson'),
+                       'BUILD_CARS_PNG': ('cars', 'cars.png'),
+                       'BUILD_PNG': ('imagery', 'truecolor.png')}
+
+MAP_WORKERS = getConfig().mapWorkers
+TILE_WORKERS = getConfig().tileWorkers
+# imagery tiles kept around the tiles with cars, negative to keep them all
+IMAGERY_MARGIN = getConfig().imageryMargin
+# drop the tiles of a released map whose footprint is out of the area
+PRUNE_TILES = getConfig().pruneTiles
+# resource downloaded for every tile of a map type
+MAP_RESOURCES = {'cars': 'detections.geojson', 'imagery': 'truecolor.png'}
+
+_tilePool = None
+_tilePoolLock = Lock()
+
+def getTilePool():
+  """ Returns the executor shared by every KrakenObject to fetch tiles.
+      Its size (SK_TILE_WORKERS) is the global cap of concurrent tile
+      requests, whatever the number of maps processed at the same time.
+  """
+  global _tilePool
+  with _tilePoolLock:
+    if _tilePool is None:
+      _tilePool = ThreadPoolExecutor(max_workers=TILE_WORKERS,
+                                     thread_name_prefix='Tile')
+    return _tilePool
+
 
 def validateMap(mapType):
   if mapType not in KRAKEN_MAPS:
@@ -42,196 +82,687 @@ def validateOperations(operation):
   if operation not in KRAKEN_OPERATIONS:
     raise SpaceKnowError('Unknown operation', 404)
 
-def downloadMaps(mapType, scenes, token, extent):
+def iterMaps(mapType, scenes, token, extent):
+  """ Releases the maps of the scenes and yields every map as soon as its
+      pipeline resolves
+  """
   validateMap(mapType)
-  maps = []
   spaceKnowLogger.info('Downloading maps for %s from KRAKEN API...' % mapType)
-  with ThreadPoolExecutor(max_workers=4) as downloader:
-    future = [downloader.submit(downloadMap, mapType, scene['sceneId'], extent, token) 
-                for scene in scenes]
-    for future in concurrent.futures.as_completed(future):
+  with ThreadPoolExecutor(max_workers=MAP_WORKERS) as downloader:
+    future = {downloader.submit(downloadMap, mapType, scene['sceneId'], extent, token):
+                scene for scene in scenes}
+    for done in concurrent.futures.as_completed(future):
       try:
-        imageryMap = future.result()
-        maps.append(imageryMap)
+        imageryMap = done.result()
+        if imageryMap:
+          yield describeScene(imageryMap, future[done])
       except SpaceKnowError as e:
         spaceKnowLogger.error("Error %d during imagery map download: %s" % 
                                     (e.status_code, e.error))
       except Exception as e:
         spaceKnowLogger.error("Unknown error during imagery map download: %s"% e)
-  
-  return maps
 
-def downloadMap(mapType, scene, extent, token):
-  url = buildURL(utils.SK_KRAKEN_API, 'release', mapType, 'geojson')
+def downloadMaps(mapType, scenes, token, extent):
+  return list(iterMaps(mapType, scenes, token, extent))
+
+def createEvaluationRequest(scenes, extent, mapTypes=('cars',)):
+  """ Body of a kraken/dry-run over the scenes
+  """
+  scenesID = [{'sceneId': s['sceneId']} for s in scenes]
+  dryRunObj = {'scenes': scenesID,
+               'mapTypes': list(mapTypes)}
+  dryRunsList = [dryRunObj]
+  evRequest = {'dryRuns': dryRunsList,
+             'extent': extent}
+  return json.dumps(evRequest)
+
+def describeScene(jsonMap, scene):
+  """ Copies the scene's identifier and acquisition time into its map
+  """
+  jsonMap['sceneId'] = scene['sceneId']
+  jsonMap['datetime'] = scene.get('datetime')
+  return jsonMap
+
+def sceneTimestamp(jsonMap):
+  """ Acquisition time of the map's scene in seconds, 0 when unknown; a
+      datetime without timezone is UTC (see results.toTimestamp)
+  """
+  try:
+    return toTimestamp(jsonMap.get('datetime') or None, 0.0)
+  except ValueError:
+    return 0.0
+
+def pruneTiles(jsonMap, extent, mapType):
+  """ Drops the tiles of a released map whose Web-Mercator footprint does
+      not intersect the polygons of the extent, before any of them is
+      downloaded. The number of tiles dropped is in jsonMap['skippedTiles'].
+  """
+  tiles = jsonMap['tiles']
+  jsonMap['skippedTiles'] = 0
+  if not PRUNE_TILES or len(tiles) == 0:
+    return jsonMap
+  try:
+    inside = tilesInGeometry(tiles.coords, extent)
+  except (AttributeError, KeyError, TypeError, ValueError) as e:
+    spaceKnowLogger.error("Tiles of map %s not filtered by area: %s" %
+                          (jsonMap['mapId'], e))
+    return jsonMap
+  skipped = len(tiles) - int(inside.sum())
+  if skipped:
+    jsonMap['tiles'] = tiles.take(np.flatnonzero(inside))
+    jsonMap['skippedTiles'] = skipped
+    getMetrics().add('sk_tiles_outside_total', skipped, mapType=mapType)
+    spaceKnowLogger.debug("Map %s: %d of %d tiles out of the area" %
+                          (jsonMap['mapId'], skipped, len(tiles)))
+  return jsonMap
+
+def skippedReport(skippedTiles):
+  """ Tiles of a run skipped because out of the area, from the
+      skippedTiles of its maps ({mapType: tiles}), and the bytes they would
+      have cost, estimated with the mean size of the tiles downloaded
+  """
+  metrics = getMetrics()
+  report = {'tiles': 0, 'bytes': 0}
+  for mapType, skipped in skippedTiles.items():
+    resource = MAP_RESOURCES[mapType]
+    fetched = metrics.counter('sk_tiles_total', resource=resource,
+                              source='network')
+    size = metrics.counter('sk_bytes_received_total', kind='tile',
+                           resource=resource)
+    report['tiles'] += skipped
+    report['bytes'] += int(skipped * size / fetched) if fetched else 0
+  return report
+
+def downloadMap(mapType, scene, extent, token, manifest=None):
+  """ Releases the map of a scene over the extent, None when the release
+      failed. manifest, if any, journals the release pipeline instead of
+      the manifest of the run (see Pipeline).
+  """
+  url = buildURL(getConfig().krakenApi, 'release', mapType, 'geojson')
   data = json.dumps({'sceneId': scene,
                      'extent': extent})
   try:
-    pipeline = Pipeline(url, token, data)
+    pipeline = Pipeline(url, token, data, manifest)
     pipeline.start()
     spaceKnowLogger.info('Making Request for scene %s' % scene)
     jsonMap = pipeline.join()
     if not jsonMap or 'mapId' not in jsonMap or 'maxZoom' not in jsonMap or \
       'tiles' not in jsonMap:
       raise SpaceKnowError('Receive invalid map for scene %s' % scene, 500)
-    return jsonMap
+    jsonMap['tiles'] = TileSet.fromList(jsonMap['tiles'])
+    return pruneTiles(jsonMap, extent, mapType)
   except SpaceKnowError as e:
     spaceKnowLogger.error('Error %d: %s' % (e.status_code, e.error))
 
-class Tile():
-  def __init__(self, tile:list):
-    self.z = str(tile[0])
-    self.x = str(tile[1])
-    self.y = str(tile[2])
-
-  def __str__(self):
-    return '_'.join([self.z, self.x, self.y])
-  
-  def aslist(self):
-    return [self.z, self.x, self.y]
-
 class KrakenObject():
-  def __init__(self, mapType, geometry_id='-', outputDir='output'):
+  def __init__(self, mapType, geometry_id='-', outputDir='output', cache=None,
+               store=None):
     validateMap(mapType)
     self.mapType = mapType
     self.resources = KRAKEN_MAPS[mapType]
-    self._url = buildURL(utils.SK_KRAKEN_API, 'grid')
-    self._geometryId = '-'
+    self._url = buildURL(getConfig().krakenApi, 'grid')
+    self._geometryId = geometry_id
     self.outputDir = outputDir
+    self.cache = cache if cache is not None else getTileCache()
+    self.store = store
 
-  def download_resource(self, mapId, tile, resource):
+  def resource_url(self, mapId, tile, resource):
+    return '%s/%s/%s/%d/%d/%d/%s' % (self._url, mapId, self._geometryId,
+                                     tile.z, tile.x, tile.y, resource)
+
+  def parse_resource(self, tileUrl, resource, content):
+    """ Decodes the body of a tile resource: a NumPy array of pixels for png
+        files, the list of features for geojson files and a dict for json
+        files.
+    """
+    if resource.endswith('.png'):
+      return getTileDecoder().decode(content)
+    with getMetrics().timer('sk_tile_seconds', stage='parse',
+                            resource=resource):
+      jsonFile = json.loads(content)
+    if resource.endswith('.geojson'):
+      if 'features' not in jsonFile:
+        spaceKnowLogger.error("Invalid resource from %s"% tileUrl)
+        return None
+      return jsonFile['features']
+    return jsonFile
+
+  def check_resource(self, resource):
     validateResource(self.mapType, resource)
+    if not resource.endswith(('.png', '.json', '.geojson')):
+      raise SpaceKnowError("Resource not available at the moment", 404)
+
+  def cached_content(self, mapId, tile, resource):
+    """ Looks for the resource in the run store, then in the tile cache
+    """
+    content = None
+    if self.store is not None:
+      content = self.store.take(mapId, tile, resource)
+    if content is None and self.cache:
+      content = self.cache.get(mapId, self._geometryId, tile.z, tile.x, tile.y,
+                               resource)
+    return content
+
+  def cache_content(self, mapId, tile, resource, content, source='fetch'):
+    if self.store is not None and source == 'prefetch':
+      self.store.put(mapId, tile, resource, content)
+    if self.cache:
+      self.cache.put(mapId, self._geometryId, tile.z, tile.x, tile.y,
+                     resource, content)
+
+  def download_resource(self, mapId, tile, resource):
     try:
-      tileUrl = buildURL(self._url, mapId, self._geometryId, 
-                              tile.z, tile.x, tile.y, resource)
-      spaceKnowLogger.info('GET %s' % tileUrl)
-      if resource.endswith('.png'):
-        image = Image.open(requests.get(tileUrl, stream=True).raw)
-        return image
-      elif resource.endswith('.json'):
-        return utils.process(tileUrl, '', isGET=True)
-      elif resource.endswith('.geojson'):
-        jsonFile = utils.process(tileUrl, isGET=True)
-        if 'features' not in jsonFile:
-          spaceKnowLogger.error("Invalid resource from %s"% tileUrl)
-          return None
-        else:
-          return jsonFile['features']
-      elif resource in self.resources :
-        raise SpaceKnowError("Resource not available at the moment", 404)
+      self.check_resource(resource)
+      content = self.download_content(mapId, tile, resource)
+      if content is None:
+        return None
+      return self.parse_resource(self.resource_url(mapId, tile, resource),
+                                 resource, content)
+    except Exception as e:
+      spaceKnowLogger.error("Error downloading resource %s: %s" %(resource, e))
+
+  def download_tile(self, mapId, tile, resource, prefetch=(), prefetchIf=None):
+    """ Downloads a resource of the tile and, in the same tile task, the
+        prefetch resources needed by the next operations of the run. They
+        are only kept in the run store; prefetchIf(result) can restrict
+        them to the tiles whose result is interesting.
+    """
+    result = self.download_resource(mapId, tile, resource)
+    if prefetch and self.store is not None and result is not None and \
+      (prefetchIf is None or prefetchIf(result)):
+      for other in prefetch:
+        if self.store.key(mapId, tile, other) not in self.store:
+          self.download_content(mapId, tile, other, source='prefetch')
+    return result
+
+  def download_content(self, mapId, tile, resource, source='fetch'):
+    """ Raw bytes of a resource from the caches or SpaceKnow, None on error;
+        only the resources fetched with source 'prefetch' are kept in the
+        run store
+    """
+    try:
+      metrics = getMetrics()
+      content = self.cached_content(mapId, tile, resource)
+      if content is None:
+        tileUrl = self.resource_url(mapId, tile, resource)
+        logSampled('GET %s', tileUrl)
+        with metrics.timer('sk_tile_seconds', stage='fetch',
+                           resource=resource):
+          response = getTransport().get(tileUrl)
+          content = response.content
+        if response.status_code >= 400:
+          raise SpaceKnowError("Tile unavailable at %s" % tileUrl,
+                               response.status_code)
+        metrics.add('sk_bytes_received_total', len(content), kind='tile',
+                    resource=resource)
+        metrics.add('sk_tiles_total', resource=resource, source='network')
+        self.cache_content(mapId, tile, resource, content, source)
       else:
-        raise SpaceKnowError("Unknown resource for the object %s"% self.mapType, 404)
+        metrics.add('sk_tiles_total', resource=resource, source='cache')
+      return content
     except Exception as e:
       spaceKnowLogger.error("Error downloading resource %s: %s" %(resource, e))
 
-  
-  def download_tiles(self, mapId, tiles, resource):
-    tilesResource = {}
+  def download_pixels(self, mapId, tile, resource):
+    """ Downloads a png resource and hands it over to the tile decoder.
+        Returns the Future of its pixels, None on error. Without caches,
+        the body is read in a pooled buffer and decoded from there.
+    """
+    try:
+      decoder = getTileDecoder()
+      metrics = getMetrics()
+      content = self.cached_content(mapId, tile, resource)
+      if content is not None:
+        metrics.add('sk_tiles_total', resource=resource, source='cache')
+        return decoder.submit(content)
+      tileUrl = self.resource_url(mapId, tile, resource)
+      logSampled('GET %s', tileUrl)
+      metrics.add('sk_tiles_total', resource=resource, source='network')
+      with metrics.timer('sk_tile_seconds', stage='fetch', resource=resource):
+        response = getTransport().get(tileUrl, stream=True)
+        if response.status_code >= 400:
+          response.close()
+          raise SpaceKnowError("Tile unavailable at %s" % tileUrl,
+                               response.status_code)
+        if self.store is not None or self.cache:
+          content = response.content
+          size = len(content)
+        else:
+          buffer, size = decoder.readBody(response)
+      metrics.add('sk_bytes_received_total', size, kind='tile',
+                  resource=resource)
+      if content is not None:
+        self.cache_content(mapId, tile, resource, content)
+        return decoder.submit(content)
+      return decoder.submitBuffer(buffer, size)
+    except Exception as e:
+      spaceKnowLogger.error("Error downloading resource %s: %s" %(resource, e))
+
+  def fetch_tiles(self, mapId, tiles, resource, prefetch=(), prefetchIf=None):
+    """ Downloads the resource of every tile on the shared tile pool.
+        Returns a list in the same order of tiles, a tile which can not be
+        downloaded is None and does not stop the others.
+    """
+    futures = []
     for tile in tiles:
-      try:
+      if type(tile) == list:
         if len(tile) != 3:
-          spaceKnowLogger.error('Invalid tile for map %s' % mapId, 400)
-        else:
-          t = Tile(tile)
-          tileRes = self.download_resource(mapId, t, resource)
-          tilesResource[str(t)] = tileRes
-      except SpaceKnowError:
-        spaceKnowLogger.error("Error downloading resource %s for mapId %s" %
-                              (resource, mapId))
+          spaceKnowLogger.error('Invalid tile %s for map %s' % (tile, mapId))
+          futures.append(None)
+          continue
+        tile = Tile(tile)
+      futures.append(getTilePool().submit(self.download_tile, mapId, tile,
+                                          resource, prefetch, prefetchIf))
+    results = []
+    for future in futures:
+      try:
+        results.append(future.result() if future else None)
+      except Exception as e:
+        spaceKnowLogger.error("Error downloading resource %s for mapId %s: %s" %
+                              (resource, mapId, e))
+        results.append(None)
+    return results
+
+  def fetch_contents(self, mapId, coords, resource):
+    """ Raw bytes of the resource of every tile of an (N, 3) array, fetched
+        on the shared tile pool; None for the tiles which failed
+    """
+    futures = [getTilePool().submit(self.download_content, mapId, Tile(row),
+                                    resource) for row in coords.tolist()]
+    return [future.result() for future in futures]
+
+  def download_tiles(self, mapId, tiles, resource, prefetch=(), prefetchIf=None):
+    tilesResource = {}
+    results = self.fetch_tiles(mapId, tiles, resource, prefetch, prefetchIf)
+    for tile, tileRes in zip(tiles, results):
+      if tileRes is not None:
+        t = Tile(tile) if type(tile) == list else tile
+        tilesResource[str(t)] = tileRes
     return tilesResource
   
-  def build_png(self, mapId, tiles, resource, outputFile):
-    tiledMapPath = path.join(self.outputDir)
-    images = []
-    if not path.exists(tiledMapPath):
-      os.mkdir(tiledMapPath)
-    
-    images = []
+  def iter_tiles(self, mapId, tiles, resource, window=None):
+    """ Yields (tile, result) as soon as each tile is downloaded, keeping at
+        most `window` downloads in flight so results never pile up.
+        Results of png resources are NumPy arrays decoded by the shared
+        TileDecoder while the next tiles are downloading.
+    """
+    window = window or 2 * TILE_WORKERS
+    task = self.download_pixels if resource.endswith('.png') else \
+      self.download_resource
+    pending = set()
+
+    def result(future):
+      value = future.result()
+      if isinstance(value, concurrent.futures.Future):
+        try:
+          return value.result()
+        except Exception as e:
+          spaceKnowLogger.error("Error decoding resource %s of tile %s: %s" %
+                                (resource, future.tile, e))
+          return None
+      return value
+
     for tile in tiles:
       if type(tile) == list:
+        if len(tile) != 3:
+          spaceKnowLogger.error('Invalid tile %s for map %s' % (tile, mapId))
+          continue
         tile = Tile(tile)
-      image = self.download_resource(mapId, tile, resource)
-      images.append(image)
-    
-    utils.stitchImages(images, filename=path.join(tiledMapPath, 
-                                                    outputFile))
+      future = getTilePool().submit(task, mapId, tile, resource)
+      future.tile = tile
+      pending.add(future)
+      if len(pending) >= window:
+        done, pending = concurrent.futures.wait(
+          pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+          yield future.tile, result(future)
+    for future in concurrent.futures.as_completed(pending):
+      yield future.tile, result(future)
+
+  def build_png(self, mapId, tiles, resource, outputFile):
+    """ Assembles the resource of every tile at its grid position and saves
+        it in outputDir/outputFile. Missing tiles are left white.
+    """
+    tiledMapPath = path.join(self.outputDir)
+    os.makedirs(tiledMapPath, exist_ok=True)
+    if len(tiles) == 0:
+      spaceKnowLogger.error('No tiles available for %s' % outputFile)
+      return
+    mosaic = Mosaic(tiles)
+    try:
+      decoder = getTileDecoder()
+      with getMetrics().timer('sk_map_seconds', stage='build_png',
+                              resource=resource):
+        for tile, pixels in self.iter_tiles(mapId, tiles, resource):
+          mosaic.paste(tile, pixels)
+          decoder.recycle(pixels)
+        mosaic.save(path.join(tiledMapPath, outputFile))
+    finally:
+      mosaic.close()
+
+
+def hasDetections(features):
+  return any(feature.get('properties', {}).get('count', 0) > 0
+             for feature in features)
 
 
 class CarsObject(KrakenObject):
-  def __init__(self, mapType='cars'):
-    super().__init__(mapType)
+  """ Car detection over the tiles of a map.
+
+      With `processes` > 0 (SK_PROCESS_WORKERS) the detections are parsed
+      by worker processes, out of the GIL: the tile pool downloads the
+      bodies of a shard of SK_SHARD_TILES tiles while the processes parse
+      the previous shards, which come back as DetectionTables.
+  """
+  def __init__(self, mapType='cars', store=None, processes=None):
+    super().__init__(mapType, store=store)
+    self.detections = None
+    self.processes = PROCESS_WORKERS if processes is None else processes
   
-  def detectCars(self, mapId, tiles):
+  def detectCars(self, mapId, tiles, prefetch=()):
     """ Check if there is a group of Cars inside a Map
       
       Arguments:
       - mapId: identifier of imagery got from KRAKEN API Imagery
       - tiles: list of tile inside the imagery
+      - prefetch: other resources to download, in the same pass, for the
+        tiles with at least one detection
 
       Returns:
       - tiles_with_cars: list of tiles where there is AT LEAST 1 Car
       - countedCars: number of cars inside mapId
+      The DetectionTable of the map is kept in self.detections.
     """
-    countedCars = 0
-    tiles_with_cars = []
-    detectionsAnalysis = self.download_tiles(mapId, tiles, resource='detections.geojson')
-    
-    for tile in tiles:
-      t = Tile(tile)
-      count = 0
-      if str(t) not in detectionsAnalysis:
-        continue
-      else:
-        jsonAnalysis = detectionsAnalysis[str(t)]
-        for jsonObj in jsonAnalysis:
-          if 'properties' not in jsonObj:
-            raise SpaceKnowError('Invalid Resource for tile %s'% str(t), 500)
-          else:
-            count+= jsonObj['properties']['count']
-      if count > 0:
-        tiles_with_cars.append(t)
-        countedCars += count
+    with getMetrics().timer('sk_map_seconds', stage='detect'):
+      self.detections = self.analyseDetections(mapId, tiles, prefetch)
+    return self.detections.total, \
+      TileSet(self.detections.tiles[self.detections.tilesWithDetections()])
+
+  def download_tile(self, mapId, tile, resource, prefetch=(), prefetchIf=None):
+    result = super().download_tile(mapId, tile, resource, prefetch, prefetchIf)
+    manifest = getManifest()
+    if manifest and result is not None and resource == 'detections.geojson':
+      manifest.addTile(mapId, str(tile), result)
+    return result
+
+  def analyseDetections(self, mapId, tiles, prefetch=()):
+    """ Downloads detections.geojson of every tile and returns its columnar
+        DetectionTable. Tiles already processed by a previous run, according
+        to the run manifest, are not downloaded again.
+    """
+    manifest = getManifest()
+    processed = manifest.tiles(mapId) if manifest else {}
+    missing = [tile for tile in tiles if str(asTile(tile)) not in processed] \
+      if processed else tiles
+    if processed:
+      spaceKnowLogger.info("Map %s: %d tiles already processed" %
+                           (mapId, len(tiles) - len(missing)))
+    if self.processes > 0:
+      return self.analyse_shards(mapId, tiles, missing, processed, prefetch)
+    detectionsAnalysis = self.download_tiles(mapId, missing,
+                                             resource='detections.geojson',
+                                             prefetch=prefetch,
+                                             prefetchIf=hasDetections)
+    if manifest:
+      manifest.flush()
+    detectionsAnalysis.update(processed)
+    with getMetrics().timer('sk_map_seconds', stage='aggregate'):
+      return DetectionTable.fromAnalysis(tiles, detectionsAnalysis)
+
+
+  def analyse_shards(self, mapId, tiles, missing, processed, prefetch=()):
+    """ analyseDetections on the worker processes, shard by shard. At most
+        2 shards per process are waiting to be parsed. The prefetch
+        resources of the tiles with vehicles are fetched on the tile pool
+        as soon as their shard is parsed.
+    """
+    tiles = TileSet.fromList(tiles)
+    manifest = getManifest()
+    pool = getProcessPool(self.processes)
+    metrics = getMetrics()
+    tables = [DetectionTable.fromAnalysis(tiles, processed)] if processed \
+      else []
+    prefetches = []
+    if self.store is None:
+      prefetch = ()
+
+    def collect(futures):
+      for future in futures:
+        bodies = pending.pop(future)
+        try:
+          result = future.result()
+        except Exception as e:
+          spaceKnowLogger.error("Error parsing a shard of map %s: %s" %
+                                (mapId, e))
+          continue
+        metrics.observe('sk_shard_seconds', result['seconds'],
+                        stage='parse', resource='detections.geojson')
+        for key in result['invalid']:
+          spaceKnowLogger.error("Invalid resource detections.geojson for "
+                                "tile %s of map %s" % (key, mapId))
+        table = result['table']
+        tables.append(table)
+        if manifest:
+          invalid = set(result['invalid'])
+          manifest.addTiles(mapId, [
+            (key, count, body.decode('utf-8')) for key, count, body in
+            zip((str(Tile(row)) for row in table.tiles.tolist()),
+                table.tileCounts().tolist(), bodies)
+            if body is not None and key not in invalid])
+        for row in table.tiles[table.tilesWithDetections()].tolist():
+          for other in prefetch:
+            if self.store.key(mapId, Tile(row), other) not in self.store:
+              prefetches.append(getTilePool().submit(
+                self.download_content, mapId, Tile(row), other, 'prefetch'))
+
+    pending = {}
+    for shard in TileSet.fromList(missing).batches(SHARD_TILES):
+      bodies = self.fetch_contents(mapId, shard, 'detections.geojson')
+      pending[pool.submit(parseDetections, shard, bodies)] = bodies
+      if len(pending) >= 2 * self.processes:
+        done, _ = concurrent.futures.wait(
+          pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        collect(done)
+    collect(concurrent.futures.as_completed(list(pending)))
+    concurrent.futures.wait(prefetches)
+    with metrics.timer('sk_map_seconds', stage='aggregate'):
+      return DetectionTable.concatenate(tiles, tables)
+
 
-    return countedCars, tiles_with_cars
+def countCars(tiles, detectionsAnalysis):
+  """ Sums the detections of every tile.
+      detectionsAnalysis maps str(Tile) to the features of its
+      detections.geojson; tiles not in it are skipped.
+  """
+  detections = DetectionTable.fromAnalysis(tiles, detectionsAnalysis)
+  return detections.total, \
+    TileSet(detections.tiles[detections.tilesWithDetections()])
+
+
+def storeResults(jsonMap, detections, logger=spaceKnowLogger):
+  """ Writes the DetectionTable of a map in the result store, if any. A
+      failed write is logged: the counts of the run do not depend on it.
+  """
+  results = getResults()
+  if results is None:
+    return
+  try:
+    with getMetrics().timer('sk_map_seconds', stage='store'):
+      results.addMap(jsonMap, detections)
+  except Exception as e:
+    logger.error("Results of map %s not stored: %s" % (jsonMap['mapId'], e))
 
 
 class KrakenManager():
-  def __init__(self, logger=spaceKnowLogger):
+  """ Runs Kraken operations over maps.
+
+      Arguments:
+      logger -- logger of the operations
+      operations -- operations planned for the run: while walking the tiles
+                    of a map for one operation, the resources of the other
+                    planned operations on the same map type are fetched too
+      store -- RunStore shared by every object created by the manager
+      processes -- worker processes parsing the detections, 0 to parse
+                   them on the tile threads (SK_PROCESS_WORKERS)
+      margin -- BUILD_PNG of an imagery map released along a cars map only
+                fetches the tiles within `margin` tiles of the tiles with
+                cars (SK_IMAGERY_MARGIN); negative for every tile
+      outputDir -- folder of the PNG files
+      The detections of every map are also added to a DetectionIndex
+      (self.index) which merges vehicles seen by overlapping scenes, and
+      written in the result store of the process (see results.py).
+  """
+  def __init__(self, logger=spaceKnowLogger, operations=(), store=None,
+               processes=None, margin=None, outputDir='output'):
     self.logger = logger
+    self.outputDir = outputDir
+    self.processes = PROCESS_WORKERS if processes is None else processes
+    self.margin = IMAGERY_MARGIN if margin is None else margin
+    self.built = []
+    self.operations = list(operations)
+    for operation in self.operations:
+      validateOperations(operation)
+    self.store = store if store is not None else RunStore()
+    self.detections = {}
+    self.index = DetectionIndex()
+    self.failedMaps = []
+
+  def prefetch_for(self, operation):
+    mapType, resource = OPERATION_RESOURCES[operation]
+    return [other for op, (otherType, other) in OPERATION_RESOURCES.items()
+            if op in self.operations and otherType == mapType and
+            other != resource]
+
+  def imagery_for(self, jsonMap, carTiles=None):
+    """ Imagery map of a run_map input and the tiles to build.
+        That is the input itself, unless it is a map released with an
+        imagery map alongside (see CreditScheduler.iterRelease). Then the
+        imagery map is taken, restricted to the tiles within self.margin
+        of carTiles. Returns (None, None) when the imagery is not
+        available.
+    """
+    future = jsonMap.get('alongside', {}).get('imagery')
+    if future is None:
+      return jsonMap, jsonMap['tiles']
+    try:
+      imageryMap = future.result()
+    except Exception as e:
+      self.logger.error("Error during imagery release of scene %s: %s" %
+                        (jsonMap.get('sceneId'), e))
+      imageryMap = None
+    if not imageryMap:
+      return None, None
+    tiles = imageryMap['tiles']
+    if self.margin >= 0 and carTiles is not None:
+      tiles = tiles.take(np.flatnonzero(tiles.around(carTiles, self.margin)))
+      getMetrics().add('sk_tiles_pruned_total',
+                       len(imageryMap['tiles']) - len(tiles),
+                       resource='truecolor.png')
+    return imageryMap, tiles
+
+  def run_map(self, imagery, operations):
+    """ Runs the operations on one map, in the order CAR_DETECTION,
+        BUILD_CARS_PNG (only the tiles with cars), BUILD_PNG (see
+        imagery_for: a cars map builds the PNG of its imagery map).
+        Returns (mapId, cars, tiles): cars is None without CAR_DETECTION,
+        tiles are the tiles with cars after CAR_DETECTION.
+    """
+    mapId, tiles, cars = imagery['mapId'], imagery['tiles'], None
+    if 'CAR_DETECTION' in operations:
+      self.logger.info("Detecting cars for map %s"% mapId)
+      carsDetector = CarsObject(store=self.store, processes=self.processes)
+      cars, tiles = carsDetector.detectCars(
+        mapId, imagery['tiles'], prefetch=self.prefetch_for('CAR_DETECTION'))
+      self.detections[mapId] = carsDetector.detections
+      self.index.add(carsDetector.detections, sceneTimestamp(imagery), mapId)
+      storeResults(imagery, carsDetector.detections, self.logger)
+    if 'BUILD_CARS_PNG' in operations and (cars is None or cars > 0):
+      self.build_image(mapId, tiles, 'BUILD_CARS_PNG')
+    if 'BUILD_PNG' in operations:
+      imageryMap, imageryTiles = self.imagery_for(
+        imagery, tiles if cars is not None else None)
+      if imageryMap and len(imageryTiles) > 0:
+        self.build_image(imageryMap['mapId'], imageryTiles, 'BUILD_PNG')
+    return mapId, cars, tiles
+
+  def stream(self, maps, operations, callback=None, workers=None):
+    """ Runs the operations on every map as soon as it is available and
+        yields (mapId, cars, tiles) as soon as each map is done.
+
+        maps can be any iterable, e.g. the generator of kraken.iterMaps, so
+        a map is processed while the other releases are still resolving.
+        At most `workers` maps (SK_MAP_WORKERS) are processed at the same
+        time: the next map is taken from `maps` only when one of them is
+        done, which keeps the memory of the run bounded. callback, if any,
+        is called with every result before it is yielded. A map whose
+        operations raise is logged, kept in self.failedMaps and left out.
+    """
+    for operation in operations:
+      validateOperations(operation)
+    workers = workers or MAP_WORKERS
+    with ThreadPoolExecutor(max_workers=workers,
+                            thread_name_prefix='Map') as pool:
+      pending = {}
+      for imagery in maps:
+        pending[pool.submit(self.run_map, imagery, operations)] = \
+          imagery.get('mapId')
+        if len(pending) < workers:
+          continue
+        done, _ = concurrent.futures.wait(
+          pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        yield from self._results(done, pending, callback)
+      yield from self._results(concurrent.futures.as_completed(list(pending)),
+                               pending, callback)
+
+  def _results(self, done, pending, callback):
+    """ Results of the done futures of run_map, taken out of pending
+        ({future: mapId}); the failed maps are logged and left out
+    """
+    for future in done:
+      mapId = pending.pop(future)
+      try:
+        result = future.result()
+      except Exception as e:
+        self.logger.error("Error processing mapId %s: %s" % (mapId, e))
+        self.failedMaps.append(mapId)
+        continue
+      if callback:
+        callback(*result)
+      yield result
 
   def process(self, maps, operation):
     validateOperations(operation)
     result = {}
-    if operation == 'CAR_DETECTION':
-      for imagery in maps:
-        self.logger.info("Detecting cars for map %s"% imagery['mapId'] )
-        carsDetector = CarsObject()
-        counted_cars, tiles = carsDetector.detectCars(imagery['mapId'], 
-                                                      imagery['tiles'])
-        if counted_cars > 0:
-          result[imagery['mapId']] = (counted_cars, tiles)
-    elif operation == 'BUILD_CARS_PNG':
-      for imagery in maps:
-        self.logger.info("Creating PNG file for %s"% imagery['mapId'])
-        imageGenerator = KrakenObject(mapType='cars')
-        imageGenerator.build_png(imagery['mapId'], imagery['tiles'], 'cars.png',
-                              imagery['mapId'][-10:]+'_detection.png')
-    elif operation == 'BUILD_PNG':
-      for imagery in maps:
-        self.logger.info("Creating PNG file for %s"% imagery['mapId'])
-        imageGenerator = KrakenObject(mapType='imagery')
-        imageGenerator.build_png(imagery['mapId'], imagery['tiles'], 'truecolor.png',
-                              imagery['mapId'][-10:]+'_imagery.png')
+    for mapId, counted_cars, tiles in self.stream(maps, [operation]):
+      if counted_cars:
+        result[mapId] = (counted_cars, tiles)
     return result
   
+  def summary(self):
+    """ Totals per map and per class of every map processed by
+        CAR_DETECTION, as a structured array (see detections.summarise)
+    """
+    return summarise(self.detections)
+
   def build_image(self, mapId, tiles, operation):
     validateOperations(operation)
+    manifest = getManifest()
+    stage = '%s/%s' % (operation, mapId)
+    self.built.append((operation, mapId))
+    if manifest and manifest.done(stage):
+      self.logger.info("PNG file for %s already built" % mapId[-10:])
+      return
     if operation == 'BUILD_CARS_PNG':
       self.logger.info("Creating PNG file for %s"% mapId[-10:])
-      imageGenerator = KrakenObject(mapType='cars')
+      imageGenerator = KrakenObject(mapType='cars', outputDir=self.outputDir,
+                                    store=self.store)
       imageGenerator.build_png(mapId, tiles, 'cars.png',
                                mapId[-10:]+'_detection.png')
     elif operation == 'BUILD_PNG':
       self.logger.info("Creating PNG file for %s"% mapId[-10:])
-      imageGenerator = KrakenObject(mapType='imagery')
+      imageGenerator = KrakenObject(mapType='imagery',
+                                    outputDir=self.outputDir, store=self.store)
       imageGenerator.build_png(mapId, tiles, 'truecolor.png',
-                            mapId[-10:]+'_imagery.png')
\ No newline at end of file
+                            mapId[-10:]+'_imagery.png')
+    if manifest:
+      manifest.complete(stage)
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import sqlite3
+import threading
+
+from config import getConfig
+from utils import spaceKnowLogger
+
+# tiles journaled by addTile before their rows are committed
+TILE_BATCH = 256
+
+
+class Manifest():
+  """ SQLite journal of the work done by a run, so a run which crashed or
+      exited halfway can be started again without repeating it.
+
+      It records:
+      - pipelines: url and request of every pipeline with its pipelineId,
+        its status (PROCESSING or RESOLVED) and, once RESOLVED, its result.
+        A resolved pipeline is not initiated again (no credits are spent
+        twice); a PROCESSING one is reattached through tasking/get-status.
+      - tiles: detections (its features, or its whole detections.geojson
+        body) and vehicle count of every processed tile of a map, so only
+        the missing tiles are downloaded.
+      - stages: names of the steps completed (e.g. the PNG of a map).
+      Pipelines and stages are committed at once. Tiles are committed
+      TILE_BATCH at a time and at the end of every map (flush): a crash
+      loses at most that many tiles, which are downloaded again.
+  """
+  def __init__(self, filename):
+    self.filename = filename
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(filename, check_same_thread=False)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.execute('PRAGMA synchronous=NORMAL')
+    self._db.executescript('''
+      CREATE TABLE IF NOT EXISTS pipelines (
+        key TEXT PRIMARY KEY, url TEXT, pipelineId TEXT, status TEXT,
+        result TEXT);
+      CREATE TABLE IF NOT EXISTS tiles (
+        mapId TEXT, tile TEXT, count INTEGER, features TEXT,
+        PRIMARY KEY (mapId, tile));
+      CREATE TABLE IF NOT EXISTS stages (name TEXT PRIMARY KEY);
+    ''')
+    self._db.commit()
+    self._tiles = []
+
+  def _execute(self, sql, args=()):
+    with self._lock:
+      self._db.execute(sql, args)
+      self._db.commit()
+
+  def _query(self, sql, args=()):
+    with self._lock:
+      self._flush()
+      return self._db.execute(sql, args).fetchall()
+
+  def _flush(self):
+    if self._tiles:
+      self._db.executemany('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)',
+                           self._tiles)
+      self._db.commit()
+      self._tiles = []
+
+  def flush(self):
+    """ Commits the tiles journaled by addTile
+    """
+    with self._lock:
+      self._flush()
+
+  @staticmethod
+  def key(url, request):
+    return hashlib.sha1(('%s\n%s' % (url, request)).encode('utf-8')).hexdigest()
+
+  def pipeline(self, url, request):
+    """ Returns (pipelineId, status, result) of the pipeline or None
+    """
+    rows = self._query('SELECT pipelineId, status, result FROM pipelines '
+                       'WHERE key = ?', (self.key(url, request),))
+    if not rows:
+      return None
+    pipelineId, status, result = rows[0]
+    return pipelineId, status, json.loads(result) if result else None
+
+  def startPipeline(self, url, request, pipelineId):
+    self._execute('INSERT OR REPLACE INTO pipelines VALUES (?, ?, ?, ?, NULL)',
+                  (self.key(url, request), url, pipelineId, 'PROCESSING'))
+
+  def resolvePipeline(self, url, request, pipelineId, result):
+    self._execute('INSERT OR REPLACE INTO pipelines VALUES (?, ?, ?, ?, ?)',
+                  (self.key(url, request), url, pipelineId, 'RESOLVED',
+                   json.dumps(result)))
+
+  def forgetPipeline(self, url, request):
+    self._execute('DELETE FROM pipelines WHERE key = ?',
+                  (self.key(url, request),))
+
+  def tiles(self, mapId):
+    """ Detections of the processed tiles of a map: {str(Tile): features}
+    """
+    tiles = {}
+    for tile, features in self._query('SELECT tile, features FROM tiles '
+                                      'WHERE mapId = ?', (mapId,)):
+      features = json.loads(features)
+      tiles[tile] = features.get('features', []) \
+        if isinstance(features, dict) else features
+    return tiles
+
+  def addTile(self, mapId, tile, features):
+    count = sum(feature.get('properties', {}).get('count', 0)
+                for feature in features)
+    row = (mapId, tile, count, json.dumps(features))
+    with self._lock:
+      self._tiles.append(row)
+      if len(self._tiles) >= TILE_BATCH:
+        self._flush()
+
+  def addTiles(self, mapId, rows):
+    """ Records several processed tiles in one transaction: rows of
+        (str(Tile), vehicles, features or detections.geojson as JSON)
+    """
+    with self._lock:
+      self._db.executemany('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)',
+                           [(mapId, tile, count, features)
+                            for tile, count, features in rows])
+      self._db.commit()
+
+  def tileCounts(self, mapId):
+    """ Vehicles of every processed tile of a map: {str(Tile): count}
+    """
+    return dict(self._query('SELECT tile, count FROM tiles WHERE mapId = ?',
+                            (mapId,)))
+
+  def done(self, stage):
+    return len(self._query('SELECT 1 FROM stages WHERE name = ?',
+                           (stage,))) > 0
+
+  def complete(self, stage):
+    self._execute('INSERT OR IGNORE INTO stages VALUES (?)', (stage,))
+
+  def stats(self):
+    with self._lock:
+      self._flush()
+      return {'pipelines': self._db.execute(
+                'SELECT COUNT(*) FROM pipelines').fetchone()[0],
+              'tiles': self._db.execute(
+                'SELECT COUNT(*) FROM tiles').fetchone()[0],
+              'stages': self._db.execute(
+                'SELECT COUNT(*) FROM stages').fetchone()[0]}
+
+  def clear(self):
+    """ Forgets the run: called when it completed successfully
+    """
+    with self._lock:
+      self._tiles = []
+      self._db.executescript('DELETE FROM pipelines; DELETE FROM tiles; '
+                             'DELETE FROM stages;')
+      self._db.commit()
+
+  def close(self):
+    with self._lock:
+      self._flush()
+      self._db.close()
+
+
+_manifest = None
+_manifestLock = threading.Lock()
+
+def openManifest(filename=None):
+  """ Opens the manifest of the run (SK_MANIFEST, default manifest.sqlite;
+      empty disables it) and makes it the one used by pipelines and tile
+      downloads. Returns None when disabled.
+  """
+  global _manifest
+  filename = getConfig().manifest if filename is None \
+    else filename
+  with _manifestLock:
+    if _manifest is not None:
+      _manifest.close()
+      _manifest = None
+    if filename:
+      _manifest = Manifest(filename)
+      stats = _manifest.stats()
+      if stats['pipelines'] or stats['tiles']:
+        spaceKnowLogger.info("Resuming from %s: %d pipelines, %d tiles" %
+                             (filename, stats['pipelines'], stats['tiles']))
+    return _manifest
+
+def closeManifest(completed=False):
+  """ Closes the manifest of the run, forgetting it if the run completed
+  """
+  global _manifest
+  with _manifestLock:
+    if _manifest is not None:
+      if completed:
+        _manifest.clear()
+      _manifest.close()
+      _manifest = None
+
+def getManifest():
+  """ Manifest of the current run, None when runs are not journaled
+  """
+  return _manifest
@@ -0,0 +1,335 @@
+import bisect
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from config import getConfig
+from urllib.parse import urlsplit
+
+# upper bounds in seconds of the buckets of every histogram
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+LOG_SAMPLE = getConfig().logSample
+TRACE_SPANS = getConfig().traceSpans
+
+_logger = logging.getLogger('SpaceKnow')
+
+
+class Histogram():
+  """ Cumulative histogram of observations (Prometheus layout): count of
+      every bucket, sum, count and maximum. Quantiles are interpolated
+      inside the buckets.
+  """
+  def __init__(self, buckets=BUCKETS):
+    self.buckets = tuple(buckets)
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.sum = 0.0
+    self.count = 0
+    self.max = 0.0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+    if value > self.max:
+      self.max = value
+
+  def quantile(self, q):
+    if self.count == 0:
+      return 0.0
+    rank = q * self.count
+    seen = 0
+    for index, count in enumerate(self.counts):
+      if count and seen + count >= rank:
+        lower = self.buckets[index - 1] if index > 0 else 0.0
+        upper = self.buckets[index] if index < len(self.buckets) else self.max
+        return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+      seen += count
+    return self.max
+
+  def asdict(self):
+    return {'count': self.count, 'sum': self.sum,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'max': self.max, 'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95), 'p99': self.quantile(0.99)}
+
+
+class Timer():
+  """ Context manager which observes the seconds spent in its block
+  """
+  __slots__ = ('_metrics', '_name', '_labels', '_start')
+
+  def __init__(self, metrics, name, labels):
+    self._metrics = metrics
+    self._name = name
+    self._labels = labels
+
+  def __enter__(self):
+    self._start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    self._metrics.observe(self._name, time.perf_counter() - self._start,
+                          self._start, **self._labels)
+
+
+class Metrics():
+  """ Histograms and counters of a run, labelled like Prometheus series.
+
+      The hot paths call observe/add/timer; the registry is exported at the
+      end of a run as Prometheus text (toPrometheus) or as a JSON summary
+      with mean, max and p50/p95/p99 of every histogram (summary). When a
+      tracer is set, every observation is also handed to it as a span.
+
+      Usage:
+        with getMetrics().timer('sk_tile_seconds', stage='fetch'):
+          ...
+        getMetrics().add('sk_bytes_received_total', len(body), kind='tile')
+  """
+  def __init__(self, buckets=BUCKETS):
+    self.buckets = buckets
+    self.tracer = None
+    self._histograms = {}
+    self._counters = {}
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+  def observe(self, name, seconds, start=None, **labels):
+    """ Adds an observation to the histogram name{labels}
+    """
+    key = self._key(name, labels)
+    with self._lock:
+      histogram = self._histograms.get(key)
+      if histogram is None:
+        histogram = self._histograms[key] = Histogram(self.buckets)
+      histogram.observe(seconds)
+    if self.tracer is not None:
+      self.tracer.span(name, labels, start, seconds)
+
+  def add(self, name, value=1, **labels):
+    """ Increases the counter name{labels}
+    """
+    key = self._key(name, labels)
+    with self._lock:
+      self._counters[key] = self._counters.get(key, 0) + value
+
+  def timer(self, name, **labels):
+    return Timer(self, name, labels)
+
+  def histogram(self, name, **labels):
+    with self._lock:
+      return self._histograms.get(self._key(name, labels))
+
+  def counter(self, name, **labels):
+    with self._lock:
+      return self._counters.get(self._key(name, labels), 0)
+
+  def reset(self):
+    with self._lock:
+      self._histograms = {}
+      self._counters = {}
+
+  @staticmethod
+  def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+      return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('"', '\\"'))
+                             for name, value in pairs)
+
+  def toPrometheus(self):
+    """ Registry in the Prometheus text exposition format
+    """
+    with self._lock:
+      histograms = sorted(self._histograms.items())
+      counters = sorted(self._counters.items())
+    lines, typed = [], set()
+    for (name, labels), histogram in histograms:
+      if name not in typed:
+        lines.append('# TYPE %s histogram' % name)
+        typed.add(name)
+      cumulative = 0
+      for bound, count in zip(self.buckets + ('+Inf',), histogram.counts):
+        cumulative += count
+        lines.append('%s_bucket%s %d' % (name, self._labels(labels,
+                                                            [('le', bound)]),
+                                         cumulative))
+      lines.append('%s_sum%s %.6f' % (name, self._labels(labels),
+                                      histogram.sum))
+      lines.append('%s_count%s %d' % (name, self._labels(labels),
+                                      histogram.count))
+    for (name, labels), value in counters:
+      if name not in typed:
+        lines.append('# TYPE %s counter' % name)
+        typed.add(name)
+      lines.append('%s%s %s' % (name, self._labels(labels), value))
+    return '\n'.join(lines) + '\n'
+
+  def summary(self):
+    """ Registry as a dict: {'histograms': {name: [series]}, 'counters':
+        {name: [series]}}, every series with its labels
+    """
+    with self._lock:
+      histograms = sorted(self._histograms.items())
+      counters = sorted(self._counters.items())
+    result = {'histograms': {}, 'counters': {}}
+    for (name, labels), histogram in histograms:
+      series = dict(histogram.asdict(), labels=dict(labels))
+      result['histograms'].setdefault(name, []).append(series)
+    for (name, labels), value in counters:
+      result['counters'].setdefault(name, []).append(
+        {'labels': dict(labels), 'value': value})
+    return result
+
+  def save(self, filename):
+    """ Writes the registry as Prometheus text (.prom, .txt) or JSON
+    """
+    with open(filename, 'w') as fp:
+      if filename.endswith(('.prom', '.txt')):
+        fp.write(self.toPrometheus())
+      else:
+        json.dump(self.summary(), fp, indent=2)
+
+
+class Tracer():
+  """ Records the timed blocks as spans of the Chrome trace event format
+      (chrome://tracing, Perfetto), one row per thread. At most maxSpans
+      spans are kept.
+  """
+  def __init__(self, maxSpans=TRACE_SPANS):
+    self.maxSpans = maxSpans
+    self.spans = []
+    self.dropped = 0
+    self._origin = time.perf_counter()
+    self._lock = threading.Lock()
+
+  def span(self, name, labels, start, seconds):
+    if start is None:
+      start = time.perf_counter() - seconds
+    span = {'name': labels.get('stage') or labels.get('endpoint') or name,
+            'cat': name, 'ph': 'X', 'pid': os.getpid(),
+            'tid': threading.current_thread().name,
+            'ts': (start - self._origin) * 1e6, 'dur': seconds * 1e6,
+            'args': labels}
+    with self._lock:
+      if len(self.spans) < self.maxSpans:
+        self.spans.append(span)
+      else:
+        self.dropped += 1
+
+  def save(self, filename):
+    with self._lock:
+      spans = list(self.spans)
+    with open(filename, 'w') as fp:
+      json.dump({'traceEvents': spans, 'displayTimeUnit': 'ms'}, fp)
+
+
+class Profiler():
+  """ cProfile of every thread of the run. Threads started after start()
+      get their own profile (threading.setprofile), the calling thread too;
+      the stats are merged by stop().
+  """
+  def __init__(self):
+    self._profiles = []
+    self._lock = threading.Lock()
+
+  def _newProfile(self):
+    import cProfile
+    profile = cProfile.Profile()
+    try:
+      profile.enable()
+    except ValueError:
+      # another profiler is active on the interpreter
+      return
+    with self._lock:
+      self._profiles.append(profile)
+
+  def _threadHook(self, frame, event, arg):
+    # first event of a new thread: its own profile replaces the hook
+    self._newProfile()
+
+  def start(self):
+    threading.setprofile(self._threadHook)
+    self._newProfile()
+
+  def stop(self, filename):
+    """ Writes the merged stats in filename (pstats format)
+    """
+    import pstats
+    threading.setprofile(None)
+    with self._lock:
+      profiles, self._profiles = self._profiles, []
+    for profile in profiles:
+      profile.disable()
+    if not profiles:
+      return None
+    stats = pstats.Stats(profiles[0])
+    for profile in profiles[1:]:
+      stats.add(profile)
+    stats.dump_stats(filename)
+    return stats
+
+
+def endpoint(url):
+  """ Label of a SpaceKnow URL: its path
+  """
+  return urlsplit(url).path or url
+
+
+def logSampled(message, *args, rate=None):
+  """ Logs a per-request message at DEBUG for a `rate` fraction of the calls
+      (SK_LOG_SAMPLE, default 1%), so the log does not cost as much as the
+      requests it describes
+  """
+  rate = LOG_SAMPLE if rate is None else rate
+  if rate > 0 and (rate >= 1 or random.random() < rate) and \
+    _logger.isEnabledFor(logging.DEBUG):
+    _logger.debug(message, *args)
+
+
+_metrics = Metrics()
+_profiler = None
+_tracer = None
+
+def getMetrics():
+  """ Returns the Metrics shared by the whole process
+  """
+  return _metrics
+
+def startInstrumentation():
+  """ Starts the opt-in hooks of a run: cProfile of every thread when
+      SK_PROFILE is set, span tracing when SK_TRACE is set
+  """
+  global _profiler, _tracer
+  config = getConfig()
+  if config.profile and _profiler is None:
+    _profiler = Profiler()
+    _profiler.start()
+  if config.trace and _tracer is None:
+    _tracer = _metrics.tracer = Tracer()
+
+def stopInstrumentation():
+  """ Exports the metrics of the run (SK_METRICS: .prom for Prometheus
+      text, JSON otherwise), the profile (SK_PROFILE) and the trace
+      (SK_TRACE)
+  """
+  global _profiler, _tracer
+  config = getConfig()
+  if config.metrics:
+    _metrics.save(config.metrics)
+    _logger.info("Metrics written in %s" % config.metrics)
+  if _profiler is not None:
+    _profiler.stop(config.profile)
+    _logger.info("Profile written in %s" % config.profile)
+    _profiler = None
+  if _tracer is not None:
+    _tracer.save(config.trace)
+    _logger.info("Trace of %d spans written in %s" %
+                 (len(_tracer.spans), config.trace))
+    _metrics.tracer = _tracer = None
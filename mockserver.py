@@ -0,0 +1,352 @@
+import argparse
+import json
+import math
+import random
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+PERMISSIONS = ['imagery.availability', 'kraken.dry-run', 'kraken.release',
+               'credits.get-remaining-credit', 'imagery.images.gbdx.idaho-pansharpened',
+               'algorithms.car-detection']
+
+
+def encodePNG(width, height, rgba):
+  """ Encodes a solid RGBA image as PNG without any imaging library
+  """
+  def chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + \
+      struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+  row = b'\x00' + bytes(rgba) * width
+  return b'\x89PNG\r\n\x1a\n' + \
+    chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) + \
+    chunk(b'IDAT', zlib.compress(row * height)) + chunk(b'IEND', b'')
+
+
+def lonLatToTile(lon, lat, z):
+  n = 2 ** z
+  x = int((lon + 180.0) / 360.0 * n)
+  y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+  return x, y
+
+
+def tileBounds(z, x, y):
+  n = 2 ** z
+  west = x / n * 360.0 - 180.0
+  east = (x + 1) / n * 360.0 - 180.0
+  north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+  south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+  return west, south, east, north
+
+
+class MockSpaceKnow():
+  """ Local stand-in for SpaceKnow API.
+
+      It implements oauth/ro, user/info, credits, imagery/search, kraken/
+      dry-run and kraken/release pipelines (initiate, tasking/get-status,
+      retrieve) and kraken/grid tiles with synthetic PNG and GeoJSON
+      resources, so every code path can run offline.
+
+      Usage:
+        with MockSpaceKnow(scenes=10, tilesPerMap=100) as server:
+          os.environ.update(server.environ())
+          ...
+
+      Arguments:
+      scenes -- scenes returned by imagery/search
+      tilesPerMap -- tiles of every released map
+      latency -- seconds added to every response
+      nextTry -- nextTry returned by every pipeline
+      polls -- get-status calls before a pipeline is RESOLVED
+      errorRate -- probability of a 503 answer on any endpoint
+      tileSize -- width and height of the synthetic PNG tiles
+      credits -- remaining credit of the user
+      zoom -- zoom level of the released tiles
+      center -- (lon, lat) around which the tiles are released
+      days -- scenes are acquired one per day from 2018-01-01 over this
+              many days; imagery/search returns the ones in its window
+      capacity -- requests an endpoint serves at the same time, 0 for no
+                  limit; over it the answer is 429 with a Retry-After of
+                  retryAfter seconds
+  """
+  def __init__(self, scenes=1, tilesPerMap=10, latency=0.0, nextTry=0,
+               polls=1, errorRate=0.0, tileSize=32, credits=1e9, zoom=19,
+               center=(153.1069, -27.3892), seed=0, host='127.0.0.1',
+               port=0, days=28, capacity=0, retryAfter=1):
+    self.scenes = scenes
+    self.days = days
+    self.tilesPerMap = tilesPerMap
+    self.latency = latency
+    self.nextTry = nextTry
+    self.polls = polls
+    self.errorRate = errorRate
+    self.tileSize = tileSize
+    self.credits = credits
+    self.zoom = zoom
+    self.center = center
+    self.capacity = capacity
+    self.retryAfter = retryAfter
+    self._busy = {}
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+    self._pipelines = {}
+    self.requests = {}
+    self._pngs = {}
+    self._server = ThreadingHTTPServer((host, port), self._handler())
+    self._server.daemon_threads = True
+    self._thread = None
+
+  @property
+  def url(self):
+    host, port = self._server.server_address[:2]
+    return 'http://%s:%d' % (host, port)
+
+  def environ(self):
+    """ Environment variables which point the client at this server
+    """
+    return {'SPACEKNOW_AUTH0': self.url + '/oauth/ro',
+            'SK_USER_API': self.url + '/user',
+            'SK_IMAGE_API': self.url + '/imagery',
+            'SK_TASK_API': self.url + '/tasking',
+            'SK_KRAKEN_API': self.url + '/kraken',
+            'SK_CREDIT_API': self.url + '/credits'}
+
+  def start(self):
+    self._thread = threading.Thread(target=self._server.serve_forever,
+                                    name='MockSpaceKnow', daemon=True)
+    self._thread.start()
+    return self
+
+  def stop(self):
+    self._server.shutdown()
+    self._server.server_close()
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *exc):
+    self.stop()
+
+  @property
+  def totalRequests(self):
+    with self._lock:
+      return sum(self.requests.values())
+
+  def resetCounters(self):
+    with self._lock:
+      self.requests = {}
+
+  def _enter(self, path):
+    """ Takes a slot of the endpoint of path, False when it is at capacity
+    """
+    name = '/'.join(path.strip('/').split('/')[:2])
+    with self._lock:
+      if self._busy.get(name, 0) >= self.capacity:
+        return None
+      self._busy[name] = self._busy.get(name, 0) + 1
+    return name
+
+  def _leave(self, name):
+    with self._lock:
+      self._busy[name] -= 1
+
+  def _count(self, endpoint):
+    with self._lock:
+      self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+  def _newPipeline(self, result):
+    pipelineId = uuid.uuid4().hex
+    with self._lock:
+      self._pipelines[pipelineId] = {'polls': 0, 'result': result}
+    return {'pipelineId': pipelineId, 'status': 'PROCESSING',
+            'nextTry': self.nextTry}
+
+  def _status(self, pipelineId):
+    with self._lock:
+      pipeline = self._pipelines.get(pipelineId)
+      if pipeline is None:
+        return 404, {'errorMessage': 'Unknown pipeline'}
+      pipeline['polls'] += 1
+      if pipeline['polls'] >= self.polls:
+        return 200, {'status': 'RESOLVED'}
+    return 200, {'status': 'PROCESSING', 'nextTry': self.nextTry}
+
+  def _retrieve(self, pipelineId):
+    with self._lock:
+      pipeline = self._pipelines.get(pipelineId)
+    if pipeline is None:
+      return 404, {'errorMessage': 'Unknown pipeline'}
+    return 200, pipeline['result']
+
+  def sceneList(self, start='', end=''):
+    first = datetime(2018, 1, 1)
+    scenes = [{'sceneId': 'scene-%05d' % i,
+               'datetime': (first + timedelta(days=i % self.days,
+                                              minutes=i % 60))
+               .strftime('%Y-%m-%d %H:%M:%S'),
+               'provider': 'gbdx', 'dataset': 'idaho-pansharpened',
+               'cloudCover': (i * 7) % 100 / 100.0}
+              for i in range(self.scenes)]
+    return [scene for scene in scenes
+            if (not start or scene['datetime'] >= start) and
+            (not end or scene['datetime'] <= end)]
+
+  def tileList(self):
+    side = max(1, int(math.ceil(math.sqrt(self.tilesPerMap))))
+    cx, cy = lonLatToTile(self.center[0], self.center[1], self.zoom)
+    x0, y0 = cx - side // 2, cy - side // 2
+    return [[self.zoom, x0 + i % side, y0 + i // side]
+            for i in range(self.tilesPerMap)]
+
+  def _grid(self, mapId, z, x, y, resource):
+    rnd = random.Random('%s/%d/%d/%d' % (mapId, z, x, y))
+    if resource.endswith('.png'):
+      color = (255, 0, 0, 255) if resource == 'cars.png' else \
+        (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256), 255)
+      if color not in self._pngs:
+        self._pngs[color] = encodePNG(self.tileSize, self.tileSize, color)
+      return 200, 'image/png', self._pngs[color]
+    if resource == 'detections.geojson':
+      west, south, east, north = tileBounds(z, x, y)
+      features = []
+      for _ in range(rnd.randrange(4)):
+        lon = rnd.uniform(west, east)
+        lat = rnd.uniform(south, north)
+        d = (east - west) / 50
+        features.append({'type': 'Feature',
+                         'geometry': {'type': 'Polygon',
+                                      'coordinates': [[[lon, lat], [lon + d, lat],
+                                                       [lon + d, lat + d], [lon, lat + d],
+                                                       [lon, lat]]]},
+                         'properties': {'class': rnd.choice(['cars', 'trucks']),
+                                        'count': rnd.randrange(1, 4)}})
+      body = {'type': 'FeatureCollection', 'features': features}
+    else:
+      body = {'mapId': mapId, 'tile': [z, x, y]}
+    return 200, 'application/json', json.dumps(body).encode()
+
+  def route(self, method, path, body):
+    """ Returns (endpoint, status, content type, body bytes)
+    """
+    parts = [p for p in path.split('/') if p]
+    if len(parts) >= 2 and parts[0] == 'kraken' and parts[1] == 'grid' and \
+      len(parts) == 8:
+      mapId, z, x, y, resource = parts[2], int(parts[4]), int(parts[5]), \
+        int(parts[6]), parts[7]
+      return ('kraken/grid',) + self._grid(mapId, z, x, y, resource)
+    try:
+      request = json.loads(body) if body else {}
+    except ValueError:
+      request = {}
+    endpoint = '/'.join(parts)
+    if endpoint == 'oauth/ro':
+      status, reply = 200, {'id_token': 'mock-token', 'token_type': 'bearer'}
+    elif endpoint == 'user/info':
+      status, reply = 200, {'permissions': PERMISSIONS}
+    elif endpoint == 'credits/get-remaining-credit':
+      status, reply = 200, {'remainingCredit': self.credits}
+    elif endpoint == 'tasking/get-status':
+      status, reply = self._status(request.get('pipelineId'))
+    elif endpoint.endswith('/retrieve'):
+      status, reply = self._retrieve(request.get('pipelineId'))
+    elif endpoint == 'imagery/search/initiate':
+      status, reply = 200, self._newPipeline(
+        {'results': self.sceneList(request.get('startDatetime', ''),
+                                   request.get('endDatetime', ''))})
+    elif endpoint == 'kraken/dry-run/initiate':
+      scenes = sum(len(d.get('scenes', [])) for d in request.get('dryRuns', []))
+      # one credit per scene and map type
+      maps = sum(len(d.get('scenes', [])) * len(d.get('mapTypes') or ['cars'])
+                 for d in request.get('dryRuns', []))
+      status, reply = 200, self._newPipeline(
+        {'allocatedCredits': float(maps), 'ingestedKm2': 1.0 * scenes,
+         'analyzedKm2': 1.0 * scenes, 'allocatedKm2': 1.0 * scenes})
+    elif endpoint.startswith('kraken/release/') and endpoint.endswith('/initiate'):
+      mapType = parts[2]
+      sceneId = request.get('sceneId', 'scene')
+      status, reply = 200, self._newPipeline(
+        {'mapId': 'map-%s-%s' % (mapType, sceneId),
+         'maxZoom': self.zoom, 'tiles': self.tileList()})
+    else:
+      status, reply = 404, {'errorMessage': 'Unknown endpoint %s' % endpoint}
+    endpoint = endpoint.replace('/initiate', '').replace('/retrieve', '')
+    return endpoint, status, 'application/json', json.dumps(reply).encode()
+
+  def _handler(self):
+    server = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      # headers and body are written separately: avoid the delayed ACK stall
+      disable_nagle_algorithm = True
+
+      def _serve(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        path = urlparse(self.path).path
+        slot = server._enter(path) if server.capacity else None
+        if server.capacity and slot is None:
+          server._count('throttled')
+          self.send_response(429)
+          self.send_header('Retry-After', '%g' % server.retryAfter)
+          self.send_header('Content-Length', '0')
+          self.end_headers()
+          return
+        try:
+          if server.latency:
+            time.sleep(server.latency)
+          if server.errorRate and server._random.random() < server.errorRate:
+            endpoint, status, kind, reply = 'error', 503, 'application/json', \
+              b'{}'
+          else:
+            endpoint, status, kind, reply = server.route(self.command, path,
+                                                         body)
+        finally:
+          if slot:
+            server._leave(slot)
+        server._count(endpoint)
+        self.send_response(status)
+        self.send_header('Content-Type', kind)
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+      do_GET = _serve
+      do_POST = _serve
+
+      def log_message(self, *args):
+        pass
+
+    return Handler
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Offline SpaceKnow API')
+  parser.add_argument('--port', type=int, default=8080)
+  parser.add_argument('--scenes', type=int, default=1)
+  parser.add_argument('--tiles', type=int, default=10)
+  parser.add_argument('--latency', type=float, default=0.0)
+  parser.add_argument('--next-try', type=float, default=0)
+  parser.add_argument('--polls', type=int, default=1)
+  parser.add_argument('--error-rate', type=float, default=0.0)
+  parser.add_argument('--days', type=int, default=28)
+  parser.add_argument('--capacity', type=int, default=0)
+  parser.add_argument('--retry-after', type=float, default=1)
+  args = parser.parse_args()
+  server = MockSpaceKnow(scenes=args.scenes, tilesPerMap=args.tiles,
+                         latency=args.latency, nextTry=args.next_try,
+                         polls=args.polls, errorRate=args.error_rate,
+                         port=args.port, days=args.days,
+                         capacity=args.capacity, retryAfter=args.retry_after)
+  for name, value in server.environ().items():
+    print('%s=%s' % (name, value))
+  try:
+    server._server.serve_forever()
+  except KeyboardInterrupt:
+    server.stop()
@@ -0,0 +1,129 @@
+import numpy as np
+import struct
+import tempfile
+import zlib
+
+from config import getConfig
+from utils import spaceKnowLogger
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def _pngChunk(fp, kind, data):
+  fp.write(struct.pack('>I', len(data)))
+  fp.write(kind)
+  fp.write(data)
+  fp.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+
+def writePNG(filename, canvas, stripRows=256):
+  """ Writes an RGBA uint8 array (height, width, 4) as PNG, compressing
+      stripRows rows at a time so only one strip is copied in memory.
+  """
+  height, width, channels = canvas.shape
+  with open(filename, 'wb') as fp:
+    fp.write(PNG_SIGNATURE)
+    _pngChunk(fp, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6,
+                                       0, 0, 0))
+    compressor = zlib.compressobj(6)
+    strip = np.zeros((stripRows, 1 + width * channels), dtype=np.uint8)
+    for top in range(0, height, stripRows):
+      rows = min(stripRows, height - top)
+      # first byte of every row is the PNG filter type (0 = none)
+      strip[:rows, 1:] = canvas[top:top + rows].reshape(rows, -1)
+      data = compressor.compress(strip[:rows].tobytes())
+      if data:
+        _pngChunk(fp, b'IDAT', data)
+    _pngChunk(fp, b'IDAT', compressor.flush())
+    _pngChunk(fp, b'IEND', b'')
+
+
+class Mosaic():
+  """ Places the tiles of a map on their (x, y) grid.
+
+      The canvas covers the bounding box of the tiles and is allocated when
+      the first tile arrives (its size gives the tile size). Canvases
+      bigger than memoryLimit bytes live in a memory-mapped temporary file,
+      so a map with thousands of tiles is assembled in bounded memory.
+      Slots of missing tiles keep the fill colour.
+
+      Arguments:
+      tiles -- TileSet, Tile objects or [z, x, y] lists of the same zoom
+      fill -- RGBA colour of missing tiles
+      memoryLimit -- bytes above which the canvas is memory-mapped
+                     (SK_MOSAIC_MEMORY)
+  """
+  def __init__(self, tiles, fill=(255, 255, 255, 255), memoryLimit=None):
+    if hasattr(tiles, 'coords'):
+      coords = tiles.coords.astype(np.int64)
+    else:
+      coords = np.array([[int(t[0]), int(t[1]), int(t[2])] if type(t) == list
+                         else [int(t.z), int(t.x), int(t.y)] for t in tiles],
+                        dtype=np.int64).reshape(-1, 3)
+    if len(coords) == 0:
+      raise ValueError('A mosaic needs at least one tile')
+    self.zoom = int(coords[:, 0].max())
+    self.minX, self.minY = coords[:, 1].min(), coords[:, 2].min()
+    self.columns = int(coords[:, 1].max() - self.minX + 1)
+    self.rows = int(coords[:, 2].max() - self.minY + 1)
+    self.fill = np.array(fill, dtype=np.uint8)
+    self.memoryLimit = memoryLimit or getConfig().mosaicMemory
+    self.tileWidth = self.tileHeight = None
+    self.canvas = None
+    self.placed = 0
+    self._mapFile = None
+
+  def _allocate(self, tileWidth, tileHeight):
+    self.tileWidth, self.tileHeight = tileWidth, tileHeight
+    shape = (self.rows * tileHeight, self.columns * tileWidth, 4)
+    if np.prod(shape) > self.memoryLimit:
+      self._mapFile = tempfile.TemporaryFile(prefix='mosaic')
+      self.canvas = np.memmap(self._mapFile, dtype=np.uint8, mode='w+',
+                              shape=shape)
+      for top in range(0, shape[0], tileHeight):
+        self.canvas[top:top + tileHeight] = self.fill
+    else:
+      self.canvas = np.empty(shape, dtype=np.uint8)
+      self.canvas[:] = self.fill
+
+  def paste(self, tile, image):
+    """ Copies the tile pixels (array or PIL Image) at its grid position.
+        Returns False when the tile can not be placed.
+    """
+    if image is None:
+      return False
+    z, x, y = (int(v) for v in (tile if type(tile) == list else tile.aslist()))
+    pixels = np.asarray(image.convert('RGBA') if hasattr(image, 'convert')
+                        else image)
+    if self.canvas is None:
+      self._allocate(pixels.shape[1], pixels.shape[0])
+    if z != self.zoom or pixels.shape[:2] != (self.tileHeight, self.tileWidth):
+      spaceKnowLogger.error('Tile %d/%d/%d does not fit the mosaic' % (z, x, y))
+      return False
+    top = (y - self.minY) * self.tileHeight
+    left = (x - self.minX) * self.tileWidth
+    slot = self.canvas[top:top + self.tileHeight, left:left + self.tileWidth]
+    # grey and RGB tiles are broadcast into the RGBA slot, without a copy
+    if pixels.ndim == 2:
+      slot[..., :3] = pixels[..., None]
+      slot[..., 3] = 255
+    elif pixels.shape[2] == 3:
+      slot[..., :3] = pixels
+      slot[..., 3] = 255
+    else:
+      slot[...] = pixels
+    self.placed += 1
+    return True
+
+  def save(self, filename, stripRows=256):
+    if self.canvas is None:
+      spaceKnowLogger.error('No images available for %s' % filename)
+      return False
+    writePNG(filename, self.canvas, stripRows)
+    return True
+
+  def close(self):
+    self.canvas = None
+    if self._mapFile:
+      self._mapFile.close()
+      self._mapFile = None
@@ -2,17 +2,41 @@ import json
 import time
 import utils
 
-from threading import Thread
+from manifest import getManifest
+from metrics import endpoint, getMetrics
+from poller import getPoller
 from utils import process, SpaceKnowError
 
-class Pipeline(Thread):
-  def __init__(self, url, token, request):
-    super().__init__()
+class Pipeline():
+  """ Lifecycle of a SpaceKnow pipeline: initiate, wait until RESOLVED,
+      retrieve. Status checks are done by the process-wide PipelinePoller.
+
+      When a run manifest is open, a pipeline already RESOLVED by a
+      previous run returns its recorded result and a pipeline still
+      PROCESSING is reattached instead of being initiated again.
+      `manifest` replaces the manifest of the run for this pipeline (any
+      object with the pipeline methods of manifest.Manifest).
+
+      The seconds from initiate to RESOLVED (time spent queued and
+      processed by SpaceKnow) and of the retrieve are observed in the
+      sk_pipeline_seconds histogram.
+
+      Usage:
+        pipeline = Pipeline(url, token, request)
+        pipeline.start()
+        result = pipeline.join()
+  """
+  def __init__(self, url, token, request, manifest=None):
     self.url = url
     self.token = token
     self.request = request
     self.__return = None
+    self._future = None
+    self._resolved = False
+    self._reattached = False
+    self.manifest = manifest if manifest is not None else getManifest()
     self.error = None
+    self._started = None
 
   def __initiate(self):
     utils.spaceKnowLogger.debug("Initiate pipeline at %s" % self.url)
@@ -34,60 +58,74 @@ class Pipeline(Thread):
       self.error = e
       raise e
   
-  def __isReady(self):
-    try:
-      url = utils.SK_TASK_API +'/get-status'
-      pipelineId = json.dumps({"pipelineId": self.id})
-      response = process(url, data=pipelineId, token=self.token)
-      if 'status' not in response or \
-        (response['status']!='RESOLVED' and 'nextTry' not in response) :
-        raise SpaceKnowError(('Invalid response during checking the pipeline\'s status: %s',
-                        pipelineId), 500)
-      if response['status'] == 'RESOLVED':
-        return True
-      elif response['status'] == 'FAILED':
-        raise SpaceKnowError('Error during pipeline processing', 500)
-      else:
-        self.nextTry= response['nextTry']
-        return False
-    except SpaceKnowError as e:
-      utils.spaceKnowLogger.error("Error %d during status checking at pipeline %s: %s" %
-                    (e.status_code, self.id, e.error))
-      self.error = e
-      raise e
-
   def __retrieve(self):
     pipelineId = json.dumps({"pipelineId": self.id})
     utils.spaceKnowLogger.debug("Retrieve pipeline at %s" % self.url)
     response = process(self.url+'/retrieve', data=pipelineId, token=self.token)
     return response
     
-  """  
-  #status = Event()
-  time.sleep(tryIn)
-  try:
-    while not isReady(pipelineId, tryIn, token):
-      print("Imagery is not available yet. Retry in %d"% tryIn)
-      time.sleep(tryIn)
-  except SpaceKnowError as e:
-     spaceKnowLogger.error("Error %d during status checking at pipeline %s: %s" % 
-                    (e.status_code, pipelineId, e.error))
-"""
-  def run(self):
+  def __resolved(self, future):
+    if future.exception() is None:
+      getMetrics().observe('sk_pipeline_seconds',
+                           time.perf_counter() - self._started, self._started,
+                           endpoint=endpoint(self.url), stage='resolve')
+
+  def start(self):
+    """ Initiates the pipeline and hands it over to the shared poller, no
+        thread is kept alive while the pipeline is processing.
+    """
+    if self.manifest:
+      entry = self.manifest.pipeline(self.url, self.request)
+      if entry and entry[1] == 'RESOLVED':
+        utils.spaceKnowLogger.debug("Pipeline %s already resolved" % entry[0])
+        self.id, self.__return, self._resolved = entry[0], entry[2], True
+        return
+      if entry:
+        utils.spaceKnowLogger.debug("Reattaching pipeline %s" % entry[0])
+        self.id, self.nextTry, self._reattached = entry[0], 0, True
+        self._started = time.perf_counter()
+        self._future = getPoller().register(self.id, self.token, 0)
+        self._future.add_done_callback(self.__resolved)
+        return
     try:
+      self._started = time.perf_counter()
       self.nextTry, self.id = self.__initiate()
-      time.sleep(self.nextTry)
-      while not self.__isReady():
-        utils.spaceKnowLogger.info("Imagery is not available yet. Retry in %d"% self.nextTry)
-        time.sleep(self.nextTry)
-      self.__return = self.__retrieve()
+      if self.manifest:
+        self.manifest.startPipeline(self.url, self.request, self.id)
+      self._future = getPoller().register(self.id, self.token, self.nextTry)
+      self._future.add_done_callback(self.__resolved)
     except SpaceKnowError as e:
-        utils.spaceKnowLogger.error("Error %d at pipeline %s: %s" %
-                      (e.status_code, self.url, e.error))
+      utils.spaceKnowLogger.error("Error %d at pipeline %s: %s" %
+                    (e.status_code, self.url, e.error))
 
-  def join(self):
-    super().join()
+  def join(self, timeout=None):
+    """ Waits until the pipeline is RESOLVED and returns its result.
+        Raises the SpaceKnowError met during the pipeline's lifecycle.
+    """
     if self.error:
       raise self.error
+    if self._resolved:
+      return self.__return
+    try:
+      self._future.result(timeout)
+      with getMetrics().timer('sk_pipeline_seconds',
+                              endpoint=endpoint(self.url), stage='retrieve'):
+        self.__return = self.__retrieve()
+      if self.manifest:
+        self.manifest.resolvePipeline(self.url, self.request, self.id,
+                                      self.__return)
+    except SpaceKnowError as e:
+      if self._reattached:
+        # the pipeline of the previous run is gone: start a new one
+        utils.spaceKnowLogger.info("Pipeline %s can not be resumed: %s" %
+                                   (self.id, e.error))
+        self.manifest.forgetPipeline(self.url, self.request)
+        self._reattached = False
+        self.start()
+        return self.join(timeout)
+      utils.spaceKnowLogger.error("Error %d at pipeline %s: %s" %
+                      (e.status_code, self.url, e.error))
+      self.error = e
+      raise e
 
     return self.__return
@@ -0,0 +1,123 @@
+import heapq
+import itertools
+import json
+import time
+import utils
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from config import getConfig
+from threading import Condition, Lock, Thread
+from utils import process, SpaceKnowError
+
+
+def checkStatus(pipelineId, token):
+  """ Asks tasking/get-status the status of a pipeline.
+      Returns (status, nextTry); raises SpaceKnowError when the pipeline
+      FAILED or the response is invalid.
+  """
+  url = getConfig().taskApi + '/get-status'
+  data = json.dumps({"pipelineId": pipelineId})
+  response = process(url, data=data, token=token)
+  if 'status' not in response or \
+    (response['status']!='RESOLVED' and 'nextTry' not in response) :
+    raise SpaceKnowError('Invalid response during checking the pipeline\'s '
+                         'status: %s' % data, 500)
+  if response['status'] == 'FAILED':
+    raise SpaceKnowError('Error during pipeline processing', 500)
+  return response['status'], response.get('nextTry', 0)
+
+
+class PipelinePoller(Thread):
+  """ Single scheduler which checks the status of every pipeline in flight.
+
+      Pipelines are kept in a priority queue keyed on their next-try
+      deadline: the thread sleeps until the first deadline is due, then
+      checks every due pipeline in the same cycle (tasking/get-status takes
+      one pipelineId, so the checks of a cycle run together on `workers`
+      threads). The Future of a pipeline is resolved when it is RESOLVED
+      and fails with SpaceKnowError when it FAILED.
+  """
+  def __init__(self, workers=4):
+    super().__init__(name='PipelinePoller', daemon=True)
+    self._queue = []
+    self._sequence = itertools.count()
+    self._condition = Condition()
+    self._checker = ThreadPoolExecutor(max_workers=workers,
+                                       thread_name_prefix='PollerCheck')
+    self.polls = 0
+
+  @property
+  def pending(self):
+    with self._condition:
+      return len(self._queue)
+
+  def register(self, pipelineId, token, nextTry):
+    """ Schedules the first status check in nextTry seconds and returns the
+        Future of the pipeline.
+    """
+    future = Future()
+    self._schedule(time.monotonic() + nextTry, pipelineId, token, future)
+    return future
+
+  def _schedule(self, deadline, pipelineId, token, future):
+    with self._condition:
+      heapq.heappush(self._queue, (deadline, next(self._sequence),
+                                   pipelineId, token, future))
+      self._condition.notify()
+
+  def _due(self):
+    """ Waits for the first deadline and pops every entry already due
+    """
+    with self._condition:
+      while True:
+        if not self._queue:
+          self._condition.wait()
+          continue
+        delay = self._queue[0][0] - time.monotonic()
+        if delay > 0:
+          self._condition.wait(delay)
+          continue
+        due = []
+        now = time.monotonic()
+        while self._queue and self._queue[0][0] <= now:
+          due.append(heapq.heappop(self._queue))
+        return due
+
+  def _check(self, entry):
+    _, _, pipelineId, token, future = entry
+    try:
+      status, nextTry = checkStatus(pipelineId, token)
+      if status == 'RESOLVED':
+        future.set_result(pipelineId)
+      else:
+        utils.spaceKnowLogger.debug("Pipeline %s is not ready. Retry in %d" %
+                                    (pipelineId, nextTry))
+        self._schedule(time.monotonic() + nextTry, pipelineId, token, future)
+    except SpaceKnowError as e:
+      utils.spaceKnowLogger.error("Error %d during status checking at pipeline "
+                                  "%s: %s" % (e.status_code, pipelineId, e.error))
+      future.set_exception(e)
+    except Exception as e:
+      future.set_exception(e)
+
+  def run(self):
+    while True:
+      due = self._due()
+      self.polls += len(due)
+      for entry in due:
+        self._checker.submit(self._check, entry)
+
+
+_poller = None
+_pollerLock = Lock()
+
+def getPoller():
+  """ Returns the poller shared by every Pipeline of the process
+      (SK_POLL_WORKERS status checks at the same time).
+  """
+  global _poller
+  with _pollerLock:
+    if _poller is None:
+      _poller = PipelinePoller(workers=getConfig().pollWorkers)
+      _poller.start()
+    return _poller
@@ -0,0 +1,310 @@
+import argparse
+import csv
+import numpy as np
+import sqlite3
+import sys
+import threading
+
+from config import getConfig
+from datetime import datetime, timezone
+from detections import DETECTION_CLASSES
+from geo import bbox, lonLatToTile, pointsInGeometry
+
+COUNT_COLUMNS = [(name, np.int64) for name in ('total',) + DETECTION_CLASSES]
+SCENE_DTYPE = [('mapId', object), ('sceneId', object), ('datetime', object),
+               ('timestamp', np.float64)] + COUNT_COLUMNS
+TILE_DTYPE = [('mapId', object), ('timestamp', np.float64), ('z', np.int32),
+              ('x', np.int32), ('y', np.int32)] + COUNT_COLUMNS
+DETECTION_DTYPE = [('mapId', object), ('timestamp', np.float64),
+                   ('z', np.int32), ('x', np.int32), ('y', np.int32),
+                   ('cls', np.int8), ('count', np.int32), ('lon', np.float64),
+                   ('lat', np.float64)]
+
+
+def toTimestamp(value, default):
+  """ Seconds of an ISO date or datetime string, a datetime or a number;
+      default when value is None. A date or datetime without timezone is
+      UTC, as the acquisition times of SpaceKnow, whatever the timezone of
+      the host: every timestamp of the client goes through here.
+  """
+  if value is None:
+    return default
+  if isinstance(value, (int, float)):
+    return float(value)
+  if isinstance(value, str):
+    value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+  if value.tzinfo is None:
+    value = value.replace(tzinfo=timezone.utc)
+  return value.timestamp()
+
+
+class ResultStore():
+  """ SQLite store of the results of every run, kept across runs so
+      dashboards query years of counts without running detection again.
+
+      It records:
+      - scenes: totals per class of every map, with its scene and time
+      - tiles: totals per class of every analysed tile of a map, tiles
+        without vehicles included
+      - detections: one row per detection feature (tile, class, vehicles,
+        centroid lon/lat)
+      Detections are indexed by an R*Tree over lon, lat and time, tiles by
+      (z, x, y, timestamp) and scenes by time, so queries by area and date
+      range read only the matching rows. A map is written in one
+      transaction and writing it again replaces its rows.
+
+      Usage:
+        store = ResultStore('results.sqlite')
+        store.addMap(jsonMap, carsObject.detections)
+        store.counts((west, south, east, north), '2018-01-01', '2019-01-01')
+  """
+  def __init__(self, filename):
+    self.filename = filename
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(filename, check_same_thread=False,
+                               isolation_level=None)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.execute('PRAGMA synchronous=NORMAL')
+    self._db.executescript('''
+      CREATE TABLE IF NOT EXISTS scenes (
+        mapId TEXT PRIMARY KEY, sceneId TEXT, datetime TEXT, timestamp REAL,
+        tiles INTEGER, total INTEGER, cars INTEGER, trucks INTEGER,
+        other INTEGER);
+      CREATE INDEX IF NOT EXISTS scenesTime ON scenes (timestamp);
+      CREATE INDEX IF NOT EXISTS scenesScene ON scenes (sceneId);
+      CREATE TABLE IF NOT EXISTS tiles (
+        mapId TEXT, z INTEGER, x INTEGER, y INTEGER, timestamp REAL,
+        total INTEGER, cars INTEGER, trucks INTEGER, other INTEGER,
+        PRIMARY KEY (mapId, z, x, y)) WITHOUT ROWID;
+      CREATE INDEX IF NOT EXISTS tilesPosition ON tiles (z, x, y, timestamp);
+      CREATE TABLE IF NOT EXISTS detections (
+        id INTEGER PRIMARY KEY, mapId TEXT, timestamp REAL, z INTEGER,
+        x INTEGER, y INTEGER, cls INTEGER, count INTEGER, lon REAL,
+        lat REAL);
+      CREATE INDEX IF NOT EXISTS detectionsMap ON detections (mapId);
+      CREATE VIRTUAL TABLE IF NOT EXISTS detectionsIndex USING rtree (
+        id, minLon, maxLon, minLat, maxLat, minTime, maxTime);
+    ''')
+
+  def _query(self, sql, args=()):
+    with self._lock:
+      return self._db.execute(sql, args).fetchall()
+
+  def addMap(self, jsonMap, table):
+    """ Records the DetectionTable of a map released for a scene
+        (jsonMap with mapId, sceneId and datetime, see describeScene).
+        Returns the number of detections written.
+    """
+    mapId = jsonMap['mapId']
+    try:
+      timestamp = toTimestamp(jsonMap.get('datetime') or None, 0.0)
+    except ValueError:
+      timestamp = 0.0
+    classes = table.tileClassCounts()
+    totals = table.classCounts()
+    z, x, y = (table.tiles[:, axis].tolist() for axis in range(3))
+    tileRows = [(mapId,) + position + (timestamp, sum(counts)) +
+                tuple(counts) for position, counts in
+                zip(zip(z, x, y), classes.tolist())]
+    tile = table.tile
+    detectionColumns = (table.tiles[tile, 0].tolist(),
+                        table.tiles[tile, 1].tolist(),
+                        table.tiles[tile, 2].tolist(), table.cls.tolist(),
+                        table.count.tolist(), table.lon.tolist(),
+                        table.lat.tolist())
+    located = np.flatnonzero(~(np.isnan(table.lon) | np.isnan(table.lat)))
+    with self._lock:
+      self._db.execute('BEGIN IMMEDIATE')
+      try:
+        self._delete(mapId)
+        first = self._db.execute(
+          'SELECT COALESCE(MAX(id), 0) + 1 FROM detections').fetchone()[0]
+        self._db.execute('INSERT INTO scenes VALUES (?, ?, ?, ?, ?, ?, ?, ?, '
+                         '?)', (mapId, jsonMap.get('sceneId'),
+                                jsonMap.get('datetime'), timestamp,
+                                len(table.tiles), table.total) +
+                         tuple(totals[name] for name in DETECTION_CLASSES))
+        self._db.executemany('INSERT INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?, '
+                             '?, ?)', tileRows)
+        self._db.executemany('INSERT INTO detections VALUES (?, ?, ?, ?, ?, '
+                             '?, ?, ?, ?, ?)',
+                             ((first + row, mapId, timestamp) + values
+                              for row, values in
+                              enumerate(zip(*detectionColumns))))
+        lon, lat = table.lon[located].tolist(), table.lat[located].tolist()
+        self._db.executemany('INSERT INTO detectionsIndex VALUES (?, ?, ?, ?, '
+                             '?, ?, ?)',
+                             ((first + row, a, a, b, b, timestamp, timestamp)
+                              for row, a, b in zip(located.tolist(), lon,
+                                                   lat)))
+        self._db.execute('COMMIT')
+      except Exception:
+        self._db.execute('ROLLBACK')
+        raise
+    return len(table)
+
+  def _delete(self, mapId):
+    self._db.execute('DELETE FROM detectionsIndex WHERE id IN (SELECT id FROM '
+                     'detections WHERE mapId = ?)', (mapId,))
+    for name in ('detections', 'tiles', 'scenes'):
+      self._db.execute('DELETE FROM %s WHERE mapId = ?' % name, (mapId,))
+
+  def scenes(self, start=None, end=None):
+    """ Totals of every map acquired between start and end (ISO dates,
+        datetimes or seconds), by time
+    """
+    rows = self._query('SELECT mapId, sceneId, datetime, timestamp, total, '
+                       'cars, trucks, other FROM scenes WHERE timestamp '
+                       'BETWEEN ? AND ? ORDER BY timestamp, mapId',
+                       self._range(start, end))
+    return np.array(rows, dtype=SCENE_DTYPE)
+
+  def detections(self, box, start=None, end=None):
+    """ Detections with their centroid inside box (west, south, east,
+        north) and acquired between start and end
+    """
+    west, south, east, north = (float(value) for value in box)
+    first, last = self._range(start, end)
+    rows = self._query(
+      'SELECT d.mapId, d.timestamp, d.z, d.x, d.y, d.cls, d.count, d.lon, '
+      'd.lat FROM detectionsIndex AS r JOIN detections AS d ON d.id = r.id '
+      'WHERE r.minLon <= ? AND r.maxLon >= ? AND r.minLat <= ? AND '
+      'r.maxLat >= ? AND r.minTime <= ? AND r.maxTime >= ? AND d.lon '
+      'BETWEEN ? AND ? AND d.lat BETWEEN ? AND ? AND d.timestamp BETWEEN ? '
+      'AND ?', (east, west, north, south, last, first, west, east, south,
+                north, first, last))
+    return np.array(rows, dtype=DETECTION_DTYPE)
+
+  def counts(self, area, start=None, end=None):
+    """ Vehicles per map inside the area, acquired between start and end:
+        one row per map with mapId, sceneId, datetime, timestamp, total
+        and one column per class, by time. Every map with an analysed tile
+        over the area has a row, with zeros when no vehicle was found.
+        area is a (west, south, east, north) box or a GeoJSON object, whose
+        polygons are tested exactly.
+    """
+    box = area if isinstance(area, (tuple, list)) else bbox(area)
+    first, last = self._range(start, end)
+    covering = set()
+    for zoom, minX, maxX, minY, maxY in self._tileRanges(box):
+      covering.update(mapId for (mapId,) in self._query(
+        'SELECT DISTINCT mapId FROM tiles WHERE z = ? AND x BETWEEN ? AND ? '
+        'AND y BETWEEN ? AND ? AND timestamp BETWEEN ? AND ?',
+        (zoom, minX, maxX, minY, maxY, first, last)))
+    found = self.detections(box, start, end)
+    if not isinstance(area, (tuple, list)) and len(found):
+      found = found[pointsInGeometry(found['lon'], found['lat'], area)]
+    mapIds, inverse = np.unique(found['mapId'].astype(str),
+                                return_inverse=True)
+    classes = len(DETECTION_CLASSES)
+    perClass = np.bincount(inverse * classes + found['cls'],
+                           weights=found['count'],
+                           minlength=len(mapIds) * classes) \
+      .reshape(len(mapIds), classes).astype(np.int64)
+    found = dict(zip(mapIds.tolist(), perClass.tolist()))
+    covering.update(found)
+    scenes = [row for row in self._query(
+      'SELECT mapId, sceneId, datetime, timestamp FROM scenes WHERE '
+      'timestamp BETWEEN ? AND ? ORDER BY timestamp, mapId', (first, last))
+      if row[0] in covering]
+    result = np.zeros(len(scenes), dtype=SCENE_DTYPE)
+    empty = [0] * classes
+    for row, scene in enumerate(scenes):
+      counts = found.get(scene[0], empty)
+      result[row] = scene + (sum(counts),) + tuple(counts)
+    return result
+
+  def tiles(self, box, start=None, end=None):
+    """ Totals of the analysed tiles overlapping box (west, south, east,
+        north) of the maps acquired between start and end, tiles without
+        vehicles included
+    """
+    first, last = self._range(start, end)
+    rows = []
+    for zoom, minX, maxX, minY, maxY in self._tileRanges(box):
+      rows += self._query(
+        'SELECT mapId, timestamp, z, x, y, total, cars, trucks, other FROM '
+        'tiles WHERE z = ? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ? AND '
+        'timestamp BETWEEN ? AND ?', (zoom, minX, maxX, minY, maxY, first,
+                                      last))
+    return np.array(rows, dtype=TILE_DTYPE)
+
+  def _tileRanges(self, box):
+    """ (zoom, minX, maxX, minY, maxY) of the tiles overlapping box at every
+        zoom level of the store
+    """
+    west, south, east, north = (float(value) for value in box)
+    for (zoom,) in self._query('SELECT DISTINCT z FROM tiles'):
+      minX, minY = lonLatToTile(west, north, zoom)
+      maxX, maxY = lonLatToTile(east, south, zoom)
+      yield zoom, int(minX), int(maxX), int(minY), int(maxY)
+
+  @staticmethod
+  def _range(start, end):
+    return toTimestamp(start, -np.inf), toTimestamp(end, np.inf)
+
+  def stats(self):
+    with self._lock:
+      return {name: self._db.execute('SELECT COUNT(*) FROM %s' % name)
+              .fetchone()[0] for name in ('scenes', 'tiles', 'detections')}
+
+  def close(self):
+    with self._lock:
+      self._db.close()
+
+
+_results = None
+_resultsLock = threading.Lock()
+
+def openResults(filename=None):
+  """ Opens the result store (SK_RESULTS, default results.sqlite; empty
+      disables it) and makes it the one written by car detection. Returns
+      None when disabled.
+  """
+  global _results
+  filename = getConfig().results if filename is None else filename
+  with _resultsLock:
+    if _results is not None:
+      _results.close()
+      _results = None
+    if filename:
+      _results = ResultStore(filename)
+    return _results
+
+def closeResults():
+  global _results
+  with _resultsLock:
+    if _results is not None:
+      _results.close()
+      _results = None
+
+def getResults():
+  """ Result store of the process, None when results are not stored
+  """
+  return _results
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Vehicles per scene inside an area, from the result store')
+  parser.add_argument('box', nargs=4, type=float,
+                      metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'))
+  parser.add_argument('--start', help='first acquisition date (ISO)')
+  parser.add_argument('--end', help='last acquisition date (ISO)')
+  parser.add_argument('--store', default=None,
+                      help='result store (SK_RESULTS)')
+  args = parser.parse_args()
+
+  store = ResultStore(args.store or getConfig().results)
+  try:
+    counts = store.counts(tuple(args.box), args.start, args.end)
+  finally:
+    store.close()
+  writer = csv.writer(sys.stdout)
+  writer.writerow(counts.dtype.names)
+  for row in counts:
+    writer.writerow([str(value) for value in row.tolist()])
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,76 @@
+import threading
+
+from collections import OrderedDict
+from config import getConfig
+
+
+class RunStore():
+  """ In-memory store of the tile resources prefetched during a run.
+
+      While detecting cars, KrakenManager also downloads the resources of
+      the next operations (cars.png for BUILD_CARS_PNG) for the tiles with
+      detections. They wait here until the build takes them, so the build
+      does not request them again. Resources fetched for their own use are
+      not kept: no other operation of the run reads them.
+
+      When the stored bytes exceed maxBytes the oldest resources are
+      dropped; the build fetches them a second time.
+
+      Arguments:
+      maxBytes -- memory budget of the store (SK_RUN_STORE_BYTES)
+  """
+  def __init__(self, maxBytes=None):
+    self.maxBytes = maxBytes or getConfig().runStoreBytes
+    self._items = OrderedDict()
+    self._lock = threading.Lock()
+    self.size = 0
+    self.reused = 0
+    self.bytesReused = 0
+    self.dropped = 0
+
+  @staticmethod
+  def key(mapId, tile, resource):
+    return (mapId, str(tile.z), str(tile.x), str(tile.y), resource)
+
+  def take(self, mapId, tile, resource):
+    """ Removes and returns a prefetched resource, None if it is not stored
+    """
+    with self._lock:
+      content = self._items.pop(self.key(mapId, tile, resource), None)
+      if content is not None:
+        self.size -= len(content)
+        self.reused += 1
+        self.bytesReused += len(content)
+      return content
+
+  def put(self, mapId, tile, resource, content):
+    """ Stores a prefetched resource until its take
+    """
+    if len(content) > self.maxBytes:
+      self.dropped += 1
+      return
+    key = self.key(mapId, tile, resource)
+    with self._lock:
+      previous = self._items.pop(key, None)
+      if previous is not None:
+        self.size -= len(previous)
+      self._items[key] = content
+      self.size += len(content)
+      while self.size > self.maxBytes:
+        _, dropped = self._items.popitem(last=False)
+        self.size -= len(dropped)
+        self.dropped += 1
+
+  def __contains__(self, key):
+    with self._lock:
+      return key in self._items
+
+  def report(self):
+    """ Prefetched resources taken by the builds (reused, bytesReused),
+        dropped before their take and memory usage of the store
+    """
+    with self._lock:
+      return {'reused': self.reused,
+              'bytesReused': self.bytesReused,
+              'dropped': self.dropped,
+              'size': self.size}
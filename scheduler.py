@@ -0,0 +1,280 @@
+import collections
+import concurrent.futures
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from config import getConfig
+from kraken import createEvaluationRequest, describeScene, downloadMap, \
+  sceneTimestamp
+from pipeline import Pipeline
+from utils import SpaceKnowError, spaceKnowLogger, validateAccessRights
+
+SCHEDULER_WORKERS = getConfig().schedulerWorkers
+DRY_RUN_SCENES = getConfig().dryRunScenes
+# fields of a cost analysis
+COST_FIELDS = ('ingestedKm2', 'analyzedKm2', 'allocatedKm2', 'allocatedCredits')
+
+
+def newestFirst(scenes):
+  """ Value of every scene in [0, 1]: 1 for the most recent one
+  """
+  times = [sceneTimestamp(scene) for scene in scenes]
+  oldest, newest = min(times, default=0), max(times, default=0)
+  span = newest - oldest
+  return [(t - oldest) / span if span > 0 else 1.0 for t in times]
+
+
+def clearestFirst(scenes):
+  """ Value of every scene in [0, 1]: 1 for a scene without clouds
+  """
+  return [1.0 - min(max(float(scene.get('cloudCover') or 0), 0.0), 1.0)
+          for scene in scenes]
+
+
+PRIORITIES = {'newest': newestFirst, 'clearest': clearestFirst}
+
+
+def released(future):
+  """ True when the release of a Future ran and returned a map
+  """
+  return not future.cancelled() and future.exception() is None and \
+    bool(future.result())
+
+
+class CreditBudget():
+  """ Credits which can still be spent by the run, shared by every thread.
+      A release reserves its estimated cost before it is initiated and
+      gets it back if it fails.
+  """
+  def __init__(self, available):
+    self.available = float(available)
+    self.spent = 0.0
+    self._lock = threading.Lock()
+
+  def reserve(self, credits):
+    with self._lock:
+      if credits > self.available - self.spent:
+        return False
+      self.spent += credits
+      return True
+
+  def refund(self, credits):
+    with self._lock:
+      self.spent -= credits
+
+  @property
+  def remaining(self):
+    with self._lock:
+      return self.available - self.spent
+
+
+def creditBudget(credits):
+  """ credits as a CreditBudget
+  """
+  return credits if isinstance(credits, CreditBudget) else \
+    CreditBudget(credits)
+
+
+class CreditScheduler():
+  """ Releases as many scenes as the credits allow, the most valuable first.
+
+      The scenes are priced by dry-runs of `batch` scenes over every map
+      type of `mapTypes` (the dry-runs run together on `workers` threads),
+      so the maps released alongside (see iterRelease) are in the credits
+      reserved for a scene. The analysis of a batch is split evenly
+      between its scenes, which cover the same extent. Scenes are then ranked by
+      value / cost, where the value comes from `priority` ('newest' or
+      'clearest'), and released in that order while the budget covers
+      them: a scene too expensive for the remaining credits is skipped and
+      the cheaper ones after it are still released. Releases run on
+      `workers` threads.
+
+      Arguments:
+      token, permissions -- of an authenticated user
+      extent -- area of the analysis
+      priority -- name of a function of PRIORITIES (SK_PRIORITY)
+      workers -- dry-runs and releases in flight (SK_SCHEDULER_WORKERS)
+      batch -- scenes of a dry-run (SK_DRY_RUN_SCENES)
+      mapTypes -- map types released for every scene, e.g. ('cars',
+                  'imagery') when the imagery is released alongside
+  """
+  def __init__(self, token, permissions, extent, priority=None, workers=None,
+               mapTypes=('cars',), batch=None):
+    self.token = token
+    self.permissions = permissions
+    self.extent = extent
+    self.mapTypes = tuple(mapTypes)
+    self.priority = priority or getConfig().priority
+    if self.priority not in PRIORITIES:
+      raise SpaceKnowError('Unknown priority %s' % self.priority, 400)
+    self.workers = workers or SCHEDULER_WORKERS
+    self.batch = batch or DRY_RUN_SCENES
+    self.costs = {}
+    self.skipped = []
+    self.budget = None
+
+  def dryRun(self, scenes):
+    """ Returns {sceneId: cost analysis} of a batch of scenes
+    """
+    pipeline = Pipeline(getConfig().krakenApi + '/dry-run', self.token,
+                        createEvaluationRequest(scenes, self.extent,
+                                                self.mapTypes))
+    pipeline.start()
+    analysis = pipeline.join()
+    if not analysis or 'allocatedCredits' not in analysis:
+      raise SpaceKnowError('Cost analysis is not available for %s' %
+                           (scenes[0]['sceneId'] if len(scenes) == 1 else
+                            '%d scenes' % len(scenes)), 503)
+    share = {name: analysis.get(name, 0) / len(scenes) for name in COST_FIELDS}
+    return {scene['sceneId']: dict(share) for scene in scenes}
+
+  def price(self, scenes):
+    """ Cost analyses of a batch; when its dry-run fails, every scene is
+        dry-run alone so one scene which can not be priced does not drop
+        the others. Scenes which can not be priced are left out.
+    """
+    try:
+      return self.dryRun(scenes)
+    except SpaceKnowError as e:
+      spaceKnowLogger.error("Error %d during dry-run of %d scenes: %s" %
+                            (e.status_code, len(scenes), e.error))
+      if len(scenes) == 1:
+        return {}
+    costs = {}
+    for scene in scenes:
+      try:
+        costs.update(self.dryRun([scene]))
+      except SpaceKnowError as e:
+        spaceKnowLogger.error("Error %d during dry-run of scene %s: %s" %
+                              (e.status_code, scene['sceneId'], e.error))
+    return costs
+
+  def estimate(self, scenes):
+    """ Dry-runs the scenes; returns {sceneId: cost analysis}. Scenes whose
+        cost can not be estimated are left out; raises SpaceKnowError when
+        no scene can be priced.
+    """
+    validateAccessRights([getConfig().krakenDryRun], self.permissions)
+    batches = [scenes[start:start + self.batch]
+               for start in range(0, len(scenes), self.batch)]
+    with ThreadPoolExecutor(max_workers=self.workers,
+                            thread_name_prefix='DryRun') as pool:
+      for costs in pool.map(self.price, batches):
+        self.costs.update(costs)
+    if scenes and not self.costs:
+      raise SpaceKnowError('Cost analysis is not available for any of the '
+                           '%d scenes' % len(scenes), 503)
+    return self.costs
+
+  def order(self, scenes):
+    """ Scenes with a cost estimate, the highest value / cost first
+    """
+    scenes = [scene for scene in scenes if scene['sceneId'] in self.costs]
+    values = PRIORITIES[self.priority](scenes)
+
+    def score(item):
+      value, scene = item
+      cost = self.costs[scene['sceneId']]['allocatedCredits']
+      return value / cost if cost > 0 else float('inf')
+
+    return [scene for _, scene in sorted(zip(values, scenes), key=score,
+                                         reverse=True)]
+
+  def totals(self, scenes=None):
+    """ Sum of the cost analyses of the scenes (all the estimated ones by
+        default)
+    """
+    analyses = [self.costs[scene['sceneId']] for scene in scenes] \
+      if scenes is not None else list(self.costs.values())
+    return {name: sum(analysis.get(name, 0) for analysis in analyses)
+            for name in COST_FIELDS}
+
+  def checkPriced(self, mapTypes):
+    """ Raises SpaceKnowError when a map type was not in the dry-runs
+    """
+    unpriced = set(mapTypes) - set(self.mapTypes)
+    if unpriced:
+      raise SpaceKnowError('Map types %s are not in the cost estimate' %
+                           ', '.join(sorted(unpriced)), 400)
+
+  def iterRelease(self, mapType, scenes, credits, alongside=()):
+    """ Releases the maps of the scenes within `credits`, in priority order,
+        and yields every map as soon as its release resolves. At most
+        `workers` releases run ahead of the maps the consumer has taken:
+        a slow consumer holds the next releases back. Skipped scenes are in
+        self.skipped once the generator is exhausted.
+
+        The maps of the `alongside` map types (e.g. 'imagery') are released
+        at the same time as the map of every scene: jsonMap['alongside']
+        holds {mapType: Future of its map}. Their credits are reserved with
+        the scene's, so they must be in the mapTypes of the dry-runs. When
+        the release of a scene fails, its credits only go back to the
+        budget if none of its alongside maps was released: a map already
+        charged keeps the scene's credits reserved.
+
+        credits is a number of credits or a CreditBudget shared with the
+        releases of other schedulers (e.g. of other extents).
+    """
+    self.checkPriced((mapType,) + tuple(alongside))
+    self.budget = creditBudget(credits)
+    pending = collections.deque(self.order(scenes))
+    skipped, running, companions = [], {}, {}
+    with ThreadPoolExecutor(max_workers=self.workers * (1 + len(alongside)),
+                            thread_name_prefix='Release') as pool:
+      while pending or running:
+        while pending and len(running) < self.workers:
+          scene = pending.popleft()
+          cost = self.costs[scene['sceneId']]['allocatedCredits']
+          if not self.budget.reserve(cost):
+            skipped.append(scene)
+            continue
+          running[pool.submit(downloadMap, mapType, scene['sceneId'],
+                              self.extent, self.token)] = (scene, cost)
+          companions[scene['sceneId']] = {
+            other: pool.submit(downloadMap, other, scene['sceneId'],
+                               self.extent, self.token)
+            for other in alongside}
+        if not running:
+          break
+        done, _ = concurrent.futures.wait(
+          running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+          scene, cost = running.pop(future)
+          try:
+            jsonMap = future.result()
+          except Exception as e:
+            spaceKnowLogger.error("Unknown error during release of scene %s: "
+                                  "%s" % (scene['sceneId'], e))
+            jsonMap = None
+          others = companions.pop(scene['sceneId'])
+          if jsonMap:
+            if alongside:
+              jsonMap['alongside'] = others
+            yield describeScene(jsonMap, scene)
+            continue
+          # the releases already running can not be cancelled: wait for them
+          concurrent.futures.wait([other for other in others.values()
+                                   if not other.cancel()])
+          charged = [name for name, other in others.items()
+                     if released(other)]
+          if charged:
+            spaceKnowLogger.error("Scene %s: %s released without its %s map, "
+                                  "its credits stay spent" %
+                                  (scene['sceneId'], ', '.join(charged),
+                                   mapType))
+            continue
+          self.budget.refund(cost)
+          # the credits can pay for the scenes skipped before, which come
+          # first in priority order
+          pending.extendleft(reversed(skipped))
+          skipped = []
+    self.skipped = skipped
+
+  def release(self, mapType, scenes, credits):
+    """ Releases the maps of the scenes within `credits`, in priority order.
+        Returns the released maps; skipped scenes are in self.skipped.
+    """
+    released = {jsonMap['sceneId']: jsonMap for jsonMap in
+                self.iterRelease(mapType, scenes, credits)}
+    return [released[scene['sceneId']] for scene in self.order(scenes)
+            if scene['sceneId'] in released]
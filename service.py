@@ -0,0 +1,251 @@
+import geojson
+import os
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from config import getConfig, initLogging
+from flask import Flask, Response, request, jsonify
+from metrics import getMetrics
+from results import getResults, openResults
+from spaceknow import analyseArea, areaFromGeoJSON, loadArea, logger
+from tilecache import getTileCache
+from transport import getTransport
+from utils import authenticate, getPermissions, SpaceKnowError
+
+# the token of SpaceKnow is valid for 10 hours
+TOKEN_TTL = getConfig().tokenTTL
+PERMISSIONS_TTL = getConfig().permissionsTTL
+
+
+class Credentials():
+  """ Caches the bearer token and the user's permissions until they expire,
+      so jobs do not authenticate again.
+  """
+  def __init__(self, user='', password='', tokenTTL=TOKEN_TTL,
+               permissionsTTL=PERMISSIONS_TTL):
+    self.user = user or getConfig().username
+    self.password = password or getConfig().password
+    self.tokenTTL = tokenTTL
+    self.permissionsTTL = permissionsTTL
+    self._lock = threading.Lock()
+    self._token = None
+    self._tokenExpiry = 0
+    self._permissions = None
+    self._permissionsExpiry = 0
+
+  def get(self):
+    """ Returns a valid (token, permissions) pair
+    """
+    with self._lock:
+      now = time.monotonic()
+      if not self._token or now >= self._tokenExpiry:
+        token = authenticate(self.user, self.password)
+        if not token:
+          raise SpaceKnowError('Authentication failed', 401)
+        self._token, self._tokenExpiry = token, now + self.tokenTTL
+        self._permissions = None
+      if not self._permissions or now >= self._permissionsExpiry:
+        permissions = getPermissions(self._token)
+        if not permissions:
+          raise SpaceKnowError('Impossible to check permission available for '
+                               'the users', 403)
+        self._permissions = permissions
+        self._permissionsExpiry = now + self.permissionsTTL
+      return self._token, self._permissions
+
+  def renew(self, token):
+    """ New token for a token rejected by SpaceKnow, None when the user can
+        not authenticate again (see Transport.setTokenRenewer)
+    """
+    with self._lock:
+      if self._token and self._token != token:
+        # renewed by another request in the meantime
+        return self._token
+      renewed = authenticate(self.user, self.password)
+      if not renewed:
+        return None
+      self._token = renewed
+      self._tokenExpiry = time.monotonic() + self.tokenTTL
+      return renewed
+
+
+class JobManager():
+  """ Runs car-count jobs on a bounded worker pool and keeps their status.
+
+      A token rejected by SpaceKnow during a job is renewed by the
+      transport, which sends the rejected request again: the job goes on.
+      The PNG files of a job are written in outputDir/<jobId>.
+
+      Arguments:
+      credentials -- Credentials shared by every job
+      workers -- jobs running at the same time (SK_SERVICE_WORKERS)
+      maxJobs -- finished jobs kept in memory
+      outputDir -- folder of the jobs' PNG files
+  """
+  def __init__(self, credentials, workers=None, maxJobs=1000,
+               outputDir='output'):
+    self.credentials = credentials
+    self.outputDir = outputDir
+    getTransport().setTokenRenewer(credentials.renew)
+    self._pool = ThreadPoolExecutor(
+      max_workers=workers or getConfig().serviceWorkers,
+      thread_name_prefix='Job')
+    self._jobs = {}
+    self._lock = threading.Lock()
+    self._areas = {}
+    self.maxJobs = maxJobs
+
+  def area(self, filename=''):
+    """ Areas loaded from disk are parsed once
+    """
+    filename = filename or getConfig().geojsonFile
+    with self._lock:
+      if filename not in self._areas:
+        self._areas[filename] = loadArea(filename)
+      return self._areas[filename]
+
+  def submit(self, area, buildImages=False):
+    jobId = uuid.uuid4().hex
+    job = {'jobId': jobId, 'status': 'QUEUED', 'created': time.time(),
+           'started': None, 'finished': None, 'result': None, 'error': None,
+           'progress': [], 'outputDir': os.path.join(self.outputDir, jobId)
+           if buildImages else None}
+    with self._lock:
+      self._jobs[jobId] = job
+      self._trim()
+    self._pool.submit(self._run, job, area, buildImages)
+    return job
+
+  def _trim(self):
+    finished = [job for job in self._jobs.values() if job['finished']]
+    for job in sorted(finished, key=lambda job: job['finished'])[
+        :max(len(self._jobs) - self.maxJobs, 0)]:
+      del self._jobs[job['jobId']]
+
+  def _run(self, job, area, buildImages):
+    job['status'] = 'RUNNING'
+    job['started'] = time.time()
+
+    def progress(mapId, cars, tiles):
+      # partial results, visible while the job is running
+      job['progress'] = job['progress'] + [{'mapId': mapId, 'cars': cars}]
+
+    try:
+      token, permissions = self.credentials.get()
+      job['result'] = analyseArea(token, permissions, area, buildImages,
+                                  progress,
+                                  outputDir=job['outputDir'] or 'output')
+      job['status'] = 'RESOLVED'
+    except SpaceKnowError as e:
+      logger.error("Error {} in job {}: {}".format(e.status_code, job['jobId'],
+                                                   e.error))
+      job['status'] = 'FAILED'
+      job['error'] = {'status': e.status_code, 'message': e.error}
+    except Exception as e:
+      logger.error("Unknown error in job %s: %s" % (job['jobId'], e))
+      job['status'] = 'FAILED'
+      job['error'] = {'status': 500, 'message': str(e)}
+    finally:
+      job['finished'] = time.time()
+
+  def get(self, jobId):
+    with self._lock:
+      job = self._jobs.get(jobId)
+      return dict(job) if job else None
+
+  def list(self):
+    with self._lock:
+      return [{'jobId': job['jobId'], 'status': job['status']}
+              for job in self._jobs.values()]
+
+
+def createApp(jobs=None):
+  """ Flask application exposing car-count jobs:
+
+      POST /jobs -- starts a job; optional JSON body with a GeoJSON Feature
+                    ("area"), a GeoJSON file name ("filename") and
+                    "buildImages" (PNG files in the job's "outputDir").
+                    Returns 202 with the job.
+      GET /jobs -- status of every job
+      GET /jobs/<jobId> -- status, per-map progress and result of a job
+      GET /health -- connection pool, endpoint limits and tile cache
+                     counters
+      GET /metrics -- latency histograms and byte counters of every job,
+                      Prometheus text (JSON summary with ?format=json)
+      GET /counts?bbox=west,south,east,north&start=&end= -- vehicles per
+                      scene inside the box from the result store, without
+                      running detection (start, end: ISO dates)
+  """
+  initLogging()
+  if getResults() is None:
+    openResults()
+  app = Flask(__name__)
+  jobs = jobs or JobManager(Credentials())
+
+  @app.errorhandler(SpaceKnowError)
+  def spaceKnowError(e):
+    status = e.status_code if 400 <= e.status_code < 600 else 500
+    return jsonify({'errorMessage': e.error}), status
+
+  @app.route('/jobs', methods=['POST'])
+  def createJob():
+    body = request.get_json(silent=True) or {}
+    if 'area' in body:
+      area = areaFromGeoJSON(geojson.loads(geojson.dumps(body['area'])))
+    else:
+      area = jobs.area(body.get('filename', ''))
+    job = jobs.submit(area, bool(body.get('buildImages', False)))
+    return jsonify(job), 202
+
+  @app.route('/jobs', methods=['GET'])
+  def listJobs():
+    return jsonify(jobs.list())
+
+  @app.route('/jobs/<jobId>', methods=['GET'])
+  def getJob(jobId):
+    job = jobs.get(jobId)
+    if not job:
+      return jsonify({'errorMessage': 'Unknown job'}), 404
+    return jsonify(job)
+
+  @app.route('/health', methods=['GET'])
+  def health():
+    cache = getTileCache()
+    transport = getTransport()
+    return jsonify({'transport': transport.stats.asdict(),
+                    'endpoints': transport.endpoints.asdict()
+                    if transport.endpoints else None,
+                    'tileCache': cache.stats() if cache else None})
+
+  @app.route('/counts', methods=['GET'])
+  def counts():
+    results = getResults()
+    if results is None:
+      raise SpaceKnowError('The result store is disabled (SK_RESULTS)', 404)
+    try:
+      box = tuple(float(value) for value in
+                  request.args.get('bbox', '').split(','))
+      if len(box) != 4:
+        raise ValueError('bbox needs west,south,east,north')
+      rows = results.counts(box, request.args.get('start'),
+                            request.args.get('end'))
+    except ValueError as e:
+      raise SpaceKnowError('Invalid query: %s' % e, 400)
+    return jsonify([dict(zip(rows.dtype.names, row)) for row in rows.tolist()])
+
+  @app.route('/metrics', methods=['GET'])
+  def metrics():
+    if request.args.get('format') == 'json':
+      return jsonify(getMetrics().summary())
+    return Response(getMetrics().toPrometheus(),
+                    mimetype='text/plain; version=0.0.4')
+
+  return app
+
+
+if __name__ == "__main__":
+  createApp().run(host=getConfig().serviceHost,
+                  port=getConfig().servicePort,
+                  threaded=True)
@@ -1,78 +1,95 @@
-import geojson
 import json
-import kraken
 import logging
-import logging.config
-import os
-import requests
-import time
-import utils
 import sys
 
-from dotenv import load_dotenv
-from flask import Flask, request, jsonify
-from functools import wraps
-from geojson import GeometryCollection
-from json import JSONDecodeError
-from kraken import KrakenManager
+from config import getConfig, initLogging
+from manifest import closeManifest, openManifest
+from metrics import startInstrumentation, stopInstrumentation
 from pipeline import Pipeline
-from requests.exceptions import ConnectionError
+from tilecache import getTileCache
 from utils import authenticate, getPermissions, process, SpaceKnowError, \
   validateAccessRights, buildPermission
 
-logging.config.fileConfig('logging.conf')
+# kraken, scheduler (NumPy) and geojson are imported by the functions which
+# use them, so the entry point and the modules importing the helpers of this
+# one start without them
 logger = logging.getLogger('Main')
 
-def createBrisbaneArea(filename = ''):
+def areaFromGeoJSON(geoObj):
+  """ Builds the area of the analysis from a GeoJSON Feature
+  """
+  from geojson import GeometryCollection
+  if not geoObj.is_valid or 'geometry' not in geoObj:
+    raise SpaceKnowError('Invalid GeoJson file!', 400)
+  area = GeometryCollection([geoObj['geometry']])
+  if not area.is_valid:
+    raise SpaceKnowError("Invalid GeoJson Object", 400)
+  return area
+
+def loadArea(filename = ''):
+  """ Loads the area of the analysis from a GeoJSON file.
+      Raises SpaceKnowError if the file is missing or invalid.
+  """
+  import geojson
+  if not filename or len(filename) == 0:
+    filename = getConfig().geojsonFile
   try:
-    if not filename or len(filename) == 0:
-      filename = os.getenv('GEOJSON_FILE')
     with open(filename) as fp:
-      geoObj = geojson.load(fp)
-      if not geoObj.is_valid:
-        raise SpaceKnowError('Invalid GeoJson file!', 400)
-      brisbaneArea = GeometryCollection([geoObj['geometry']])
-      if not brisbaneArea.is_valid:
-        raise SpaceKnowError("Invalid GeoJson Object", 400)
-      return brisbaneArea
+      return areaFromGeoJSON(geojson.load(fp))
   except FileNotFoundError:
-    logger.error("Error: file %s not found" % os.getenv('GEOJSON_FILE'))
+    raise SpaceKnowError("File %s not found" % filename, 404)
+
+def createBrisbaneArea(filename = ''):
+  try:
+    return loadArea(filename)
+  except SpaceKnowError as e:
+    if e.status_code != 404:
+      raise e
+    logger.error("Error: file %s not found" % (filename or
+                                               getConfig().geojsonFile))
     exit()
 
-def prepare_searchReq(area):
-  data = {'provider':os.getenv('PROVIDER_GBDX'),
-          'dataset': os.getenv('GBDX_IDAHO_DB'),
-          'startDatetime': '2018-01-01 00:00:00',
-          'endDatetime': '2018-01-31 23:59:59',
+SEARCH_START = '2018-01-01 00:00:00'
+SEARCH_END = '2018-01-31 23:59:59'
+
+def prepare_searchReq(area, startDatetime=SEARCH_START,
+                      endDatetime=SEARCH_END):
+  config = getConfig()
+  data = {'provider': config.provider,
+          'dataset': config.dataset,
+          'startDatetime': startDatetime,
+          'endDatetime': endDatetime,
           'onlyDownloadable': True,
           'extent': area}
   return json.dumps(data)
 
-def createEvaluationRequest(scenes, extent):
-  scenesID = [{ 'sceneId': s['sceneId'] for s in scenes }]
-  mapTypes = ['cars']
-  dryRunObj = {'scenes': scenesID,
-               'mapTypes': mapTypes}
-  dryRunsList = [dryRunObj]
-  evRequest = {'dryRuns': dryRunsList,
-             'extent': extent}
-  return json.dumps(evRequest)
-
-def searchImagery(permissions, token, extent):
-  validateAccessRights([os.getenv('IMG_AVAILABILITY')], permissions)
-  url = utils.SK_IMAGE_API + '/search'
-  pipeline = Pipeline(url, token, prepare_searchReq(extent))
+def searchScenes(permissions, token, extent, startDatetime=SEARCH_START,
+                 endDatetime=SEARCH_END):
+  """ Scenes of the extent acquired between startDatetime and endDatetime,
+      an empty list when there are none
+  """
+  validateAccessRights([getConfig().imgAvailability], permissions)
+  url = getConfig().imageApi + '/search'
+  pipeline = Pipeline(url, token, prepare_searchReq(extent, startDatetime,
+                                                    endDatetime))
   pipeline.start()
   logger.info("Created Pipeline. Waiting for results...")
   response = pipeline.join()
-  if not response or 'results' not in response or len(response['results'])==0:
-    raise SpaceKnowError('Any imagery found in the response', 500)
+  if not response or 'results' not in response:
+    return []
   return response['results']
+
+def searchImagery(permissions, token, extent):
+  scenes = searchScenes(permissions, token, extent)
+  if len(scenes) == 0:
+    raise SpaceKnowError('Any imagery found in the response', 500)
+  return scenes
   
 def evaluatesCosts(scenes, extent, permissions, token):
-  validateAccessRights([os.getenv('KRAKEN_DRY_RUN')], permissions)
+  from kraken import createEvaluationRequest
+  validateAccessRights([getConfig().krakenDryRun], permissions)
   data = createEvaluationRequest(scenes, extent)
-  url = utils.SK_KRAKEN_API + '/dry-run'
+  url = getConfig().krakenApi + '/dry-run'
   pipeline = Pipeline(url, token, data)
   pipeline.start()
   logger.info("Created Pipeline. Waiting for results...")
@@ -82,34 +99,41 @@ def evaluatesCosts(scenes, extent, permissions, token):
   return analysis
 
 def getCreditsAvailable(token, permissions):
-  validateAccessRights([os.getenv('CREDITS_AVAILABLE')], permissions)
-  url = utils.SK_CREDIT_API + '/get-remaining-credit'
+  validateAccessRights([getConfig().creditsAvailable], permissions)
+  url = getConfig().creditApi + '/get-remaining-credit'
   response = process(url=url, token=token)
   if 'remainingCredit' not in response:
     raise SpaceKnowError('Invalid response from server', 500)
   return response['remainingCredit']
 
-def downloadCarImagery(scenes, token, permissions, extent):
-  permissionsNeeds = [os.getenv('KRAKEN_RELEASE'),
-                      buildPermission(os.getenv('IMAGERY_IMAGES'),
-                                      os.getenv('PROVIDER_GBDX'),
-                                      os.getenv('GBDX_IDAHO_DB'))]
-  validateAccessRights(permissionsNeeds, permissions)
+def releasePermissions():
+  config = getConfig()
+  return [config.krakenRelease,
+          buildPermission(config.imageryImages, config.provider,
+                          config.dataset)]
+
+def downloadCarImagery(scenes, token, permissions, extent, scheduler=None,
+                       credits=None):
+  """ Releases the cars maps of the scenes. With a CreditScheduler, only
+      the scenes which fit in `credits` are released, the most valuable
+      first.
+  """
+  validateAccessRights(releasePermissions(), permissions)
+  if scheduler is not None:
+    return scheduler.release('cars', scenes, credits)
+  import kraken
   return kraken.downloadMaps('cars', scenes, token, extent)
 
 def downloadImagery(scenes, token, permissions, extent):
-  permissionsNeeds = [os.getenv('KRAKEN_RELEASE'),
-                      buildPermission(os.getenv('IMAGERY_IMAGES'),
-                                      os.getenv('PROVIDER_GBDX'),
-                                      os.getenv('GBDX_IDAHO_DB'))]
-  validateAccessRights(permissionsNeeds, permissions)
+  import kraken
+  validateAccessRights(releasePermissions(), permissions)
   return kraken.downloadMaps('imagery', scenes, token, extent)
 
 def getConfigurations(user='', password=''):
   if not user or len(user)==0:
-    user = os.getenv('USERNAME')
+    user = getConfig().username
   if not password or len(password)==0:
-    password = os.getenv('PASSWORD')
+    password = getConfig().password
   
   token = authenticate(user, password)
   if not token or  len(token) == 0:
@@ -118,7 +142,26 @@ def getConfigurations(user='', password=''):
   logger.info("Congratulations, you are in SpaceKnow!")
   return token
 
-def runCarDetections(user='', password='', filename=''):
+def runCarDetections(user='', password='', filename='', engine=''):
+  """ Counts the cars inside the area.
+      engine -- 'threads' (default), 'async' to drive the whole flow from
+                one event loop or 'distributed' to run releases and
+                detection on the workers of SK_QUEUE (SK_ENGINE)
+      The metrics of the run are exported at the end (SK_METRICS, and
+      SK_PROFILE, SK_TRACE when profiling or tracing)
+  """
+  from results import closeResults, openResults
+  initLogging()
+  startInstrumentation()
+  openResults()
+  try:
+    _runCarDetections(user, password, filename, engine)
+  finally:
+    closeResults()
+    stopInstrumentation()
+
+def _runCarDetections(user, password, filename, engine):
+  engine = engine or getConfig().engine
   logger.info("Authenticating at SpaceKnowAPI...")
   token = getConfigurations(user, password)
   permissions = getPermissions(token)
@@ -127,57 +170,194 @@ def runCarDetections(user='', password='', filename=''):
     exit()
   logger.info("Selecting Brisbane Airport Area for the analysis...")
   area = createBrisbaneArea(filename)
+  queue = None
+  if engine == 'distributed':
+    from workqueue import openQueue
+    queue = openQueue()
+  openManifest()
   try:
-    logger.info("Downloading imagery for Staff Parking Lot...")
-    scenes =  searchImagery(permissions, token, area)
-    logger.info("Downloaded %d scenes"% len(scenes))
-    logger.info("Making cost analysis on all scenes...")
-    costAnalysis = evaluatesCosts(scenes, area, permissions, token)
-    logger.info("Brisbane Area total size: %.4f km2" % costAnalysis['ingestedKm2'])
-    logger.info("Brisbane Area size to analyze: %.4f km2" % costAnalysis['analyzedKm2'])
-    logger.info("Brisbane Area allocated size: %.4f km2" % costAnalysis['allocatedKm2'])
-    logger.info("Credits required: %.4f" % costAnalysis['allocatedCredits'])
-    userCredits = getCreditsAvailable(token, permissions)
-    if userCredits < costAnalysis['allocatedCredits'] :
-      logger.info("Impossible to make analysis!\n The user %s does not have enough"
-            " credits.\n Available credits: %.2f" % (os.getenv('USERNAME'), 
-            userCredits))
-      exit()
-   
-    logger.info("My credits: %.2f" % userCredits)
-    logger.info("Downloading Imagery Maps...")
-    carMaps = downloadCarImagery(scenes, token, permissions, area)
-    logger.info("Downloaded %d imageries" % len(carMaps))
-    krakenManager = KrakenManager()
-    logger.info("Detecting cars inside imageries...")
-    results = krakenManager.process(carMaps, 'CAR_DETECTION')
-    if len(results) == 0:
-      logger.info("No cars was found in this area!")
-      exit()
-    total = 0
-    for mapId, pair in results.items():
-      cars = pair[0]
-      tiles = pair[1]
-      total += cars
-      logger.info("Found %d cars for mapId %s"% (cars, mapId[-10:]))
-      logger.info("Building PNG file for mapId %s" % mapId[-10:])
-      krakenManager.build_image(mapId, tiles, 'BUILD_CARS_PNG')
-      logger.info("Created image %s_detection.png"%mapId[-10:])
-
-    logger.info("Found %d cars in total" % total)
-    
-    logger.info("Downloading all analyzed imageries...")
-    imageryMaps = downloadImagery(scenes, token, permissions, area)
-    logger.info("Downloaded %d imageries" % len(imageryMaps))
-    logger.info("Building satellite images...")
-    krakenManager.process(imageryMaps, 'BUILD_PNG')
-    logger.info("All satellite images are ready!")
+    if engine == 'async':
+      import asyncio
+      import aiospaceknow
+      result = asyncio.run(aiospaceknow.analyseAreaAsync(token, permissions,
+                                                         area))
+    else:
+      result = analyseArea(token, permissions, area, queue=queue)
+    closeManifest(completed=True)
+    if result['total'] == 0:
+      return
     logger.info("Summary: \n Cars in the area: %d \n All satellite and tiles images" 
-      " are in output folder!" % total)
+      " are in output folder!" % result['total'])
+    logger.info("Run store: %(reused)d prefetched tiles reused by the "
+                "builds (%(bytesReused)d bytes), %(dropped)d dropped" %
+                result['runStore'])
+    logger.info("Area filter: %(tiles)d tiles out of the area skipped "
+                "(~%(bytes)d bytes)" % result['outsideArea'])
+    if getTileCache():
+      logger.info("Tile cache: %(hits)d hits, %(misses)d misses, "
+                  "%(bytesSaved)d bytes saved" % getTileCache().stats())
   except SpaceKnowError as e:
     logger.error("Error {}: {}".format(str(e.status_code), e.error))
     logger.info("Error during the processing check spaceknow.log for details")
     exit()
+  finally:
+    if queue is not None:
+      queue.close()
+
+def analyseArea(token, permissions, area, buildImages=True, callback=None,
+                queue=None, outputDir='output'):
+  """ Counts the cars inside the area with an authenticated user.
+      Raises SpaceKnowError when the analysis can not be done.
+
+      The cars and imagery maps of every scene are released together;
+      every map is detected (and its PNG files built) as soon as its
+      release resolves, and the imagery PNG only covers the tiles around
+      the cars (SK_IMAGERY_MARGIN). callback(mapId, cars, tiles), if any,
+      gets the result of every map as soon as it is ready. The PNG files
+      are written in outputDir.
+
+      With a work queue (see workqueue.py), the releases and the car
+      detection run on its workers and no PNG file is built.
+
+      Returns a dict with:
+      - total: cars found by every map
+      - unique: vehicles after merging the duplicates of overlapping scenes
+      - inArea: vehicles inside the area
+      - maps: per-map totals (mapId, total, cars, trucks)
+      - runStore: report of the prefetched tiles reused during the run
+      - outsideArea: tiles out of the area skipped and bytes avoided
+      - failedTiles: tiles of the work queue's shard jobs which failed
+        every attempt, so their cars are missing from the counts
+  """
+  from kraken import KrakenManager
+  logger.info("Downloading imagery for Staff Parking Lot...")
+  scenes =  searchImagery(permissions, token, area)
+  logger.info("Downloaded %d scenes"% len(scenes))
+  if queue is not None:
+    buildImages = False
+  scheduler, budget = planRun(token, permissions, area, scenes, buildImages)
+  operations = runOperations(buildImages)
+  logger.info("Downloading Imagery Maps and detecting cars...")
+  # tiles out of the area of this run's maps, see kraken.pruneTiles
+  skippedTiles = {'cars': 0, 'imagery': 0}
+  companions = []
+  if queue is not None:
+    from workqueue import Coordinator
+    krakenManager = Coordinator(queue, area)
+    released = krakenManager.released
+    maps = krakenManager.stream(scheduler, scenes, budget, callback)
+  else:
+    krakenManager = KrakenManager(operations=operations, outputDir=outputDir)
+    released = []
+
+    def carMaps():
+      alongside = ('imagery',) if buildImages else ()
+      for carMap in scheduler.iterRelease('cars', scenes, budget, alongside):
+        released.append(carMap['sceneId'])
+        skippedTiles['cars'] += carMap['skippedTiles']
+        companions.extend(carMap.get('alongside', {}).values())
+        yield carMap
+
+    maps = krakenManager.stream(carMaps(), operations, callback)
+
+  total = 0
+  for mapId, cars, tiles in maps:
+    total += cars
+    logFound(mapId, cars, buildImages)
+  if queue is not None:
+    skippedTiles['cars'] = krakenManager.skippedTiles
+  failedTiles = krakenManager.failedTiles if queue is not None else 0
+  return reportRun(krakenManager, area, scheduler, budget, released, total,
+                   skippedTiles, companions, failedTiles, buildImages)
+
+def planRun(token, permissions, area, scenes, buildImages):
+  """ Prices the scenes and returns the CreditScheduler of the run with the
+      credits it can spend: the credits of the user, capped by
+      SK_CREDIT_BUDGET. The imagery released alongside the cars, when PNG
+      files are built, is paid from the same budget.
+  """
+  from scheduler import CreditScheduler
+  logger.info("Making cost analysis on every scene...")
+  scheduler = CreditScheduler(token, permissions, area,
+                              mapTypes=('cars', 'imagery') if buildImages
+                              else ('cars',))
+  scheduler.estimate(scenes)
+  costAnalysis = scheduler.totals()
+  logger.info("Brisbane Area total size: %.4f km2" % costAnalysis['ingestedKm2'])
+  logger.info("Brisbane Area size to analyze: %.4f km2" % costAnalysis['analyzedKm2'])
+  logger.info("Brisbane Area allocated size: %.4f km2" % costAnalysis['allocatedKm2'])
+  logger.info("Credits required: %.4f" % costAnalysis['allocatedCredits'])
+  userCredits = getCreditsAvailable(token, permissions)
+  logger.info("My credits: %.2f" % userCredits)
+  budget = userCredits
+  if getConfig().creditBudget is not None:
+    budget = min(budget, getConfig().creditBudget)
+  validateAccessRights(releasePermissions(), permissions)
+  return scheduler, budget
+
+def runOperations(buildImages):
+  return ['CAR_DETECTION', 'BUILD_CARS_PNG', 'BUILD_PNG'] if buildImages \
+    else ['CAR_DETECTION']
+
+def logFound(mapId, cars, buildImages):
+  if cars > 0:
+    logger.info("Found %d cars for mapId %s"% (cars, mapId[-10:]))
+    if buildImages:
+      logger.info("Created image %s_detection.png"%mapId[-10:])
+
+def reportRun(krakenManager, area, scheduler, budget, released, total,
+              skippedTiles, companions, failedTiles, buildImages):
+  """ Result of analyseArea from the manager of the run (KrakenManager or
+      any object with its index, summary, store and built)
+  """
+  from kraken import skippedReport
+  for future in companions:
+    if future.done() and not future.cancelled() and \
+      future.exception() is None and future.result():
+      skippedTiles['imagery'] += future.result()['skippedTiles']
+  if scheduler.skipped:
+    logger.info("Skipped %d scenes over the budget of %.2f credits" %
+                (len(scheduler.skipped), budget))
+  if len(released) == 0 and scheduler.skipped:
+    raise SpaceKnowError("Impossible to make analysis! The user does not have "
+                         "enough credits. Available credits: %.2f" %
+                         budget, 402)
+  logger.info("Downloaded %d imageries (%.2f credits)" %
+              (len(released), scheduler.budget.spent))
+  if failedTiles:
+    logger.error("%d tiles could not be analysed: the counts are partial" %
+                 failedTiles)
+  result = {'total': 0, 'unique': 0, 'inArea': 0, 'maps': [],
+            'runStore': krakenManager.store.report(),
+            'outsideArea': skippedReport(skippedTiles),
+            'failedTiles': failedTiles}
+  if total == 0:
+    logger.info("No cars was found in this area!")
+    return result
+
+  logger.info("Found %d cars in total" % total)
+  index = krakenManager.index
+  logger.info("Found %d vehicles after merging %d duplicates of overlapping "
+              "scenes, %d inside the area" % (index.total, index.merged,
+                                               index.countIn(area)))
+  summary = krakenManager.summary()
+  for row in summary:
+    logger.info("mapId %s: %d cars, %d trucks" % (row['mapId'][-10:],
+                                                 row['cars'], row['trucks']))
+  
+  if buildImages:
+    built = sum(1 for operation, _ in krakenManager.built
+                if operation == 'BUILD_PNG')
+    logger.info("Built %d satellite images around the cars" % built)
+  result.update({'total': total,
+                 'unique': index.total,
+                 'inArea': index.countIn(area),
+                 'maps': [{'mapId': row['mapId'], 'total': int(row['total']),
+                           'cars': int(row['cars']),
+                           'trucks': int(row['trucks'])} for row in summary],
+                 'runStore': krakenManager.store.report(),
+                 'outsideArea': skippedReport(skippedTiles)})
+  return result
 
 if __name__ == "__main__":
   
@@ -0,0 +1,173 @@
+import math
+import numpy as np
+import threading
+
+from config import getConfig
+from detections import DETECTION_CLASSES
+from geo import bbox, pointsInGeometry
+
+METERS_PER_DEGREE = 111320.0
+
+
+class DetectionIndex():
+  """ Incremental grid-hash index of the detections of many scenes.
+
+      Detections are hashed on square cells of cellMeters side (a local
+      equirectangular projection around the first detection). When a new
+      detection of the same class lies within `distance` meters and
+      `seconds` of an indexed one, the two are merged (the highest count is
+      kept), so vehicles seen by overlapping scenes or tiles are counted once.
+      Scenes can be added at any time without rebuilding the index.
+
+      Arguments:
+      distance -- merge distance in meters (SK_DEDUP_METERS)
+      seconds -- merge time tolerance in seconds (SK_DEDUP_SECONDS)
+      cellMeters -- side of a grid cell, at least `distance`
+  """
+  def __init__(self, distance=None, seconds=None, cellMeters=None):
+    self.distance = distance if distance is not None else \
+      getConfig().dedupMeters
+    self.seconds = seconds if seconds is not None else \
+      getConfig().dedupSeconds
+    self.cellMeters = max(cellMeters or 4 * self.distance, self.distance, 1e-6)
+    self._lock = threading.Lock()
+    self._cells = {}
+    self._size = 0
+    self._refLat = None
+    capacity = 1024
+    self.lon = np.zeros(capacity, dtype=np.float64)
+    self.lat = np.zeros(capacity, dtype=np.float64)
+    self.count = np.zeros(capacity, dtype=np.int32)
+    self.cls = np.zeros(capacity, dtype=np.int8)
+    self.time = np.zeros(capacity, dtype=np.float64)
+    self.mapIds = []
+    self.merged = 0
+
+  def __len__(self):
+    return self._size
+
+  def _grow(self, needed):
+    capacity = len(self.lon)
+    if needed <= capacity:
+      return
+    while capacity < needed:
+      capacity *= 2
+    for name in ('lon', 'lat', 'count', 'cls', 'time'):
+      column = getattr(self, name)
+      grown = np.zeros(capacity, dtype=column.dtype)
+      grown[:self._size] = column[:self._size]
+      setattr(self, name, grown)
+
+  def _project(self, lon, lat):
+    scale = METERS_PER_DEGREE * math.cos(math.radians(self._refLat))
+    return lon * scale, lat * METERS_PER_DEGREE
+
+  def _cell(self, x, y):
+    return int(math.floor(x / self.cellMeters)), \
+      int(math.floor(y / self.cellMeters))
+
+  def add(self, detections, timestamp=0.0, mapId=None):
+    """ Indexes a DetectionTable taken at timestamp (seconds).
+        Returns the number of vehicles not already indexed.
+    """
+    valid = ~(np.isnan(detections.lon) | np.isnan(detections.lat))
+    added = 0
+    with self._lock:
+      if self._refLat is None and valid.any():
+        self._refLat = float(detections.lat[valid][0])
+      self._grow(self._size + int(valid.sum()))
+      xs, ys = self._project(detections.lon, detections.lat) if valid.any() \
+        else (detections.lon, detections.lat)
+      for i in np.flatnonzero(valid):
+        duplicate = self._nearest(xs[i], ys[i], detections.cls[i], timestamp)
+        if duplicate is not None:
+          previous = int(self.count[duplicate])
+          self.count[duplicate] = max(previous, int(detections.count[i]))
+          added += int(self.count[duplicate]) - previous
+          self.merged += 1
+          continue
+        index = self._size
+        self.lon[index] = detections.lon[i]
+        self.lat[index] = detections.lat[i]
+        self.count[index] = detections.count[i]
+        self.cls[index] = detections.cls[i]
+        self.time[index] = timestamp
+        self.mapIds.append(mapId)
+        self._cells.setdefault(self._cell(xs[i], ys[i]), []).append(index)
+        self._size += 1
+        added += int(detections.count[i])
+    return added
+
+  def _nearest(self, x, y, cls, timestamp):
+    cx, cy = self._cell(x, y)
+    best, bestDistance = None, self.distance
+    for dx in (-1, 0, 1):
+      for dy in (-1, 0, 1):
+        for index in self._cells.get((cx + dx, cy + dy), ()):
+          if self.cls[index] != cls or \
+            abs(self.time[index] - timestamp) > self.seconds:
+            continue
+          ox, oy = self._project(self.lon[index], self.lat[index])
+          distance = math.hypot(ox - x, oy - y)
+          if distance <= bestDistance:
+            best, bestDistance = index, distance
+    return best
+
+  @property
+  def total(self):
+    return int(self.count[:self._size].sum())
+
+  def classCounts(self, indexes=None):
+    if indexes is None:
+      indexes = np.arange(self._size)
+    totals = np.bincount(self.cls[indexes], weights=self.count[indexes],
+                         minlength=len(DETECTION_CLASSES)).astype(np.int64)
+    return dict(zip(DETECTION_CLASSES, totals.tolist()))
+
+  def queryBBox(self, west, south, east, north):
+    """ Indexes of the detections inside the bounding box
+    """
+    if self._size == 0:
+      return np.zeros(0, dtype=np.int64)
+    with self._lock:
+      x0, y0 = self._project(west, south)
+      x1, y1 = self._project(east, north)
+      (cx0, cy0), (cx1, cy1) = self._cell(x0, y0), self._cell(x1, y1)
+      if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(self._cells):
+        candidates = np.arange(self._size)
+      else:
+        candidates = np.array([index for cx in range(cx0, cx1 + 1)
+                               for cy in range(cy0, cy1 + 1)
+                               for index in self._cells.get((cx, cy), ())],
+                              dtype=np.int64)
+      if len(candidates) == 0:
+        return candidates
+      lon, lat = self.lon[candidates], self.lat[candidates]
+      inside = (lon >= west) & (lon <= east) & (lat >= south) & (lat <= north)
+      return np.sort(candidates[inside])
+
+  def queryPoint(self, lon, lat, radius):
+    """ Indexes of the detections within radius meters of (lon, lat)
+    """
+    if self._size == 0:
+      return np.zeros(0, dtype=np.int64)
+    dLat = radius / METERS_PER_DEGREE
+    dLon = dLat / max(math.cos(math.radians(lat)), 1e-6)
+    candidates = self.queryBBox(lon - dLon, lat - dLat, lon + dLon, lat + dLat)
+    x, y = self._project(lon, lat)
+    xs, ys = self._project(self.lon[candidates], self.lat[candidates])
+    return candidates[np.hypot(xs - x, ys - y) <= radius]
+
+  def queryGeometry(self, geometry):
+    """ Indexes of the detections inside a GeoJSON area, e.g. the one of
+        spaceknow.createBrisbaneArea
+    """
+    candidates = self.queryBBox(*bbox(geometry))
+    if len(candidates) == 0:
+      return candidates
+    return candidates[pointsInGeometry(self.lon[candidates],
+                                       self.lat[candidates], geometry)]
+
+  def countIn(self, geometry):
+    indexes = self.queryGeometry(geometry)
+    return int(self.count[indexes].sum())
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+import batch
+import scheduler
+from batch import BatchJob, BatchRunner, splitWindows
+from config import getConfig
+from detections import DETECTION_CLASSES
+from utils import SpaceKnowError
+
+
+def area(lon):
+  return {'type': 'GeometryCollection', 'geometries': [
+    {'type': 'Polygon', 'coordinates': [[[lon, 0], [lon + 1, 0], [lon + 1, 1],
+                                         [lon, 1], [lon, 0]]]}]}
+
+
+@pytest.fixture
+def account(monkeypatch):
+  """ SpaceKnow account with 3 scenes found by both jobs, 2 credits each
+  """
+  scenes = [{'sceneId': 'scene-%d' % index,
+             'datetime': '2018-01-%02d 00:00:00' % (index + 1)}
+            for index in range(3)]
+  released = []
+
+  def dryRun(self, batchScenes):
+    return {scene['sceneId']: {'allocatedCredits': 2.0}
+            for scene in batchScenes}
+
+  def downloadMap(mapType, sceneId, extent, token):
+    released.append(sceneId)
+    return {'mapId': 'map-' + sceneId, 'skippedTiles': 0}
+
+  def release(self, jsonMap, jobs, indexes):
+    counts = np.ones(len(DETECTION_CLASSES), dtype=np.int64)
+    return [(jobs[index], counts) for index in sorted(indexes)]
+
+  monkeypatch.setattr(batch, 'searchScenes', lambda *args: scenes)
+  monkeypatch.setattr(batch, 'getCreditsAvailable', lambda *args: 5.0)
+  monkeypatch.setattr(batch, 'validateAccessRights', lambda *args: None)
+  monkeypatch.setattr(scheduler, 'validateAccessRights', lambda *args: None)
+  monkeypatch.setattr(scheduler.CreditScheduler, 'dryRun', dryRun)
+  monkeypatch.setattr(scheduler, 'downloadMap', downloadMap)
+  monkeypatch.setattr(BatchRunner, 'release', release)
+  monkeypatch.setattr(getConfig(), 'creditBudget', None)
+  return released
+
+
+def test_split_windows():
+  assert splitWindows('2018-01-01', '2018-01-05', days=2) == [
+    ('2018-01-01 00:00:00', '2018-01-02 23:59:59'),
+    ('2018-01-03 00:00:00', '2018-01-04 23:59:59'),
+    ('2018-01-05 00:00:00', '2018-01-05 00:00:00')]
+  with pytest.raises(SpaceKnowError):
+    splitWindows('2018-01-05', '2018-01-01')
+
+
+def test_scenes_over_the_budget_are_skipped(account):
+  runner = BatchRunner('token', [], workers=2)
+  jobs = [BatchJob('a', area(0), '2018-01-01', '2018-01-31'),
+          BatchJob('b', area(10), '2018-01-01', '2018-01-31')]
+  series = runner.run(jobs)
+  # the newest scenes first while the 5 credits cover them
+  assert sorted(account) == ['scene-1', 'scene-2']
+  assert [scene['sceneId'] for scene in runner.skipped] == ['scene-0']
+  assert runner.releases == 2
+  assert sorted(zip(series['area'], series['sceneId'])) == [
+    ('a', 'scene-1'), ('a', 'scene-2'), ('b', 'scene-1'), ('b', 'scene-2')]
+
+
+def test_no_scene_within_the_budget(account, monkeypatch):
+  monkeypatch.setattr(batch, 'getCreditsAvailable', lambda *args: 1.0)
+  runner = BatchRunner('token', [])
+  with pytest.raises(SpaceKnowError) as error:
+    runner.run([BatchJob('a', area(0), '2018-01-01', '2018-01-31')])
+  assert error.value.status_code == 402
+  assert account == []
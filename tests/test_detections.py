@@ -0,0 +1,72 @@
+import json
+
+import numpy as np
+import pytest
+
+from detections import DetectionTable, summarise
+from tileset import TileSet
+from utils import SpaceKnowError
+
+TILES = [[19, 100, 200], [19, 101, 200], [19, 100, 201]]
+
+
+def feature(count, cls='cars', geometry=None):
+  return {'properties': {'count': count, 'class': cls},
+          'geometry': geometry or {'type': 'Point', 'coordinates': [1.0, 2.0]}}
+
+
+def analysis():
+  square = {'type': 'Polygon',
+            'coordinates': [[[0, 0], [2, 0], [2, 2], [0, 2], [0, 0]]]}
+  return {'19_100_200': [feature(3), feature(1, 'trucks', square)],
+          '19_100_201': [feature(2, 'boats', {'type': 'Unknown'})]}
+
+
+def test_from_analysis():
+  table = DetectionTable.fromAnalysis(TILES, analysis())
+  assert len(table) == 3
+  assert table.total == 6
+  assert table.tileCounts().tolist() == [4, 0, 2]
+  assert table.tilesWithDetections().tolist() == [0, 2]
+  # unknown classes are counted as other
+  assert table.classCounts() == {'cars': 3, 'trucks': 1, 'other': 2}
+  # the closing vertex of a polygon is not part of its centroid
+  assert (table.lon[1], table.lat[1]) == (1.0, 1.0)
+  assert np.isnan(table.lon[2])
+  assert table.densityGrid().tolist() == [[4, 0], [2, 0]]
+  assert table.densityGrid('trucks').tolist() == [[1, 0], [0, 0]]
+
+
+def test_invalid_feature():
+  with pytest.raises(SpaceKnowError):
+    DetectionTable.fromAnalysis(TILES, {'19_100_200': [{'geometry': None}]})
+
+
+def test_dict_round_trip():
+  table = DetectionTable.fromAnalysis(TILES, analysis())
+  columns = json.loads(json.dumps(table.asdict()))
+  assert columns['lon'][2] is None
+  copy = DetectionTable.fromdict(columns)
+  assert (copy.tiles == table.tiles).all()
+  assert copy.tileClassCounts().tolist() == table.tileClassCounts().tolist()
+  assert np.isnan(copy.lon[2])
+
+
+def test_concatenate_shards():
+  tiles = TileSet.fromList(TILES)
+  shards = [DetectionTable.fromAnalysis([TILES[2], TILES[0]], analysis()),
+            DetectionTable.fromAnalysis([TILES[1]], {}),
+            DetectionTable.fromAnalysis([TILES[1]], {'19_101_200':
+                                                     [feature(5)]})]
+  table = DetectionTable.concatenate(tiles, shards)
+  expected = DetectionTable.fromAnalysis(tiles, analysis()).tileCounts()
+  assert table.tileCounts().tolist() == (expected + [0, 5, 0]).tolist()
+  assert len(DetectionTable.concatenate(tiles, [])) == 0
+
+
+def test_summarise():
+  summary = summarise({'map-0': DetectionTable.fromAnalysis(TILES, analysis()),
+                       'map-1': DetectionTable.fromAnalysis(TILES, {})})
+  assert summary['mapId'].tolist() == ['map-0', 'map-1']
+  assert summary['total'].tolist() == [6, 0]
+  assert summary['other'].tolist() == [2, 0]
@@ -0,0 +1,75 @@
+import numpy as np
+
+from geo import lonLatToTile, tileBounds, tilesInGeometry
+
+ZOOM = 16
+
+
+def square(west, south, east, north):
+  return {'type': 'Polygon',
+          'coordinates': [[[west, south], [east, south], [east, north],
+                           [west, north], [west, south]]]}
+
+
+def tileAt(lon, lat, z=ZOOM):
+  x, y = lonLatToTile(lon, lat, z)
+  return [z, int(x), int(y)]
+
+
+def test_tileBounds_contain_their_points():
+  z, x, y = tileAt(153.1, -27.39)
+  west, south, east, north = tileBounds(z, x, y)
+  assert west <= 153.1 <= east
+  assert south <= -27.39 <= north
+
+
+def test_tiles_inside_and_outside():
+  area = square(153.09, -27.40, 153.11, -27.38)
+  inside = tileAt(153.10, -27.39)
+  outside = tileAt(153.20, -27.39)
+  mask = tilesInGeometry([inside, outside], area)
+  assert mask.tolist() == [True, False]
+
+
+def test_tile_crossing_the_border_is_kept():
+  area = square(153.09, -27.40, 153.11, -27.38)
+  z, x, y = tileAt(153.11, -27.39)
+  west, south, east, north = tileBounds(z, x, y)
+  assert west < 153.11 < east
+  assert tilesInGeometry([[z, x, y]], area).tolist() == [True]
+
+
+def test_area_inside_one_tile():
+  z, x, y = tileAt(153.1, -27.39)
+  west, south, east, north = tileBounds(z, x, y)
+  width, height = east - west, north - south
+  area = square(west + width / 4, south + height / 4, east - width / 4,
+                north - height / 4)
+  assert tilesInGeometry([[z, x, y], [z, x + 1, y]], area).tolist() == \
+    [True, False]
+
+
+def test_corner_of_the_bounding_box_is_dropped():
+  # triangle over the lower left half of a 4x4 block of tiles
+  z, x, y = tileAt(153.1, -27.39)
+  west, _, _, north = tileBounds(z, x, y)
+  _, south, east, _ = tileBounds(z, x + 3, y + 3)
+  area = {'type': 'Polygon',
+          'coordinates': [[[west, north], [west, south], [east, south],
+                           [west, north]]]}
+  coords = np.array([[z, x + i, y + j] for j in range(4) for i in range(4)])
+  mask = tilesInGeometry(coords, area).reshape(4, 4)
+  assert mask[3, 0] and mask[0, 0] and mask[3, 3]
+  assert not mask[0, 3]
+
+
+def test_multipolygon_and_feature_collection():
+  left, right = tileAt(153.10, -27.39), tileAt(153.30, -27.39)
+  far = tileAt(153.20, -27.39)
+  collection = {'type': 'FeatureCollection', 'features': [
+    {'type': 'Feature', 'properties': {},
+     'geometry': {'type': 'MultiPolygon', 'coordinates': [
+       square(153.099, -27.391, 153.101, -27.389)['coordinates'],
+       square(153.299, -27.391, 153.301, -27.389)['coordinates']]}}]}
+  assert tilesInGeometry([left, far, right], collection).tolist() == \
+    [True, False, True]
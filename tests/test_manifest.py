@@ -0,0 +1,110 @@
+import asyncio
+import json
+
+from concurrent.futures import Future
+
+import pipeline
+from aiopipeline import AsyncPipeline
+from manifest import Manifest
+from pipeline import Pipeline
+from utils import SpaceKnowError
+
+URL = 'https://api.spaceknow.com/kraken/release/cars/geojson'
+REQUEST = '{"sceneId": "scene-0"}'
+
+
+class FakePoller():
+  """ PipelinePoller whose pipelines resolve at once, except the lost ones
+  """
+  def __init__(self, lost=()):
+    self.lost = set(lost)
+    self.registered = []
+
+  def register(self, pipelineId, token, nextTry):
+    self.registered.append(pipelineId)
+    future = Future()
+    if pipelineId in self.lost:
+      future.set_exception(SpaceKnowError('Unknown pipeline', 404))
+    else:
+      future.set_result('RESOLVED')
+    return future
+
+
+def fakeApi(monkeypatch, lost=()):
+  """ Records the calls of the pipelines; returns the list of the calls
+  """
+  calls = []
+
+  def process(url, data='', token=''):
+    calls.append(url.rsplit('/', 1)[-1])
+    if url.endswith('/initiate'):
+      return {'pipelineId': 'new', 'nextTry': 0, 'status': 'PROCESSING'}
+    return {'mapId': json.loads(data)['pipelineId']}
+  poller = FakePoller(lost)
+  monkeypatch.setattr(pipeline, 'process', process)
+  monkeypatch.setattr(pipeline, 'getPoller', lambda: poller)
+  return calls
+
+
+def run(manifest):
+  job = Pipeline(URL, 'token', REQUEST, manifest=manifest)
+  job.start()
+  return job.join()
+
+
+def test_tiles_are_journaled(tmp_path):
+  manifest = Manifest(str(tmp_path / 'manifest.sqlite'))
+  features = [{'properties': {'count': 2}}, {'properties': {'count': 3}}]
+  manifest.addTile('map', '19_1_2', features)
+  manifest.addTiles('map', [('19_1_3', 1, json.dumps(
+    {'type': 'FeatureCollection', 'features': [{'properties': {'count': 1}}]}
+  ))])
+  assert manifest.tileCounts('map') == {'19_1_2': 5, '19_1_3': 1}
+  # a whole detections.geojson body is read back as its features
+  assert manifest.tiles('map')['19_1_3'] == [{'properties': {'count': 1}}]
+  assert not manifest.done('BUILD_PNG/map')
+  manifest.complete('BUILD_PNG/map')
+  assert manifest.done('BUILD_PNG/map')
+  manifest.clear()
+  assert manifest.stats() == {'pipelines': 0, 'tiles': 0, 'stages': 0}
+  manifest.close()
+
+
+def test_resolved_pipeline_is_not_initiated_again(tmp_path, monkeypatch):
+  calls = fakeApi(monkeypatch)
+  manifest = Manifest(str(tmp_path / 'manifest.sqlite'))
+  assert run(manifest) == {'mapId': 'new'}
+  assert calls == ['initiate', 'retrieve']
+  assert manifest.pipeline(URL, REQUEST) == ('new', 'RESOLVED',
+                                             {'mapId': 'new'})
+  assert run(manifest) == {'mapId': 'new'}
+  assert calls == ['initiate', 'retrieve']
+  manifest.close()
+
+
+def test_processing_pipeline_is_reattached(tmp_path, monkeypatch):
+  calls = fakeApi(monkeypatch)
+  manifest = Manifest(str(tmp_path / 'manifest.sqlite'))
+  manifest.startPipeline(URL, REQUEST, 'previous')
+  assert run(manifest) == {'mapId': 'previous'}
+  assert calls == ['retrieve']
+  assert manifest.pipeline(URL, REQUEST)[:2] == ('previous', 'RESOLVED')
+  manifest.close()
+
+
+def test_lost_pipeline_is_initiated_again(tmp_path, monkeypatch):
+  calls = fakeApi(monkeypatch, lost=['previous'])
+  manifest = Manifest(str(tmp_path / 'manifest.sqlite'))
+  manifest.startPipeline(URL, REQUEST, 'previous')
+  assert run(manifest) == {'mapId': 'new'}
+  assert calls == ['initiate', 'retrieve']
+  manifest.close()
+
+
+def test_async_pipeline_returns_the_resolved_result(tmp_path):
+  manifest = Manifest(str(tmp_path / 'manifest.sqlite'))
+  manifest.resolvePipeline(URL, REQUEST, 'previous', {'mapId': 'previous'})
+  # no request is sent: the transport is not even opened
+  job = AsyncPipeline(None, URL, 'token', REQUEST, manifest=manifest)
+  assert asyncio.run(job.run()) == {'mapId': 'previous'}
+  manifest.close()
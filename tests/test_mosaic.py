@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from PIL import Image
+from mosaic import Mosaic
+
+TILES = [[16, 10, 20], [16, 11, 20], [16, 10, 21]]
+
+
+def tile(value, channels=4):
+  shape = (2, 3, channels) if channels > 1 else (2, 3)
+  return np.full(shape, value, dtype=np.uint8)
+
+
+@pytest.mark.parametrize('memoryLimit', [1 << 20, 1])
+def test_tiles_are_placed_on_their_grid(tmp_path, memoryLimit):
+  mosaic = Mosaic(TILES, fill=(0, 0, 0, 0), memoryLimit=memoryLimit)
+  assert mosaic.paste(TILES[0], tile(10))
+  # RGB and grey tiles get an opaque alpha
+  assert mosaic.paste(TILES[1], tile(20, channels=3))
+  assert mosaic.paste(TILES[2], Image.fromarray(tile(30, channels=1)))
+  assert mosaic.canvas.shape == (4, 6, 4)
+  assert (mosaic.canvas[:2, :3] == 10).all()
+  assert (mosaic.canvas[:2, 3:, :3] == 20).all()
+  assert (mosaic.canvas[2:, :3, :3] == 30).all()
+  assert (mosaic.canvas[:2, 3:, 3] == 255).all()
+  # the slot of the missing tile keeps the fill colour
+  assert (mosaic.canvas[2:, 3:] == 0).all()
+  filename = str(tmp_path / 'mosaic.png')
+  assert mosaic.save(filename, stripRows=3)
+  assert (np.asarray(Image.open(filename)) == mosaic.canvas).all()
+  mosaic.close()
+  assert mosaic.canvas is None
+
+
+def test_tiles_that_do_not_fit_are_refused():
+  mosaic = Mosaic(TILES)
+  assert not mosaic.paste(TILES[0], None)
+  assert mosaic.paste(TILES[0], tile(10))
+  assert not mosaic.paste(TILES[1], np.zeros((4, 4, 4), dtype=np.uint8))
+  assert not mosaic.paste([17, 10, 20], tile(10))
+  assert mosaic.placed == 1
+
+
+def test_empty_mosaic(tmp_path):
+  with pytest.raises(ValueError):
+    Mosaic([])
+  assert not Mosaic(TILES).save(str(tmp_path / 'mosaic.png'))
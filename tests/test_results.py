@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+
+from detections import DetectionTable
+from geo import lonLatToTile, tileBounds
+from results import ResultStore, toTimestamp
+
+ZOOM = 19
+
+
+def tileAt(lon, lat):
+  x, y = lonLatToTile(lon, lat, ZOOM)
+  return [ZOOM, int(x), int(y)]
+
+
+def feature(lon, lat, count=1, name='cars'):
+  return {'type': 'Feature',
+          'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+          'properties': {'count': count, 'class': name}}
+
+
+def scene(mapId, day):
+  return {'mapId': mapId, 'sceneId': 'scene-' + mapId,
+          'datetime': '2018-01-%02d 00:00:00' % day}
+
+
+CAR = (153.1000, -27.3900)
+TRUCK = (153.1005, -27.3902)
+FAR = (153.2000, -27.3900)
+BOX = (153.0995, -27.3905, 153.1010, -27.3895)
+
+
+@pytest.fixture
+def store(tmp_path):
+  store = ResultStore(str(tmp_path / 'results.sqlite'))
+  tiles = [tileAt(*CAR), tileAt(*TRUCK), tileAt(*FAR)]
+  keys = ['%d_%d_%d' % tuple(tile) for tile in tiles]
+  store.addMap(scene('m1', 1), DetectionTable.fromAnalysis(tiles, {
+    keys[0]: [feature(*CAR, count=2)],
+    keys[1]: [feature(*TRUCK, name='trucks')],
+    keys[2]: [feature(*FAR, count=7)]}))
+  store.addMap(scene('m2', 2), DetectionTable.fromAnalysis(tiles, {
+    keys[0]: [feature(*CAR)]}))
+  # analysed over the box, no vehicle found
+  store.addMap(scene('m3', 3), DetectionTable.fromAnalysis(tiles[:2], {}))
+  # elsewhere
+  store.addMap(scene('m4', 4), DetectionTable.fromAnalysis(tiles[2:], {
+    keys[2]: [feature(*FAR)]}))
+  yield store
+  store.close()
+
+
+def test_toTimestamp_is_utc():
+  assert toTimestamp('1970-01-02', None) == 86400.0
+  assert toTimestamp('1970-01-01T01:00:00Z', None) == 3600.0
+  assert toTimestamp('1970-01-01T01:00:00+01:00', None) == 0.0
+  assert toTimestamp(None, 5.0) == 5.0
+  assert toTimestamp(12, None) == 12.0
+
+
+def test_scenes(store):
+  scenes = store.scenes()
+  assert scenes['mapId'].tolist() == ['m1', 'm2', 'm3', 'm4']
+  assert scenes['total'].tolist() == [10, 1, 0, 1]
+  assert scenes['trucks'].tolist() == [1, 0, 0, 0]
+  assert store.scenes('2018-01-02', '2018-01-03')['mapId'].tolist() == \
+    ['m2', 'm3']
+
+
+def test_detections(store):
+  found = store.detections(BOX)
+  assert sorted(zip(found['mapId'].tolist(), found['count'].tolist())) == \
+    [('m1', 1), ('m1', 2), ('m2', 1)]
+  assert len(store.detections(BOX, start='2018-01-02')) == 1
+
+
+def test_counts_include_scenes_without_vehicles(store):
+  counts = store.counts(BOX)
+  assert counts['mapId'].tolist() == ['m1', 'm2', 'm3']
+  assert counts['total'].tolist() == [3, 1, 0]
+  assert counts['cars'].tolist() == [2, 1, 0]
+  assert counts['trucks'].tolist() == [1, 0, 0]
+  assert store.counts(BOX, end='2018-01-01T12:00:00')['mapId'].tolist() == \
+    ['m1']
+
+
+def test_counts_of_a_polygon(store):
+  # the car, not the truck
+  west, south, east, north = 153.0999, -27.3901, 153.1001, -27.3899
+  area = {'type': 'Polygon', 'coordinates': [[
+    [west, south], [east, south], [east, north], [west, north],
+    [west, south]]]}
+  counts = store.counts(area)
+  assert counts['mapId'].tolist() == ['m1', 'm2', 'm3']
+  assert counts['total'].tolist() == [2, 1, 0]
+
+
+def test_tiles(store):
+  tiles = store.tiles(BOX)
+  z, x, y = tileAt(*CAR)
+  car = tiles[(tiles['x'] == x) & (tiles['y'] == y)]
+  assert sorted(zip(car['mapId'].tolist(), car['total'].tolist())) == \
+    [('m1', 2), ('m2', 1), ('m3', 0)]
+  west, south, east, north = tileBounds(*tileAt(*FAR))
+  far = store.tiles((west, south, east, north))
+  assert sorted(far['mapId'].tolist()) == ['m1', 'm2', 'm4']
+
+
+def test_addMap_replaces_the_map(store):
+  tiles = [tileAt(*CAR)]
+  store.addMap(scene('m1', 1), DetectionTable.fromAnalysis(tiles, {
+    '%d_%d_%d' % tuple(tiles[0]): [feature(*CAR, count=4)]}))
+  assert store.stats() == {'scenes': 4, 'tiles': 7, 'detections': 3}
+  counts = store.counts(BOX)
+  assert counts['total'].tolist() == [4, 1, 0]
+  assert np.array_equal(store.detections(BOX, end='2018-01-01')['count'],
+                        [4])
@@ -0,0 +1,51 @@
+import json
+
+import kraken
+from kraken import KrakenObject
+from runstore import RunStore
+from tileset import Tile
+
+TILE = Tile([16, 35406, 22218])
+
+
+class FakeTransport():
+  def __init__(self):
+    self.requested = []
+
+  def get(self, url, stream=False):
+    resource = url.rsplit('/', 1)[-1]
+    self.requested.append(resource)
+    response = type('Response', (), {})()
+    response.status_code = 200
+    response.content = json.dumps({'features': []}).encode() \
+      if resource.endswith('.geojson') else b'png'
+    return response
+
+
+def test_prefetched_resources_are_taken_once(monkeypatch):
+  transport = FakeTransport()
+  monkeypatch.setattr(kraken, 'getTransport', lambda: transport)
+  store = RunStore(maxBytes=1024)
+  detector = KrakenObject('cars', cache=False, store=store)
+  assert detector.download_tile('map-0', TILE, 'detections.geojson',
+                                prefetch=['cars.png']) == []
+  # the detections are not kept, the prefetched png waits for its build
+  assert store.report() == {'reused': 0, 'bytesReused': 0, 'dropped': 0,
+                            'size': 3}
+  assert detector.download_content('map-0', TILE, 'cars.png') == b'png'
+  assert transport.requested == ['detections.geojson', 'cars.png']
+  assert store.report() == {'reused': 1, 'bytesReused': 3, 'dropped': 0,
+                            'size': 0}
+  detector.download_content('map-0', TILE, 'cars.png')
+  assert transport.requested[-1] == 'cars.png'
+
+
+def test_oldest_resources_are_dropped():
+  store = RunStore(maxBytes=5)
+  for y in range(3):
+    store.put('map-0', Tile([16, 0, y]), 'cars.png', b'xx')
+  store.put('map-0', TILE, 'cars.png', b'too large')
+  assert store.take('map-0', Tile([16, 0, 0]), 'cars.png') is None
+  assert store.take('map-0', Tile([16, 0, 2]), 'cars.png') == b'xx'
+  assert store.report() == {'reused': 1, 'bytesReused': 2, 'dropped': 2,
+                            'size': 2}
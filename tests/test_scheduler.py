@@ -0,0 +1,180 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import aiokraken
+import scheduler
+from config import getConfig
+from scheduler import CreditBudget, CreditScheduler
+from utils import SpaceKnowError
+
+
+def scenes(count):
+  return [{'sceneId': 'scene-%d' % index,
+           'datetime': '2018-01-%02d 00:00:00' % (index + 1)}
+          for index in range(count)]
+
+
+def priced(costs, mapTypes=('cars',), workers=2):
+  """ CreditScheduler over the scenes of costs {sceneId: credits}, without
+      dry-runs
+  """
+  creditScheduler = CreditScheduler('token', [], {}, priority='newest',
+                                    workers=workers, mapTypes=mapTypes)
+  creditScheduler.costs = {sceneId: {'allocatedCredits': cost}
+                           for sceneId, cost in costs.items()}
+  return creditScheduler
+
+
+class FakeRelease():
+  """ downloadMap of a SpaceKnow account charging every map it releases
+  """
+  def __init__(self, fail=(), delay=0.0):
+    self.fail = set(fail)
+    self.delay = delay
+    self.charged = []
+    self._lock = threading.Lock()
+
+  def __call__(self, mapType, sceneId, extent, token):
+    time.sleep(self.delay)
+    if (mapType, sceneId) in self.fail:
+      return None
+    with self._lock:
+      self.charged.append((mapType, sceneId))
+    return {'mapId': 'map-%s-%s' % (mapType, sceneId), 'skippedTiles': 0}
+
+
+class FakeAsyncRelease(FakeRelease):
+  """ aiokraken.downloadMap version of FakeRelease
+  """
+  async def __call__(self, transport, mapType, sceneId, extent, token):
+    await asyncio.sleep(self.delay)
+    return super().__call__(mapType, sceneId, extent, token)
+
+
+async def releaseAsync(creditScheduler, credits, alongside=()):
+  return [jsonMap async for jsonMap in
+          aiokraken.iterRelease(None, creditScheduler, 'cars', scenes(2),
+                                credits, alongside)]
+
+
+@pytest.fixture
+def release(monkeypatch):
+  def install(**kwargs):
+    fake = FakeRelease(**kwargs)
+    monkeypatch.setattr(scheduler, 'downloadMap', fake)
+    return fake
+  return install
+
+
+def test_budget():
+  budget = CreditBudget(10)
+  assert budget.reserve(6)
+  assert not budget.reserve(5)
+  budget.refund(6)
+  assert budget.reserve(10)
+  assert budget.remaining == 0
+
+
+def test_releases_within_the_budget_newest_first(release):
+  release()
+  creditScheduler = priced({'scene-0': 1, 'scene-1': 1, 'scene-2': 5,
+                            'scene-3': 1})
+  maps = creditScheduler.release('cars', scenes(4), credits=3)
+  assert [jsonMap['sceneId'] for jsonMap in maps] == \
+    ['scene-3', 'scene-1', 'scene-0']
+  assert [scene['sceneId'] for scene in creditScheduler.skipped] == \
+    ['scene-2']
+  assert creditScheduler.budget.spent == 3
+
+
+def test_failed_release_gives_its_credits_to_skipped_scenes(release):
+  release(fail=[('cars', 'scene-1')])
+  creditScheduler = priced({'scene-0': 2, 'scene-1': 2}, workers=1)
+  maps = list(creditScheduler.iterRelease('cars', scenes(2), credits=2))
+  assert [jsonMap['sceneId'] for jsonMap in maps] == ['scene-0']
+  assert creditScheduler.skipped == []
+  assert creditScheduler.budget.spent == 2
+
+
+def test_charged_companion_keeps_the_credits_reserved(release):
+  # the imagery of scene-1 is released while its cars release fails
+  fake = release(fail=[('cars', 'scene-1')], delay=0.01)
+  creditScheduler = priced({'scene-0': 2, 'scene-1': 2},
+                           mapTypes=('cars', 'imagery'), workers=1)
+  maps = list(creditScheduler.iterRelease('cars', scenes(2), credits=2,
+                                          alongside=('imagery',)))
+  assert maps == []
+  assert fake.charged == [('imagery', 'scene-1')]
+  assert creditScheduler.budget.spent == 2
+  assert [scene['sceneId'] for scene in creditScheduler.skipped] == \
+    ['scene-0']
+
+
+def test_failed_scene_without_companion_is_refunded(release):
+  fake = release(fail=[('cars', 'scene-1'), ('imagery', 'scene-1')])
+  creditScheduler = priced({'scene-0': 2, 'scene-1': 2},
+                           mapTypes=('cars', 'imagery'), workers=1)
+  maps = list(creditScheduler.iterRelease('cars', scenes(2), credits=2,
+                                          alongside=('imagery',)))
+  assert [jsonMap['sceneId'] for jsonMap in maps] == ['scene-0']
+  assert maps[0]['alongside']['imagery'].result()['mapId'] == \
+    'map-imagery-scene-0'
+  assert sorted(fake.charged) == [('cars', 'scene-0'), ('imagery', 'scene-0')]
+
+
+def test_alongside_maps_must_be_priced(release):
+  release()
+  creditScheduler = priced({'scene-0': 1})
+  with pytest.raises(SpaceKnowError) as error:
+    list(creditScheduler.iterRelease('cars', scenes(1), 10,
+                                     alongside=('imagery',)))
+  assert error.value.status_code == 400
+
+
+def test_batch_dry_run_falls_back_to_single_scenes(monkeypatch):
+  creditScheduler = CreditScheduler('token', [getConfig().krakenDryRun], {},
+                                    batch=3)
+
+  def dryRun(batch):
+    if len(batch) > 1 or batch[0]['sceneId'] == 'scene-1':
+      raise SpaceKnowError('dry-run failed', 500)
+    return {batch[0]['sceneId']: {'allocatedCredits': 1.0}}
+  monkeypatch.setattr(creditScheduler, 'dryRun', dryRun)
+  assert sorted(creditScheduler.estimate(scenes(3))) == ['scene-0', 'scene-2']
+
+
+def test_no_scene_priced(monkeypatch):
+  creditScheduler = CreditScheduler('token', [getConfig().krakenDryRun], {})
+
+  def dryRun(batch):
+    raise SpaceKnowError('dry-run failed', 500)
+  monkeypatch.setattr(creditScheduler, 'dryRun', dryRun)
+  with pytest.raises(SpaceKnowError) as error:
+    creditScheduler.estimate(scenes(2))
+  assert error.value.status_code == 503
+
+
+def test_async_release_keeps_the_budget(monkeypatch):
+  monkeypatch.setattr(aiokraken, 'downloadMap',
+                      FakeAsyncRelease(fail=[('cars', 'scene-1')]))
+  creditScheduler = priced({'scene-0': 2, 'scene-1': 2}, workers=1)
+  maps = asyncio.run(releaseAsync(creditScheduler, credits=2))
+  assert [jsonMap['sceneId'] for jsonMap in maps] == ['scene-0']
+  assert creditScheduler.skipped == []
+  assert creditScheduler.budget.spent == 2
+
+
+def test_async_charged_companion_keeps_the_credits_reserved(monkeypatch):
+  fake = FakeAsyncRelease(fail=[('cars', 'scene-1')], delay=0.01)
+  monkeypatch.setattr(aiokraken, 'downloadMap', fake)
+  creditScheduler = priced({'scene-0': 2, 'scene-1': 2},
+                           mapTypes=('cars', 'imagery'), workers=1)
+  maps = asyncio.run(releaseAsync(creditScheduler, credits=2,
+                                  alongside=('imagery',)))
+  assert maps == []
+  assert fake.charged == [('imagery', 'scene-1')]
+  assert [scene['sceneId'] for scene in creditScheduler.skipped] == \
+    ['scene-0']
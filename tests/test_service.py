@@ -0,0 +1,70 @@
+import time
+
+import pytest
+
+import service
+from utils import SpaceKnowError
+
+
+class FakeCredentials():
+  def __init__(self):
+    self.renewed = 0
+
+  def get(self):
+    return 'token', ['permission']
+
+  def renew(self, token):
+    self.renewed += 1
+    return 'renewed'
+
+
+def wait(jobs, jobId):
+  for _ in range(200):
+    job = jobs.get(jobId)
+    if job['finished']:
+      return job
+    time.sleep(0.01)
+  raise AssertionError('job %s did not finish' % jobId)
+
+
+@pytest.fixture
+def runs(monkeypatch):
+  runs = []
+
+  def analyseArea(token, permissions, area, buildImages, callback,
+                  outputDir='output'):
+    runs.append(outputDir)
+    if area == 'forbidden':
+      raise SpaceKnowError('User is unauthorized to perform the operation',
+                           403)
+    callback('map-1', 3, [])
+    return {'total': 3}
+  monkeypatch.setattr(service, 'analyseArea', analyseArea)
+  return runs
+
+
+def test_job_result_and_progress(runs):
+  jobs = service.JobManager(FakeCredentials(), workers=1)
+  job = wait(jobs, jobs.submit('area')['jobId'])
+  assert job['status'] == 'RESOLVED'
+  assert job['result'] == {'total': 3}
+  assert job['progress'] == [{'mapId': 'map-1', 'cars': 3}]
+
+
+def test_permission_error_fails_the_job_once(runs):
+  jobs = service.JobManager(FakeCredentials(), workers=1)
+  job = wait(jobs, jobs.submit('forbidden')['jobId'])
+  assert job['status'] == 'FAILED'
+  assert job['error']['status'] == 403
+  assert len(runs) == 1
+
+
+def test_every_job_has_its_own_output_folder(runs, tmp_path):
+  jobs = service.JobManager(FakeCredentials(), workers=2,
+                            outputDir=str(tmp_path))
+  first = jobs.submit('area', buildImages=True)
+  second = jobs.submit('area', buildImages=True)
+  wait(jobs, first['jobId'])
+  wait(jobs, second['jobId'])
+  assert sorted(runs) == sorted([str(tmp_path / first['jobId']),
+                                 str(tmp_path / second['jobId'])])
@@ -0,0 +1,87 @@
+import numpy as np
+
+from detections import DetectionTable
+from spatialindex import DetectionIndex, METERS_PER_DEGREE
+
+LON, LAT = 153.1, -27.39
+TILE = [[19, 473000, 296000]]
+
+
+def table(points):
+  """ DetectionTable of (lon, lat, count, class) points on one tile
+  """
+  return DetectionTable.fromAnalysis(TILE, {'19_473000_296000': [
+    {'type': 'Feature',
+     'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+     'properties': {'count': count, 'class': name}}
+    for lon, lat, count, name in points]})
+
+
+def meters(east):
+  """ Longitude east meters from LON
+  """
+  return LON + east / (METERS_PER_DEGREE * np.cos(np.radians(LAT)))
+
+
+def test_merges_detections_of_overlapping_scenes():
+  index = DetectionIndex(distance=2.0, seconds=60)
+  assert index.add(table([(LON, LAT, 1, 'cars')]), timestamp=0) == 1
+  # the same car seen 1 m away by the next scene
+  assert index.add(table([(meters(1.0), LAT, 1, 'cars')]), timestamp=30) == 0
+  assert len(index) == 1
+  assert index.merged == 1
+  assert index.total == 1
+
+
+def test_keeps_the_highest_count():
+  index = DetectionIndex(distance=2.0, seconds=60)
+  index.add(table([(LON, LAT, 2, 'trucks')]))
+  assert index.add(table([(meters(0.5), LAT, 5, 'trucks')])) == 3
+  assert index.add(table([(meters(0.5), LAT, 1, 'trucks')])) == 0
+  assert index.total == 5
+  assert index.classCounts()['trucks'] == 5
+
+
+def test_does_not_merge_far_other_class_or_later():
+  index = DetectionIndex(distance=2.0, seconds=60)
+  index.add(table([(LON, LAT, 1, 'cars')]), timestamp=0)
+  index.add(table([(meters(10.0), LAT, 1, 'cars')]), timestamp=0)
+  index.add(table([(LON, LAT, 1, 'trucks')]), timestamp=0)
+  index.add(table([(LON, LAT, 1, 'cars')]), timestamp=3600)
+  assert len(index) == 4
+  assert index.merged == 0
+  assert index.total == 4
+
+
+def test_merges_across_grid_cells():
+  # pairs 1.5 m apart along 2 m cells: some of them straddle two cells
+  for offset in range(10):
+    index = DetectionIndex(distance=2.0, seconds=60, cellMeters=2.0)
+    index.add(table([(meters(offset * 0.3), LAT, 1, 'cars')]))
+    index.add(table([(meters(offset * 0.3 + 1.5), LAT, 1, 'cars')]))
+    assert len(index) == 1
+
+
+def test_grows_and_queries():
+  index = DetectionIndex(distance=0.5, seconds=60)
+  points = [(meters(i * 5.0), LAT, 1, 'cars') for i in range(2000)]
+  assert index.add(table(points)) == 2000
+  assert len(index) == 2000
+  indexes = index.queryBBox(meters(-1.0), LAT - 0.001, meters(22.0),
+                            LAT + 0.001)
+  assert indexes.tolist() == [0, 1, 2, 3, 4]
+  assert index.queryPoint(meters(10.0), LAT, 6.0).tolist() == [1, 2, 3]
+  area = {'type': 'Polygon', 'coordinates': [[
+    [meters(-1.0), LAT - 0.001], [meters(12.0), LAT - 0.001],
+    [meters(12.0), LAT + 0.001], [meters(-1.0), LAT + 0.001],
+    [meters(-1.0), LAT - 0.001]]]}
+  assert index.countIn(area) == 3
+
+
+def test_skips_detections_without_centroid():
+  index = DetectionIndex(distance=2.0, seconds=60)
+  empty = DetectionTable.fromAnalysis(TILE, {'19_473000_296000': [
+    {'type': 'Feature', 'geometry': None, 'properties': {'count': 1}}]})
+  assert index.add(empty) == 0
+  assert len(index) == 0
+  assert len(index.queryBBox(-180, -90, 180, 90)) == 0
@@ -0,0 +1,55 @@
+import os
+import time
+
+from tilecache import TileCache
+
+TILE = ('map-0', 'geometry-0', 16, 35406, 22218)
+
+
+def test_put_then_get(tmp_path):
+  cache = TileCache(str(tmp_path))
+  assert cache.get(*TILE, 'truecolor.png') is None
+  cache.put(*TILE, 'truecolor.png', b'pixels')
+  assert cache.get(*TILE, 'truecolor.png') == b'pixels'
+  # each resource of a tile is an entry of its own
+  assert cache.get(*TILE, 'cars.png') is None
+  assert cache.stats() == {'hits': 1, 'misses': 2, 'bytesSaved': 6,
+                           'evicted': 0, 'size': 6}
+
+
+def test_replaced_entry_keeps_the_size(tmp_path):
+  cache = TileCache(str(tmp_path))
+  cache.put(*TILE, 'truecolor.png', b'old pixels')
+  cache.put(*TILE, 'truecolor.png', b'new')
+  assert cache.get(*TILE, 'truecolor.png') == b'new'
+  assert cache.stats()['size'] == 3
+  # no temporary file is left behind
+  assert [name for _, _, names in os.walk(str(tmp_path))
+          for name in names if name.startswith('.')] == []
+
+
+def test_size_is_measured_on_open(tmp_path):
+  TileCache(str(tmp_path)).put(*TILE, 'truecolor.png', b'pixels')
+  cache = TileCache(str(tmp_path))
+  assert cache.stats()['size'] == 6
+  assert cache.get(*TILE, 'truecolor.png') == b'pixels'
+
+
+def test_least_recently_used_files_are_evicted(tmp_path):
+  cache = TileCache(str(tmp_path), maxBytes=30)
+  for y in range(3):
+    cache.put('map-0', 'geometry-0', 16, 35406, y, 'truecolor.png', b'x' * 10)
+  # every file gets its own time, the first tile is read last
+  for y in (1, 2, 0):
+    filename = cache._path(cache.key('map-0', 'geometry-0', 16, 35406, y,
+                                     'truecolor.png'))
+    os.utime(filename, (time.time() - 10 + y, time.time() - 10 + y))
+  cache.get('map-0', 'geometry-0', 16, 35406, 0, 'truecolor.png')
+  cache.put('map-0', 'geometry-0', 16, 35406, 3, 'truecolor.png', b'x' * 10)
+  # 40 bytes over the 30 limit: the cache shrinks to 27 bytes
+  assert cache.stats()['evicted'] == 2
+  assert cache.stats()['size'] == 20
+  assert cache.get('map-0', 'geometry-0', 16, 35406, 1, 'truecolor.png') is None
+  assert cache.get('map-0', 'geometry-0', 16, 35406, 2, 'truecolor.png') is None
+  assert cache.get('map-0', 'geometry-0', 16, 35406, 0, 'truecolor.png')
+  assert cache.get('map-0', 'geometry-0', 16, 35406, 3, 'truecolor.png')
@@ -0,0 +1,87 @@
+import io
+
+import numpy as np
+import pytest
+
+import tiledecode
+from PIL import Image
+from tiledecode import TileDecoder
+
+
+def png(mode, size=(5, 3)):
+  """ PNG body of an image of the mode with distinct pixels and its PIL
+      image
+  """
+  channels = len(Image.new(mode, (1, 1)).getbands())
+  values = np.arange(size[0] * size[1] * channels, dtype=np.uint8) * 7
+  image = Image.frombytes(mode, size, values.tobytes()) if mode != 'P' else \
+    Image.frombytes('L', size, values.tobytes()).convert('P')
+  body = io.BytesIO()
+  image.save(body, format='PNG')
+  return body.getvalue(), image
+
+
+@pytest.fixture
+def decoder():
+  decoder = TileDecoder(workers=2, buffers=2, spare=4)
+  yield decoder
+  decoder._pool.shutdown()
+
+
+class FakeResponse():
+  """ Streamed response of requests with the attributes readBody uses
+  """
+  def __init__(self, body, length=True):
+    self.raw = io.BytesIO(body)
+    self.headers = {'Content-Length': str(len(body))} if length else {}
+    self.closed = False
+
+  def close(self):
+    self.closed = True
+
+
+@pytest.mark.parametrize('direct', [True, False])
+def test_rgb_and_rgba_are_decoded_with_alpha(decoder, monkeypatch, direct):
+  if not direct:
+    monkeypatch.setattr(tiledecode, 'directDecode', lambda image: False)
+  body, image = png('RGB')
+  pixels = decoder.decode(body)
+  assert pixels.shape == (3, 5, 4)
+  assert (pixels[..., :3] == np.asarray(image)).all()
+  assert (pixels[..., 3] == 255).all()
+  body, image = png('RGBA')
+  assert (decoder.decode(body) == np.asarray(image)).all()
+
+
+def test_grey_and_palette_images(decoder):
+  body, image = png('L')
+  pixels = decoder.decode(bytearray(body))
+  assert pixels.shape == (3, 5)
+  assert (pixels == np.asarray(image)).all()
+  body, image = png('P')
+  assert (decoder.decode(body) == np.asarray(image.convert('RGBA'))).all()
+
+
+def test_recycled_arrays_are_reused(decoder):
+  body, _ = png('RGB')
+  pixels = decoder.decode(body)
+  decoder.recycle(pixels)
+  assert decoder.decode(body) is pixels
+  # arrays the decoder did not allocate are ignored
+  foreign = np.zeros((3, 5, 4), dtype=np.uint8)
+  decoder.recycle(foreign)
+  assert decoder.decode(body) is not foreign
+
+
+@pytest.mark.parametrize('length', [True, False])
+def test_read_body_in_a_pooled_buffer(decoder, length):
+  body, image = png('RGBA')
+  response = FakeResponse(body, length)
+  buffer, size = decoder.readBody(response, chunk=16)
+  assert response.closed
+  assert bytes(buffer[:size]) == body
+  pixels = decoder.submitBuffer(buffer, size).result()
+  assert (pixels == np.asarray(image)).all()
+  # both buffers are free again
+  decoder.buffers.release(decoder.buffers.acquire())
+  assert len(decoder.buffers._free) == 2
@@ -0,0 +1,81 @@
+import numpy as np
+
+from tileset import Tile, TileSet, asTile, packKeys
+
+
+def grid(z=19, x=100, y=200, width=4, height=3):
+  return TileSet.fromList([[z, x + i, y + j] for j in range(height)
+                           for i in range(width)])
+
+
+def test_tile():
+  tile = asTile([19, 1, 2])
+  assert str(tile) == '19_1_2'
+  assert tile == Tile((19, 1, 2))
+  assert asTile(tile) is tile
+  assert len({tile, Tile([19, 1, 2])}) == 1
+
+
+def test_keys_are_unique_per_zoom():
+  keys = packKeys(np.array([18, 19]), np.array([5, 5]), np.array([7, 7]))
+  assert keys[0] != keys[1]
+
+
+def test_fromList_drops_invalid_rows():
+  tiles = TileSet.fromList([[19, 1, 2], Tile([19, 1, 3]), [19, 5]])
+  assert tiles.tolist() == [[19, 1, 2], [19, 1, 3]]
+  assert TileSet.fromList(tiles) is tiles
+  assert len(TileSet.fromList([])) == 0
+
+
+def test_membership_and_lookup():
+  tiles = grid()
+  assert [19, 101, 201] in tiles
+  assert Tile([19, 104, 201]) not in tiles
+  assert [18, 101, 201] not in tiles
+  assert tiles.lookup(19, [100, 103, 99], [200, 202, 200]).tolist() == \
+    [0, 11, -1]
+  # out of the grid of the zoom
+  assert tiles.lookup(1, -1, 0).tolist() == [-1]
+
+
+def test_empty_set():
+  tiles = TileSet.fromList([])
+  assert [19, 1, 2] not in tiles
+  assert tiles.indexOf([1, 2]).tolist() == [-1, -1]
+  assert not tiles.around([[19, 1, 2]]).any()
+
+
+def test_iteration_batches_and_take():
+  tiles = grid()
+  assert [str(tile) for tile in tiles][:2] == ['19_100_200', '19_101_200']
+  assert [len(batch) for batch in tiles.batches(5)] == [5, 5, 2]
+  assert tiles.take([0, 11]).tolist() == [[19, 100, 200], [19, 103, 202]]
+  assert tiles[4] == Tile([19, 100, 201])
+
+
+def test_neighbours():
+  tiles = grid()
+  corner = sorted(tiles.neighbours([19, 100, 200]).tolist())
+  assert corner == [1, 4, 5]
+  assert sorted(tiles.neighbours([19, 100, 200], diagonal=False).tolist()) \
+    == [1, 4]
+  assert len(tiles.neighbours([19, 101, 201])) == 8
+
+
+def test_around():
+  tiles = grid()
+  mask = tiles.around([[19, 100, 200]], margin=1)
+  assert sorted(np.flatnonzero(mask).tolist()) == [0, 1, 4, 5]
+  assert tiles.around([[19, 101, 201]], margin=2).all()
+  assert tiles.around([[19, 100, 200]], margin=0).sum() == 1
+
+
+def test_sortedMorton_keeps_the_tiles():
+  tiles = grid(width=8, height=8)
+  ordered = tiles.sortedMorton()
+  assert sorted(ordered.tolist()) == sorted(tiles.tolist())
+  assert np.all(np.diff(ordered.keys) > 0)
+  # the first 4 tiles of the curve are a 2x2 block
+  first = ordered.coords[:4]
+  assert np.ptp(first[:, 1]) == 1 and np.ptp(first[:, 2]) == 1
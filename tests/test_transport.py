@@ -0,0 +1,195 @@
+import asyncio
+import threading
+import time
+
+from aioutils import AsyncTransport
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from transport import EndpointLimiter, EndpointLimiters, endpointGroup, \
+  Transport
+
+
+def test_slow_start_grows_by_one():
+  limiter = EndpointLimiter('grid', limit=4, maxLimit=64)
+  for _ in range(3):
+    limiter.release(limiter.acquire())
+  assert limiter.limit == 7
+
+
+def test_congestion_halves_once_per_round_trip():
+  limiter = EndpointLimiter('grid', limit=16, maxLimit=64)
+  started = [limiter.acquire() for _ in range(3)]
+  time.sleep(0.02)
+  for start in started:
+    limiter.release(start, congested=True)
+  assert limiter.limit == 8
+  assert limiter.ceiling == 16
+  assert limiter.congested == 3
+
+
+def test_additive_increase_after_congestion():
+  limiter = EndpointLimiter('grid', limit=16, maxLimit=64)
+  limiter.release(limiter.acquire(), congested=True)
+  limiter.release(limiter.acquire())
+  assert limiter.limit == 8 + 1 / 8
+  # near the limit of the last congestion, 8 times slower
+  limiter.limit = 15.5
+  limiter.release(limiter.acquire())
+  assert limiter.limit == 15.5 + 1 / 15.5 / 8
+
+
+def test_limit_bounds():
+  limiter = EndpointLimiter('grid', limit=2, minLimit=1, maxLimit=8)
+  for _ in range(20):
+    limiter.release(limiter.acquire())
+  assert limiter.limit == 8
+  for _ in range(5):
+    limiter.release(limiter.acquire(), congested=True)
+    limiter._holdUntil = 0.0
+  assert limiter.limit == 1
+
+
+def test_acquire_blocks_at_the_limit():
+  limiter = EndpointLimiter('grid', limit=2)
+  started = [limiter.acquire(), limiter.acquire()]
+  acquired = threading.Event()
+
+  def third():
+    limiter.acquire()
+    acquired.set()
+  thread = threading.Thread(target=third)
+  thread.start()
+  assert not acquired.wait(0.1)
+  limiter.release(started[0])
+  assert acquired.wait(1.0)
+  thread.join()
+  assert limiter.inFlight == 2
+
+
+def test_retry_after_pauses_the_endpoint_at_the_minimum():
+  limiter = EndpointLimiter('grid', limit=1, minLimit=1)
+  limiter.release(limiter.acquire(), congested=True, retryAfter=0.2)
+  assert limiter.asdict()['paused'] > 0
+  start = time.monotonic()
+  limiter.acquire()
+  assert time.monotonic() - start >= 0.15
+
+
+def test_retry_after_does_not_pause_above_the_minimum():
+  limiter = EndpointLimiter('grid', limit=8, minLimit=1)
+  limiter.release(limiter.acquire(), congested=True, retryAfter=10)
+  assert limiter.asdict()['paused'] == 0.0
+
+
+def test_one_limiter_per_endpoint():
+  limiters = EndpointLimiters(limit=4, maxLimit=8)
+  first = limiters.get('https://api.spaceknow.com/kraken/grid/a/-/19/1/2/'
+                       'cars.png')
+  second = limiters.get('https://api.spaceknow.com/kraken/grid/b/-/19/3/4/'
+                        'truck.png')
+  assert first is second
+  assert first.name == endpointGroup('https://api.spaceknow.com/kraken/grid/'
+                                     'a/-/19/1/2/cars.png')
+  assert limiters.get('https://api.spaceknow.com/imagery/search') is not first
+  assert set(limiters.asdict()) == {first.name, endpointGroup(
+    'https://api.spaceknow.com/imagery/search')}
+
+
+class TokenHandler(BaseHTTPRequestHandler):
+  tokens = []
+
+  def do_GET(self):
+    token = self.headers.get('Authorization', '')
+    TokenHandler.tokens.append(token)
+    self.send_response(200 if token == 'Bearer new' else 401)
+    self.send_header('Content-Length', '2')
+    self.end_headers()
+    self.wfile.write(b'{}')
+
+  def log_message(self, *args):
+    pass
+
+
+def test_rejected_token_is_renewed_once():
+  server = HTTPServer(('127.0.0.1', 0), TokenHandler)
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  TokenHandler.tokens = []
+  renewed = []
+
+  def renew(token):
+    renewed.append(token)
+    return 'new'
+  transport = Transport(concurrency=0, backoffBase=0.01)
+  transport.setTokenRenewer(renew)
+  url = 'http://127.0.0.1:%d/user/info' % server.server_port
+  try:
+    headers = {'Authorization': 'Bearer old'}
+    assert transport.get(url, headers=headers).status_code == 200
+    # the later requests with the old token get the new one at once
+    assert transport.get(url, headers=headers).status_code == 200
+    assert renewed == ['old']
+    assert TokenHandler.tokens == ['Bearer old', 'Bearer new', 'Bearer new']
+    # a new token rejected again is not renewed in a loop
+    transport.setTokenRenewer(lambda token: None)
+    assert transport.get(url, headers={'Authorization': 'Bearer other'}) \
+      .status_code == 401
+  finally:
+    transport.close()
+    server.shutdown()
+
+
+def test_session_of_a_finished_thread_is_closed():
+  transport = Transport()
+  sessions = []
+  worker = threading.Thread(target=lambda: sessions.append(transport.session))
+  worker.start()
+  worker.join()
+  mainSession = transport.session
+  assert sessions[0] is not mainSession
+  assert transport._sessions == {mainSession}
+  transport.close()
+  assert transport._sessions == set()
+
+
+class ThrottledHandler(BaseHTTPRequestHandler):
+  answers = 0
+
+  def do_GET(self):
+    ThrottledHandler.answers += 1
+    self.send_response(429)
+    self.send_header('Retry-After', '3600')
+    self.send_header('Content-Length', '2')
+    self.end_headers()
+    self.wfile.write(b'{}')
+
+  def log_message(self, *args):
+    pass
+
+
+def test_async_transport_caps_the_throttled_retries():
+  server = HTTPServer(('127.0.0.1', 0), ThrottledHandler)
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  ThrottledHandler.answers = 0
+  limiters = EndpointLimiters(limit=4)
+  url = 'http://127.0.0.1:%d/kraken/grid/map/-/19/1/2/cars.png' % \
+    server.server_port
+
+  async def run():
+    async with AsyncTransport(maxRetries=1, maxThrottled=2,
+                              retryAfterMax=0.01, endpoints=limiters,
+                              limiter=False) as transport:
+      return await transport.request('GET', url)
+  try:
+    started = time.monotonic()
+    status, _ = asyncio.run(run())
+    assert status == 429
+    # 1 retry and 2 throttled retries, each waiting retryAfterMax
+    assert ThrottledHandler.answers == 4
+    assert time.monotonic() - started < 5
+    limiter = limiters.get(url)
+    assert limiter.congested == 4
+    assert limiter.inFlight == 0
+    assert limiter.limit < 4
+  finally:
+    server.shutdown()
@@ -0,0 +1,340 @@
+import fnmatch
+import sys
+import time
+import types
+
+import pytest
+
+import workqueue
+from scheduler import CreditScheduler
+from utils import SpaceKnowError
+from workqueue import Coordinator, RedisQueue, SQLiteQueue, idleWait, runKey
+
+
+class WatchError(Exception):
+  pass
+
+
+class FakeRedis():
+  """ In-memory client with the commands of RedisQueue; a key changed
+      after it was watched fails the transaction with WatchError
+  """
+  def __init__(self):
+    self.data = {}
+    self.versions = {}
+
+  def _changed(self, key):
+    self.versions[key] = self.versions.get(key, 0) + 1
+
+  def _get(self, key, default):
+    return self.data.setdefault(key, default)
+
+  def pipeline(self):
+    return FakePipeline(self)
+
+  def incr(self, key):
+    self.data[key] = self.data.get(key, 0) + 1
+    self._changed(key)
+    return self.data[key]
+
+  def hget(self, key, field):
+    value = self.data.get(key, {}).get(field)
+    return str(value) if value is not None else None
+
+  def hset(self, key, field, value):
+    self._get(key, {})[field] = value
+    self._changed(key)
+
+  def hdel(self, key, *fields):
+    for field in fields:
+      self.data.get(key, {}).pop(field, None)
+    self._changed(key)
+
+  def hscan_iter(self, key, match='*'):
+    return [(field, value) for field, value in self.data.get(key, {}).items()
+            if fnmatch.fnmatchcase(field, match)]
+
+  def zadd(self, key, mapping):
+    self._get(key, {}).update(mapping)
+    self._changed(key)
+
+  def zrem(self, key, *members):
+    self.hdel(key, *members)
+
+  @staticmethod
+  def _score(bound):
+    if bound in ('-inf', '+inf'):
+      return float(bound), False
+    if isinstance(bound, str) and bound.startswith('('):
+      return float(bound[1:]), True
+    return float(bound), False
+
+  def _range(self, key, low, high):
+    low, lowOpen = self._score(low)
+    high, highOpen = self._score(high)
+    return [member for member, score in sorted(
+              self.data.get(key, {}).items(), key=lambda item: item[1])
+            if (score > low if lowOpen else score >= low) and
+            (score < high if highOpen else score <= high)]
+
+  def zrangebyscore(self, key, low, high, start=None, num=None):
+    members = self._range(key, low, high)
+    return members[start:start + num] if num is not None else members
+
+  def zcount(self, key, low, high):
+    return len(self._range(key, low, high))
+
+  def rpush(self, key, value):
+    self._get(key, []).append(value)
+    self._changed(key)
+
+  def lrange(self, key, start, end):
+    return list(self.data.get(key, []))
+
+  def lrem(self, key, count, value):
+    values = self.data.get(key, [])
+    if value in values:
+      values.remove(value)
+    self._changed(key)
+
+  def llen(self, key):
+    return len(self.data.get(key, []))
+
+  def delete(self, *keys):
+    for key in keys:
+      self.data.pop(key, None)
+      self._changed(key)
+
+  def set(self, key, value):
+    self.data[key] = value
+    self._changed(key)
+
+  def exists(self, key):
+    return int(key in self.data)
+
+  def close(self):
+    pass
+
+
+class FakePipeline():
+  """ Commands run at once while watching, queued after multi() (and
+      without watch) until execute()
+  """
+  def __init__(self, client):
+    self.client = client
+    self.watched = None
+    self.immediate = True
+    self.queued = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.watched = None
+
+  def watch(self, *keys):
+    self.watched = {key: self.client.versions.get(key, 0) for key in keys}
+    self.immediate = True
+
+  def unwatch(self):
+    self.watched = None
+
+  def multi(self):
+    self.queued = []
+    self.immediate = False
+
+  def __getattr__(self, name):
+    command = getattr(self.client, name)
+
+    def call(*args, **kwargs):
+      if self.watched is not None and self.immediate:
+        return command(*args, **kwargs)
+      self.queued.append((command, args, kwargs))
+      return self
+    return call
+
+  def execute(self):
+    if self.watched is not None and any(
+        self.client.versions.get(key, 0) != version
+        for key, version in self.watched.items()):
+      self.watched, self.queued = None, []
+      raise WatchError()
+    results = [command(*args, **kwargs)
+               for command, args, kwargs in self.queued]
+    self.watched, self.queued = None, []
+    return results
+
+
+@pytest.fixture(params=['sqlite', 'redis'])
+def queue(request, tmp_path, monkeypatch):
+  monkeypatch.setattr(workqueue, 'RETRY_DELAY', 0.0)
+  if request.param == 'sqlite':
+    queue = SQLiteQueue(str(tmp_path / 'queue.sqlite'), attempts=2)
+  else:
+    # RedisQueue only needs WatchError from redis-py with a given client
+    exceptions = types.SimpleNamespace(WatchError=WatchError)
+    monkeypatch.setitem(sys.modules, 'redis',
+                        types.SimpleNamespace(exceptions=exceptions))
+    monkeypatch.setitem(sys.modules, 'redis.exceptions', exceptions)
+    queue = RedisQueue('redis://fake', attempts=2, client=FakeRedis())
+  queue.reset()
+  yield queue
+  queue.close()
+
+
+def test_put_is_idempotent_by_key(queue):
+  first = queue.put('shard', {'tiles': [1]}, 'map-1/0')
+  assert queue.put('shard', {'tiles': [2]}, 'map-1/0') == first
+  assert queue.stats() == {'queued': 1, 'leased': 0, 'finished': 0}
+
+
+def test_claim_leases_the_job(queue):
+  jobId = queue.put('release', {'scene': 'a'}, 'a')
+  job = queue.claim('w1', lease=60)
+  assert job['id'] == jobId and job['payload'] == {'scene': 'a'}
+  assert job['attempts'] == 1 and job['state'] == {}
+  assert queue.claim('w2', lease=60) is None
+  assert queue.stats()['leased'] == 1
+  assert queue.extend(jobId, 'w1', lease=60)
+  assert not queue.extend(jobId, 'w2', lease=60)
+
+
+def test_expired_lease_is_claimed_again_with_its_state(queue):
+  jobId = queue.put('release', {}, 'a')
+  queue.claim('w1', lease=0.05)
+  assert queue.save(jobId, 'w1', {'pipelineId': 'p1'})
+  time.sleep(0.1)
+  job = queue.claim('w2', lease=60)
+  assert job['id'] == jobId
+  assert job['attempts'] == 2 and job['state'] == {'pipelineId': 'p1'}
+  # the first worker lost the job: its result is dropped
+  assert not queue.complete(jobId, 'w1', {'count': 1})
+  assert queue.complete(jobId, 'w2', {'count': 2})
+  collected = queue.collect()
+  assert [(job['status'], job['result']) for job in collected] == \
+    [('done', {'count': 2})]
+
+
+def test_lease_expired_on_the_last_attempt_fails(queue):
+  jobId = queue.put('release', {}, 'a')
+  for worker in ('w1', 'w2'):
+    queue.claim(worker, lease=0.01)
+    time.sleep(0.05)
+  assert queue.claim('w3') is None
+  job, = queue.collect()
+  assert job['id'] == jobId and job['status'] == 'failed'
+  assert 'lease expired' in job['error']
+
+
+def test_fail_retries_then_gives_up(queue):
+  jobId = queue.put('shard', {}, 'a')
+  queue.claim('w1')
+  assert queue.fail(jobId, 'w1', 'boom')
+  assert queue.collect() == []
+  job = queue.claim('w1')
+  assert job['attempts'] == 2
+  assert not queue.fail(jobId, 'w2', 'not mine')
+  assert queue.fail(jobId, 'w1', 'boom again')
+  job, = queue.collect()
+  assert (job['status'], job['error'], job['attempts']) == \
+    ('failed', 'boom again', 2)
+
+
+def test_failed_job_keeps_its_state(queue):
+  jobId = queue.put('release', {}, 'a')
+  queue.claim('w1')
+  queue.save(jobId, 'w1', {'pipelineId': 'p1'})
+  queue.fail(jobId, 'w1', 'boom')
+  queue.claim('w1')
+  queue.fail(jobId, 'w1', 'boom')
+  job, = queue.collect()
+  assert job['status'] == 'failed'
+  assert job['state'] == {'pipelineId': 'p1'}
+
+
+def test_collect_returns_finished_jobs_once(queue):
+  for key in ('a', 'b', 'c'):
+    queue.put('shard', {'key': key}, key)
+  for _ in range(2):
+    job = queue.claim('w1')
+    queue.complete(job['id'], 'w1', job['payload'])
+  assert sorted(job['key'] for job in queue.collect()) == ['a', 'b']
+  assert queue.collect() == []
+  assert queue.stats() == {'queued': 1, 'leased': 0, 'finished': 0}
+  # a collected key is not queued again
+  queue.put('shard', {}, 'a')
+  assert queue.claim('w1')['key'] == 'c'
+  assert queue.claim('w1') is None
+
+
+def test_stop_and_reset(queue):
+  assert not queue.stopped()
+  queue.put('shard', {}, 'a')
+  queue.stop()
+  assert queue.stopped()
+  queue.reset()
+  assert not queue.stopped()
+  assert queue.claim('w1') is None
+
+
+def test_sqlite_queues_share_a_file(tmp_path):
+  filename = str(tmp_path / 'queue.sqlite')
+  first, second = SQLiteQueue(filename, 'one'), SQLiteQueue(filename, 'two')
+  first.put('shard', {}, 'a')
+  assert second.claim('w1') is None
+  assert first.claim('w1')['key'] == 'a'
+  first.close()
+  second.close()
+
+
+def test_runs_share_a_queue(queue):
+  mine, other = runKey('run-1', 'a'), runKey('run-2', 'a')
+  for key in (mine, other):
+    queue.put('shard', {}, key)
+  for _ in range(2):
+    job = queue.claim('w1')
+    queue.complete(job['id'], 'w1', {})
+  assert [job['key'] for job in queue.collect('run-1')] == [mine]
+  queue.put('shard', {}, runKey('run-1', 'b'))
+  queue.reset('run-1')
+  assert queue.claim('w1') is None
+  assert [job['key'] for job in queue.collect('run-2')] == [other]
+
+
+def test_watched_claim_is_retried(queue):
+  if not isinstance(queue, RedisQueue):
+    pytest.skip('WATCH transactions of RedisQueue')
+  queue.put('shard', {}, 'a')
+  client = queue._client
+  zrangebyscore = client.zrangebyscore
+  raced = []
+
+  def racing(*args, **kwargs):
+    # another worker changes the ready set during the first claim
+    if not raced:
+      raced.append(True)
+      client._changed(queue._keys['ready'])
+    return zrangebyscore(*args, **kwargs)
+  client.zrangebyscore = racing
+  assert queue.claim('w1')['attempts'] == 1
+  assert raced
+  assert queue.claim('w2') is None
+
+
+def test_coordinator_without_workers_times_out(queue):
+  creditScheduler = CreditScheduler('token', [], {}, priority='newest')
+  creditScheduler.costs = {'scene-0': {'allocatedCredits': 1}}
+  coordinator = Coordinator(queue, {}, poll=0.01, timeout=0.1)
+  scenes = [{'sceneId': 'scene-0', 'datetime': '2018-01-01 00:00:00'}]
+  with pytest.raises(SpaceKnowError) as error:
+    list(coordinator.stream(creditScheduler, scenes, 10))
+  assert error.value.status_code == 504
+  # the release of the run is not left for a worker started later
+  assert queue.claim('w1') is None
+  assert queue.stopped()
+
+
+def test_idleWait():
+  assert idleWait(0, 1.0) == workqueue.IDLE_WAIT
+  assert idleWait(1, 1.0) == 2 * workqueue.IDLE_WAIT
+  assert idleWait(10000, 1.0) == 1.0
@@ -0,0 +1,140 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+from config import getConfig
+from utils import spaceKnowLogger
+
+
+class TileCache():
+  """ Persistent cache of Kraken grid resources.
+
+      Kraken maps are immutable once released, so a resource is identified
+      by (mapId, geometryId, z, x, y, resource) forever. Every entry is a
+      file named after the SHA-1 of its key; files are written in a
+      temporary file and renamed, so concurrent workers (threads or
+      processes) never read a partial tile. When the cache grows over
+      maxBytes the least recently used files are removed.
+
+      Arguments:
+      directory -- folder of the cache
+      maxBytes -- size limit of the cache
+  """
+  def __init__(self, directory, maxBytes=1 << 30):
+    self.directory = directory
+    self.maxBytes = maxBytes
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.bytesSaved = 0
+    self.evicted = 0
+    os.makedirs(directory, exist_ok=True)
+    self._size = sum(size for _, _, size in self._entries())
+
+  @staticmethod
+  def key(mapId, geometryId, z, x, y, resource):
+    return hashlib.sha1('/'.join([str(mapId), str(geometryId), str(z), str(x),
+                                  str(y), resource]).encode()).hexdigest()
+
+  def _path(self, key):
+    return os.path.join(self.directory, key[:2], key)
+
+  def _entries(self):
+    for folder in os.scandir(self.directory):
+      if not folder.is_dir():
+        continue
+      for entry in os.scandir(folder.path):
+        try:
+          stat = entry.stat()
+        except FileNotFoundError:
+          continue
+        if not entry.name.startswith('.'):
+          yield entry.path, stat.st_mtime, stat.st_size
+
+  def get(self, mapId, geometryId, z, x, y, resource):
+    """ Returns the cached bytes of the resource or None
+    """
+    filename = self._path(self.key(mapId, geometryId, z, x, y, resource))
+    try:
+      with open(filename, 'rb') as fp:
+        content = fp.read()
+    except OSError:
+      with self._lock:
+        self.misses += 1
+      return None
+    try:
+      os.utime(filename)
+    except OSError:
+      # evicted meanwhile or read-only cache: the content is still good
+      pass
+    with self._lock:
+      self.hits += 1
+      self.bytesSaved += len(content)
+    return content
+
+  def put(self, mapId, geometryId, z, x, y, resource, content):
+    filename = self._path(self.key(mapId, geometryId, z, x, y, resource))
+    folder = os.path.dirname(filename)
+    try:
+      os.makedirs(folder, exist_ok=True)
+      fd, tmpName = tempfile.mkstemp(dir=folder, prefix='.')
+      with os.fdopen(fd, 'wb') as fp:
+        fp.write(content)
+      try:
+        # the file replaced, if any, leaves the cache
+        previous = os.stat(filename).st_size
+      except FileNotFoundError:
+        previous = 0
+      os.replace(tmpName, filename)
+    except OSError as e:
+      spaceKnowLogger.error("Impossible to cache %s: %s" % (resource, e))
+      return
+    with self._lock:
+      self._size += len(content) - previous
+      mustEvict = self._size > self.maxBytes
+    if mustEvict:
+      self.evict()
+
+  def evict(self):
+    """ Removes the least recently used files until the cache is under 90%
+        of its limit. The size is measured again on disk, so files written
+        by other processes are taken into account.
+    """
+    with self._lock:
+      entries = sorted(self._entries(), key=lambda entry: entry[1])
+      size = sum(entry[2] for entry in entries)
+      target = int(self.maxBytes * 0.9)
+      for filename, _, fileSize in entries:
+        if size <= target:
+          break
+        try:
+          os.remove(filename)
+          self.evicted += 1
+        except FileNotFoundError:
+          pass
+        size -= fileSize
+      self._size = size
+
+  def stats(self):
+    with self._lock:
+      return {'hits': self.hits,
+              'misses': self.misses,
+              'bytesSaved': self.bytesSaved,
+              'evicted': self.evicted,
+              'size': self._size}
+
+
+_tileCache = None
+_tileCacheLock = threading.Lock()
+
+def getTileCache():
+  """ Returns the tile cache of the process configured by SK_TILE_CACHE_DIR
+      (default tilecache, empty to disable it) and SK_TILE_CACHE_BYTES.
+  """
+  global _tileCache
+  with _tileCacheLock:
+    directory = getConfig().tileCacheDir
+    if _tileCache is None and directory:
+      _tileCache = TileCache(directory, getConfig().tileCacheBytes)
+    return _tileCache
@@ -0,0 +1,235 @@
+import io
+import numpy as np
+import threading
+import weakref
+
+from concurrent.futures import ThreadPoolExecutor
+from config import getConfig
+from metrics import getMetrics
+
+DECODE_WORKERS = getConfig().decodeWorkers
+# major Pillow releases of requirements.txt, see directDecode
+MIN_PILLOW, MAX_PILLOW = 10, 12
+# PIL modes decoded in place: mode of the target array and its channels.
+# RGB is unpacked as RGBX (4th byte 255), the layout PIL stores it with.
+DIRECT_MODES = {'RGBA': ('RGBA', 4), 'RGBX': ('RGBX', 4), 'RGB': ('RGBX', 4),
+                'L': ('L', 1)}
+
+
+def directDecode(image):
+  """ Whether PIL can decode the image into storage replaced by
+      TileDecoder, which skips a copy. It relies on Image.im and
+      Image._mode, checked on the Pillow releases pinned in
+      requirements.txt; any other release takes the copying path.
+  """
+  import PIL
+  major = int(PIL.__version__.split('.')[0])
+  return MIN_PILLOW <= major <= MAX_PILLOW and hasattr(image, '_mode') and \
+    hasattr(type(image), 'im')
+
+
+class _BufferReader(io.RawIOBase):
+  """ Seekable file over a memoryview, so PIL reads the PNG without a copy
+      of the body
+  """
+  def __init__(self, data):
+    self._base = memoryview(data)
+    self._view = self._base.cast('B')
+    self._position = 0
+
+  def close(self):
+    # release the views: a pooled bytearray can not grow while exported
+    self._view.release()
+    self._base.release()
+    super().close()
+
+  def readable(self):
+    return True
+
+  def seekable(self):
+    return True
+
+  def readinto(self, target):
+    chunk = self._view[self._position:self._position + len(target)]
+    target[:len(chunk)] = chunk
+    self._position += len(chunk)
+    return len(chunk)
+
+  def seek(self, offset, whence=io.SEEK_SET):
+    base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position,
+            io.SEEK_END: len(self._view)}[whence]
+    self._position = max(base + offset, 0)
+    return self._position
+
+  def tell(self):
+    return self._position
+
+
+class BufferPool():
+  """ At most `count` reusable bytearrays for response bodies. acquire()
+      blocks while every buffer is in use, which bounds the bodies waiting
+      to be decoded.
+  """
+  def __init__(self, count):
+    self._free = [bytearray() for _ in range(count)]
+    self._available = threading.Semaphore(count)
+    self._lock = threading.Lock()
+
+  def acquire(self, size=0):
+    self._available.acquire()
+    with self._lock:
+      buffer = self._free.pop()
+    if len(buffer) < size:
+      buffer.extend(bytes(size - len(buffer)))
+    return buffer
+
+  def release(self, buffer):
+    with self._lock:
+      self._free.append(buffer)
+    self._available.release()
+
+
+class TileDecoder():
+  """ Decodes PNG tiles straight into NumPy arrays on a bounded pool.
+
+      Response bodies are read into reusable buffers (readBody) and PIL
+      decodes the pixels directly into an array of the decoder (RGB, RGBA
+      and L images), so the consumer gets the array without any intermediate PIL
+      copy. Arrays given back with recycle() are reused by the next tiles
+      of the same shape. Decoding runs on `workers` threads (PIL releases
+      the GIL), in parallel with the downloads of the tile pool.
+
+      Arguments:
+      workers -- decode threads (SK_DECODE_WORKERS)
+      buffers -- response bodies read and not decoded yet
+      spare -- decoded arrays kept for reuse
+  """
+  def __init__(self, workers=None, buffers=None, spare=64):
+    workers = workers or DECODE_WORKERS
+    self._pool = ThreadPoolExecutor(max_workers=workers,
+                                    thread_name_prefix='Decode')
+    self.buffers = BufferPool(buffers or 4 * workers)
+    self._spare = {}
+    self._spareLimit = spare
+    # arrays allocated by the decoder, the only ones recycle() takes back
+    self._owned = weakref.WeakValueDictionary()
+    self._lock = threading.Lock()
+
+  def readBody(self, response, chunk=1 << 16):
+    """ Reads the whole body of a streamed response in a pooled buffer,
+        returns (buffer, size). The connection goes back to the pool.
+    """
+    try:
+      expected = int(response.headers.get('Content-Length') or 0)
+      buffer = self.buffers.acquire(expected or chunk)
+      size = 0
+      try:
+        while True:
+          if size == len(buffer):
+            buffer.extend(bytes(max(chunk, len(buffer))))
+          with memoryview(buffer) as view:
+            read = response.raw.readinto(view[size:])
+          if not read:
+            break
+          size += read
+      except Exception:
+        self.buffers.release(buffer)
+        raise
+      return buffer, size
+    finally:
+      response.close()
+
+  def _array(self, shape):
+    with self._lock:
+      spare = self._spare.get(shape)
+      if spare:
+        return spare.pop()
+      pixels = np.empty(shape, dtype=np.uint8)
+      self._owned[id(pixels)] = pixels
+      return pixels
+
+  def recycle(self, pixels):
+    """ Gives back an array returned by decode once it is not used anymore.
+        Only the writeable, contiguous arrays the decoder allocated are
+        reused; any other array (e.g. a read-only view of a converted
+        image) is ignored.
+    """
+    if pixels is None:
+      return
+    with self._lock:
+      if self._owned.get(id(pixels)) is not pixels or \
+        not pixels.flags.writeable or not pixels.flags.c_contiguous or \
+        pixels.dtype != np.uint8:
+        return
+      spare = self._spare.setdefault(pixels.shape, [])
+      if sum(len(arrays) for arrays in self._spare.values()) < \
+        self._spareLimit:
+        spare.append(pixels)
+
+  def decode(self, data):
+    """ Pixels of a PNG (any bytes-like object) as a uint8 array of shape
+        (height, width, 4), or (height, width) for grey images
+    """
+    with getMetrics().timer('sk_tile_seconds', stage='decode'):
+      return self._decode(data)
+
+  def _decode(self, data):
+    from PIL import Image
+    reader = _BufferReader(data)
+    try:
+      image = Image.open(reader)
+      if image.mode not in DIRECT_MODES:
+        return np.asarray(image.convert('RGBA'))
+      mode, channels = DIRECT_MODES[image.mode]
+      width, height = image.size
+      shape = (height, width, channels) if channels > 1 else (height, width)
+      pixels = self._array(shape)
+      target = Image.frombuffer(mode, image.size, pixels, 'raw', mode, 0, 1)
+      if directDecode(image):
+        # PIL decodes into the storage of the image: make it our array
+        if mode != image.mode:
+          image._mode = mode
+        image.im = target.im
+        image.load()
+        if image.im is target.im:
+          return pixels
+        reader.seek(0)
+        image = Image.open(reader)
+      # decode in PIL's own storage, then copy into the pooled array; RGBX
+      # is RGBA with an opaque alpha
+      if mode != image.mode:
+        image = image.convert('RGBA' if mode == 'RGBX' else mode)
+      pixels[...] = np.asarray(image).reshape(shape)
+      return pixels
+    finally:
+      reader.close()
+
+  def submit(self, data):
+    """ Decodes data on the pool, returns a Future of the array
+    """
+    return self._pool.submit(self.decode, data)
+
+  def submitBuffer(self, buffer, size):
+    """ Decodes the first size bytes of a pooled buffer (see readBody) on
+        the pool and releases the buffer; returns a Future of the array
+    """
+    def decode():
+      try:
+        with memoryview(buffer) as view:
+          return self.decode(view[:size])
+      finally:
+        self.buffers.release(buffer)
+    return self._pool.submit(decode)
+
+
+_decoder = None
+_decoderLock = threading.Lock()
+
+def getTileDecoder():
+  """ Returns the TileDecoder shared by the whole process
+  """
+  global _decoder
+  with _decoderLock:
+    if _decoder is None:
+      _decoder = TileDecoder()
+    return _decoder
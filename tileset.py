@@ -0,0 +1,192 @@
+import numpy as np
+
+# bits of the zoom in a packed key: zoom < 32, x and y < 2^29
+ZOOM_BITS = 5
+
+
+class Tile():
+  """ A tile of a Kraken grid: zoom and x, y integers
+  """
+  __slots__ = ('z', 'x', 'y')
+
+  def __init__(self, tile):
+    self.z = int(tile[0])
+    self.x = int(tile[1])
+    self.y = int(tile[2])
+
+  def __str__(self):
+    return '%d_%d_%d' % (self.z, self.x, self.y)
+
+  def __repr__(self):
+    return 'Tile(%d, %d, %d)' % (self.z, self.x, self.y)
+
+  def __eq__(self, other):
+    return isinstance(other, Tile) and \
+      (self.z, self.x, self.y) == (other.z, other.x, other.y)
+
+  def __hash__(self):
+    return hash((self.z, self.x, self.y))
+
+  def aslist(self):
+    return [self.z, self.x, self.y]
+
+  @property
+  def key(self):
+    return int(packKeys(np.array([self.z]), np.array([self.x]),
+                        np.array([self.y]))[0])
+
+
+def asTile(tile):
+  """ Tile of a [z, x, y] list, a tuple or a Tile
+  """
+  return tile if isinstance(tile, Tile) else Tile(tile)
+
+
+def _spread(values):
+  """ Spreads the lower 32 bits of every value on the even bits
+  """
+  v = values.astype(np.uint64) & np.uint64(0xffffffff)
+  for shift, mask in ((16, 0x0000ffff0000ffff), (8, 0x00ff00ff00ff00ff),
+                      (4, 0x0f0f0f0f0f0f0f0f), (2, 0x3333333333333333),
+                      (1, 0x5555555555555555)):
+    v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+  return v
+
+
+def morton(x, y):
+  """ Morton (Z-order) codes of the x, y arrays: tiles close on the grid
+      get close codes
+  """
+  return _spread(x) | (_spread(y) << np.uint64(1))
+
+
+def packKeys(z, x, y):
+  """ Packs zoom, x and y in one int64 per tile: the Morton code of x, y
+      (the quadkey as an integer) followed by the zoom
+  """
+  return ((morton(x, y) << np.uint64(ZOOM_BITS)) |
+          np.asarray(z).astype(np.uint64)).astype(np.int64)
+
+
+class TileSet():
+  """ Array-backed set of the tiles of a map.
+
+      The tiles are one int32 (N, 3) array of z, x, y; `keys` are their
+      packed 64-bit quadkeys, kept with a sorted copy for membership tests
+      and lookups with np.searchsorted. Iterating yields Tile objects one at
+      a time, `batches` yields array views; nothing is built per tile in
+      advance.
+
+      Usage:
+        tiles = TileSet.fromList(jsonMap['tiles'])
+        tiles = tiles.sortedMorton()
+        tile in tiles, tiles.neighbours(tile), tiles.around(subset, 1)
+  """
+  def __init__(self, coords):
+    self.coords = np.ascontiguousarray(coords, dtype=np.int32).reshape(-1, 3)
+    self.keys = packKeys(self.coords[:, 0], self.coords[:, 1],
+                         self.coords[:, 2])
+    self._order = np.argsort(self.keys, kind='stable')
+    self._sorted = self.keys[self._order]
+
+  @classmethod
+  def fromList(cls, tiles):
+    """ TileSet of a list of [z, x, y] lists or Tile objects (a TileSet is
+        returned as it is). Tiles which are not triples are dropped.
+    """
+    if isinstance(tiles, TileSet):
+      return tiles
+    rows = [tile.aslist() if isinstance(tile, Tile) else tile
+            for tile in tiles]
+    return cls(np.array([row for row in rows if len(row) == 3],
+                        dtype=np.int32).reshape(-1, 3))
+
+  def __len__(self):
+    return len(self.coords)
+
+  def __iter__(self):
+    for z, x, y in self.coords.tolist():
+      yield Tile((z, x, y))
+
+  def __getitem__(self, index):
+    return Tile(self.coords[index].tolist())
+
+  def batches(self, size=1024):
+    """ Yields (N, 3) views of at most size tiles
+    """
+    for start in range(0, len(self.coords), size):
+      yield self.coords[start:start + size]
+
+  def tolist(self):
+    return self.coords.tolist()
+
+  def take(self, indexes):
+    """ TileSet of the tiles at the indexes
+    """
+    return TileSet(self.coords[np.asarray(indexes, dtype=np.int64)])
+
+  def indexOf(self, keys):
+    """ Indexes of the packed keys in this set, -1 for the missing ones
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    if len(self._sorted) == 0:
+      return np.full(len(keys), -1, dtype=np.int64)
+    positions = np.minimum(np.searchsorted(self._sorted, keys),
+                           len(self._sorted) - 1)
+    found = self._sorted[positions] == keys
+    return np.where(found, self._order[positions], -1)
+
+  def lookup(self, z, x, y):
+    """ Indexes of the (arrays of) tiles in this set, -1 for the missing
+        ones and the ones out of the grid
+    """
+    z, x, y = np.broadcast_arrays(np.atleast_1d(z).astype(np.int64),
+                                  np.atleast_1d(x).astype(np.int64),
+                                  np.atleast_1d(y).astype(np.int64))
+    side = np.left_shift(1, z)
+    valid = (x >= 0) & (y >= 0) & (x < side) & (y < side)
+    indexes = np.full(len(z), -1, dtype=np.int64)
+    indexes[valid] = self.indexOf(packKeys(z[valid], x[valid], y[valid]))
+    return indexes
+
+  def contains(self, z, x, y):
+    """ Boolean mask of the (arrays of) tiles in this set
+    """
+    return self.lookup(z, x, y) >= 0
+
+  def __contains__(self, tile):
+    tile = asTile(tile)
+    return bool(self.contains(tile.z, tile.x, tile.y)[0])
+
+  def sortedMorton(self):
+    """ The same tiles ordered along the Z-order curve, so consecutive
+        tiles are neighbours on the grid
+    """
+    return TileSet(self.coords[self._order])
+
+  def neighbours(self, tile, diagonal=True):
+    """ Indexes of the tiles of this set around a tile
+    """
+    tile = asTile(tile)
+    offsets = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+               if (dx or dy) and (diagonal or not (dx and dy))]
+    dx, dy = np.array(offsets).T
+    indexes = self.lookup(tile.z, tile.x + dx, tile.y + dy)
+    return indexes[indexes >= 0]
+
+  def around(self, subset, margin=1):
+    """ Boolean mask of the tiles of this set within `margin` tiles (in x
+        and y) of any tile of subset, the subset included
+    """
+    subset = TileSet.fromList(subset)
+    mask = np.zeros(len(self), dtype=bool)
+    if len(subset) == 0:
+      return mask
+    offsets = np.arange(-margin, margin + 1)
+    dx, dy = np.meshgrid(offsets, offsets)
+    z = np.repeat(subset.coords[:, 0], dx.size)
+    x = (subset.coords[:, 1][:, None] + dx.ravel()).ravel()
+    y = (subset.coords[:, 2][:, None] + dy.ravel()).ravel()
+    indexes = self.lookup(z, x, y)
+    mask[indexes[indexes >= 0]] = True
+    return mask
@@ -0,0 +1,514 @@
+import random
+import requests
+import threading
+import time
+import weakref
+
+from config import getConfig
+from email.utils import parsedate_to_datetime
+from metrics import getMetrics
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, ConnectTimeout
+from urllib.parse import urlsplit
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def parseRetryAfter(value):
+  """ Seconds to wait from a Retry-After header (delay in seconds or HTTP
+      date), None when missing or invalid
+  """
+  if not value:
+    return None
+  try:
+    return max(float(value), 0.0)
+  except ValueError:
+    pass
+  try:
+    return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+  except (TypeError, ValueError):
+    return None
+
+
+def idempotent(method, url):
+  """ Whether a request can be sent again after a 5xx or a broken
+      connection: every request but a POST which initiates a pipeline,
+      since a second release or dry-run would be started (and paid)
+  """
+  return method != 'POST' or \
+    not urlsplit(url).path.rstrip('/').endswith('/initiate')
+
+
+def connectFailed(error):
+  """ Whether a ConnectionError happened before the request was sent
+  """
+  if isinstance(error, ConnectTimeout):
+    return True
+  reason = error.args[0] if error.args else None
+  return isinstance(getattr(reason, 'reason', reason), NewConnectionError)
+
+
+def endpointGroup(url):
+  """ Endpoint of a SpaceKnow URL which gets its own limits: the first
+      segment of the path ('imagery', 'credits', ...), the first two for
+      kraken and tasking ('kraken/grid', 'tasking/get-status', ...)
+  """
+  segments = urlsplit(url).path.strip('/').split('/')
+  if segments[0] in ('kraken', 'tasking') and len(segments) > 1:
+    return '/'.join(segments[:2])
+  return segments[0] or 'default'
+
+
+def parseRates(value):
+  """ {endpoint: requests per second} of 'kraken/grid=50,imagery=5'
+  """
+  rates = {}
+  for item in (value or '').split(','):
+    if '=' in item:
+      name, rate = item.split('=', 1)
+      rates[name.strip()] = float(rate)
+  return rates
+
+
+class TransportStats():
+  """ Thread-safe counters shared by every session of a Transport.
+      `reused` is the number of requests served by a connection which was
+      already open in the pool.
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.requests = 0
+    self.opened = 0
+    self.retries = 0
+
+  def add(self, sent=0, opened=0, retries=0):
+    with self._lock:
+      self.requests += sent
+      self.opened += opened
+      self.retries += retries
+
+  @property
+  def reused(self):
+    return max(self.requests - self.opened, 0)
+
+  def asdict(self):
+    with self._lock:
+      return {'requests': self.requests,
+              'opened': self.opened,
+              'reused': max(self.requests - self.opened, 0),
+              'retries': self.retries}
+
+
+class RateLimiter():
+  """ Token bucket shared by every thread: at most `rate` requests per
+      second on average, with bursts of `burst` requests.
+  """
+  def __init__(self, rate, burst=None):
+    self.rate = float(rate)
+    self.burst = float(burst or max(1.0, self.rate))
+    self._tokens = self.burst
+    self._updated = time.monotonic()
+    self._lock = threading.Lock()
+
+  def acquire(self):
+    """ Blocks until a request can be sent
+    """
+    while True:
+      wait = self.tryAcquire()
+      if not wait:
+        return
+      time.sleep(wait)
+
+  def tryAcquire(self):
+    """ Takes a token without blocking: returns 0 when the request can be
+        sent, otherwise the seconds until the next token
+    """
+    with self._lock:
+      now = time.monotonic()
+      self._tokens = min(self.burst,
+                         self._tokens + (now - self._updated) * self.rate)
+      self._updated = now
+      if self._tokens >= 1:
+        self._tokens -= 1
+        return 0
+      return (1 - self._tokens) / self.rate
+
+
+class EndpointLimiter():
+  """ Requests in flight and rate of one SpaceKnow endpoint, adapted like
+      TCP congestion control. Until the first congestion every success
+      grows the limit by 1 (slow start: it doubles every round trip). Then
+      AIMD: every success grows it by 1/limit (about one more request per
+      round trip), 8 times slower once it is back to the limit of the last
+      congestion; a 429, a 5xx or a connection error halves it, at most
+      once per round trip. The request
+      which got a Retry-After waits for it before being retried; when the
+      limit is already at minLimit, the whole endpoint is paused until it
+      expires, so the other threads do not keep hitting it.
+
+      Arguments:
+      name -- endpoint (see endpointGroup)
+      limit -- initial requests in flight
+      minLimit, maxLimit -- bounds of the limit
+      rate -- requests per second of the endpoint, 0 for no limit
+      decrease -- factor applied to the limit on congestion
+  """
+  def __init__(self, name, limit=4, minLimit=1, maxLimit=64, rate=0,
+               decrease=0.5):
+    self.name = name
+    self.limit = float(limit)
+    self.minLimit = minLimit
+    self.maxLimit = maxLimit
+    self.decrease = decrease
+    self.bucket = RateLimiter(rate) if rate and rate > 0 else None
+    self.inFlight = 0
+    self.latency = 0.0
+    self.successes = 0
+    self.congested = 0
+    self.pausedUntil = 0.0
+    self.ceiling = float(maxLimit)
+    self._holdUntil = 0.0
+    self._condition = threading.Condition()
+
+  def acquire(self):
+    """ Blocks until a request can be sent; returns its start time
+    """
+    with self._condition:
+      while True:
+        wait = self._admit()
+        if wait == 0:
+          break
+        self._condition.wait(wait)
+    if self.bucket:
+      self.bucket.acquire()
+    return time.monotonic()
+
+  def tryAcquire(self):
+    """ Counts the request in flight without blocking and returns 0, or
+        returns the seconds the endpoint is still paused, None when the
+        request has to wait for a release. The rate of the endpoint
+        (self.bucket) is left to the caller.
+    """
+    with self._condition:
+      return self._admit()
+
+  def _admit(self):
+    wait = self.pausedUntil - time.monotonic()
+    if wait > 0:
+      return wait
+    if self.inFlight < max(int(self.limit), self.minLimit):
+      self.inFlight += 1
+      return 0
+    return None
+
+  def release(self, started, congested=False, retryAfter=None):
+    """ Reports the outcome of a request sent after acquire()
+    """
+    now = time.monotonic()
+    with self._condition:
+      self.inFlight -= 1
+      elapsed = now - started
+      self.latency = elapsed if not self.latency else \
+        0.8 * self.latency + 0.2 * elapsed
+      if congested:
+        self.congested += 1
+        if retryAfter and self.limit <= self.minLimit:
+          self.pausedUntil = max(self.pausedUntil, now + retryAfter)
+        if now >= self._holdUntil:
+          self.ceiling = self.limit
+          self.limit = max(float(self.minLimit), self.limit * self.decrease)
+          self._holdUntil = now + self.latency
+      else:
+        self.successes += 1
+        step = 1.0 if self.congested == 0 else 1.0 / self.limit
+        if self.limit + 1 >= self.ceiling:
+          # probe the capacity found by the last congestion slowly
+          step /= 8
+        self.limit = min(float(self.maxLimit), self.limit + step)
+      self._condition.notify_all()
+
+  def asdict(self):
+    with self._condition:
+      return {'limit': round(self.limit, 2), 'inFlight': self.inFlight,
+              'successes': self.successes, 'congested': self.congested,
+              'latency': round(self.latency, 4),
+              'paused': max(self.pausedUntil - time.monotonic(), 0.0)}
+
+
+class EndpointLimiters():
+  """ One EndpointLimiter per endpoint, created on its first request
+  """
+  def __init__(self, limit=4, maxLimit=64, rates=None):
+    self.limit = limit
+    self.maxLimit = maxLimit
+    self.rates = rates or {}
+    self._limiters = {}
+    self._lock = threading.Lock()
+
+  def get(self, url):
+    name = endpointGroup(url)
+    with self._lock:
+      limiter = self._limiters.get(name)
+      if limiter is None:
+        limiter = self._limiters[name] = EndpointLimiter(
+          name, min(self.limit, self.maxLimit), maxLimit=self.maxLimit,
+          rate=self.rates.get(name, 0))
+      return limiter
+
+  def asdict(self):
+    with self._lock:
+      limiters = list(self._limiters.values())
+    return {limiter.name: limiter.asdict() for limiter in limiters}
+
+
+def _countingPool(poolClass, stats):
+  class CountingPool(poolClass):
+    def _new_conn(self):
+      stats.add(opened=1)
+      return super()._new_conn()
+  return CountingPool
+
+
+class PoolingAdapter(HTTPAdapter):
+  """ HTTPAdapter which reports every new connection to TransportStats
+  """
+  def __init__(self, stats, **kwargs):
+    self._stats = stats
+    super().__init__(**kwargs)
+
+  def init_poolmanager(self, *args, **kwargs):
+    super().init_poolmanager(*args, **kwargs)
+    self.poolmanager.pool_classes_by_scheme = {
+      'http': _countingPool(HTTPConnectionPool, self._stats),
+      'https': _countingPool(HTTPSConnectionPool, self._stats)}
+
+
+class SessionOwner():
+  """ Holds the session of a thread in the thread-local storage of a
+      Transport
+  """
+  def __init__(self, session):
+    self.session = session
+
+
+class Transport():
+  """ Keep-alive HTTP layer used for every call at SpaceKnow API.
+
+      Each thread owns a requests.Session (Session is not thread-safe) with
+      a sized connection pool, so the TCP+TLS handshake is paid once per
+      host and thread instead of once per request. The session of a thread
+      is closed once the thread is gone, so short-lived pools do not leave
+      their connections open. Failed requests
+      (connection errors, 429 and 5xx) are retried with a jittered
+      exponential backoff, or after the delay of their Retry-After. The
+      POSTs which initiate a pipeline are only retried when the server did
+      not get them: on 429 and when the connection could not be opened.
+
+      Every endpoint has its own EndpointLimiter (see endpointGroup): its
+      requests in flight adapt to the capacity of the API with AIMD and
+      its rate can be capped, on top of the global rateLimit.
+
+      With a token renewer (see setTokenRenewer), a request whose bearer
+      token is rejected with 401 is sent once more with a new token, and
+      the later requests carrying the old token get the new one.
+
+      Arguments:
+      connectTimeout -- seconds to wait for the connection to be established
+      readTimeout -- seconds to wait for the server response
+      maxRetries -- number of retries after the first attempt
+      backoffBase -- first backoff delay in seconds
+      backoffMax -- upper bound of a single backoff delay in seconds
+      poolSize -- connections kept open for each host
+      rateLimit -- requests per second of the whole process, 0 for no limit
+      concurrency -- initial requests in flight of every endpoint, 0 to
+                     disable the endpoint limiters
+      maxConcurrency -- upper bound of the requests in flight of an endpoint
+      endpointRates -- {endpoint: requests per second}
+      maxThrottled -- 429 answers retried on top of maxRetries
+      retryAfterMax -- upper bound of a Retry-After delay in seconds, also
+                       of the pause of its endpoint
+  """
+  def __init__(self, connectTimeout=5.0, readTimeout=30.0, maxRetries=3,
+               backoffBase=0.5, backoffMax=30.0, poolSize=16, rateLimit=0,
+               concurrency=4, maxConcurrency=64, endpointRates=None,
+               maxThrottled=10, retryAfterMax=120.0):
+    self.timeout = (connectTimeout, readTimeout)
+    self.maxRetries = maxRetries
+    self.backoffBase = backoffBase
+    self.backoffMax = backoffMax
+    self.poolSize = poolSize
+    self.stats = TransportStats()
+    self.limiter = None
+    self.setRateLimit(rateLimit)
+    self.endpoints = EndpointLimiters(concurrency, maxConcurrency,
+                                      endpointRates) if concurrency else None
+    self.maxThrottled = maxThrottled
+    self.retryAfterMax = retryAfterMax
+    self._local = threading.local()
+    self._sessions = set()
+    # a session is released by a finalizer, which may run in any thread
+    self._lock = threading.RLock()
+    self._renew = None
+    self._renewed = {}
+
+  @property
+  def session(self):
+    owner = getattr(self._local, 'owner', None)
+    if owner is None:
+      session = requests.Session()
+      adapter = PoolingAdapter(self.stats, pool_connections=self.poolSize,
+                               pool_maxsize=self.poolSize)
+      session.mount('http://', adapter)
+      session.mount('https://', adapter)
+      owner = SessionOwner(session)
+      self._local.owner = owner
+      with self._lock:
+        self._sessions.add(session)
+      # the thread-local owner is dropped with its thread
+      weakref.finalize(owner, self._release, session)
+    return owner.session
+
+  def _release(self, session):
+    with self._lock:
+      self._sessions.discard(session)
+    session.close()
+
+  def setTokenRenewer(self, renew):
+    """ renew(token) returns a new bearer token for a token rejected by the
+        API, None when it can not
+    """
+    self._renew = renew
+
+  def _authorize(self, headers):
+    """ headers with the last token renewed from their bearer token
+    """
+    token = (headers or {}).get('Authorization', '')[len('Bearer '):]
+    if not token:
+      return headers, None
+    with self._lock:
+      while token in self._renewed:
+        token = self._renewed[token]
+    return dict(headers, Authorization='Bearer {}'.format(token)), token
+
+  def _renewToken(self, token):
+    renewed = self._renew(token)
+    if not renewed or renewed == token:
+      return False
+    with self._lock:
+      self._renewed[token] = renewed
+    return True
+
+  def setRateLimit(self, rate):
+    """ Limits the requests of every thread to `rate` per second
+    """
+    self.limiter = RateLimiter(rate) if rate and rate > 0 else None
+
+  def backoff(self, attempt):
+    """ Full jitter backoff: a random delay in [0, base * 2^attempt]
+    """
+    return random.uniform(0, min(self.backoffMax,
+                                 self.backoffBase * (2 ** attempt)))
+
+  def request(self, method, url, **kwargs):
+    """ Sends a request retrying it on connection errors, 429 and 5xx (see
+        idempotent for the requests only retried on 429 and connection
+        failures). 429 answers have maxThrottled retries of their own. The
+        last response is returned even if its status is an error, the last
+        ConnectionError is raised when every attempt failed.
+    """
+    kwargs.setdefault('timeout', self.timeout)
+    retryable = idempotent(method, url)
+    endpoint = self.endpoints.get(url) if self.endpoints else None
+    attempt = throttled = 0
+    renewed = False
+    while True:
+      kwargs['headers'], token = self._authorize(kwargs.get('headers'))
+      if self.limiter:
+        self.limiter.acquire()
+      started = endpoint.acquire() if endpoint else 0
+      self.stats.add(sent=1)
+      congested, retryAfter = True, None
+      try:
+        response = self.session.request(method, url, **kwargs)
+        if response.status_code == 401 and token and self._renew and \
+          not renewed:
+          # the token expired or was revoked: only this request is sent again
+          renewed = True
+          if self._renewToken(token):
+            response.close()
+            congested = False
+            continue
+        congested = response.status_code in RETRY_STATUS
+        if congested:
+          retryAfter = parseRetryAfter(response.headers.get('Retry-After'))
+          if retryAfter is not None:
+            retryAfter = min(retryAfter, self.retryAfterMax)
+        throttle = response.status_code == 429 and \
+          throttled < self.maxThrottled
+        retry = congested and (retryable or response.status_code == 429)
+        if not retry or (attempt >= self.maxRetries and not throttle):
+          return response
+        response.close()
+      except ConnectionError as e:
+        throttle = False
+        if attempt >= self.maxRetries or not (retryable or connectFailed(e)):
+          raise
+      finally:
+        if endpoint:
+          endpoint.release(started, congested, retryAfter)
+      self.stats.add(retries=1)
+      if congested:
+        getMetrics().add('sk_congested_total', endpoint=endpointGroup(url))
+      if retryAfter is not None:
+        time.sleep(retryAfter)
+      else:
+        time.sleep(self.backoff(attempt + throttled))
+      if throttle:
+        throttled += 1
+      else:
+        attempt += 1
+
+  def get(self, url, **kwargs):
+    return self.request('GET', url, **kwargs)
+
+  def post(self, url, **kwargs):
+    return self.request('POST', url, **kwargs)
+
+  def close(self):
+    with self._lock:
+      for session in self._sessions:
+        session.close()
+      self._sessions = set()
+    self._local = threading.local()
+
+
+_transport = None
+_transportLock = threading.Lock()
+
+def getTransport():
+  """ Returns the Transport shared by the whole process, configured from
+      the environment (SK_CONNECT_TIMEOUT, SK_READ_TIMEOUT, SK_MAX_RETRIES,
+      SK_BACKOFF_BASE, SK_BACKOFF_MAX, SK_POOL_SIZE, SK_RATE_LIMIT,
+      SK_ENDPOINT_CONCURRENCY, SK_ENDPOINT_MAX_CONCURRENCY,
+      SK_ENDPOINT_RATES, SK_MAX_THROTTLED, SK_RETRY_AFTER_MAX).
+  """
+  global _transport
+  with _transportLock:
+    if _transport is None:
+      config = getConfig()
+      _transport = Transport(
+        connectTimeout=config.connectTimeout,
+        readTimeout=config.readTimeout,
+        maxRetries=config.maxRetries,
+        backoffBase=config.backoffBase,
+        backoffMax=config.backoffMax,
+        poolSize=config.poolSize,
+        rateLimit=config.rateLimit,
+        concurrency=config.endpointConcurrency,
+        maxConcurrency=config.endpointMaxConcurrency,
+        endpointRates=parseRates(config.endpointRates),
+        maxThrottled=config.maxThrottled,
+        retryAfterMax=config.retryAfterMax)
+    return _transport
@@ -1,24 +1,10 @@
 import logging
-import logging.config
-import numpy as np
-import os
-import requests
 
-from dotenv import load_dotenv
+from config import getConfig
 from json import JSONDecodeError
-from PIL import Image, ImageColor
-from requests.exceptions import ConnectionError
+from metrics import endpoint, getMetrics
 
-logging.config.fileConfig('logging.conf')
 spaceKnowLogger = logging.getLogger('SpaceKnow')
-load_dotenv()
-
-SK_IMAGE_API = os.getenv('SK_IMAGE_API')
-SK_TASK_API = os.getenv('SK_TASK_API')
-SK_KRAKEN_API = os.getenv('SK_KRAKEN_API')
-SK_AUTH0 = os.getenv('SPACEKNOW_AUTH0')
-SK_USER_API = os.getenv('SK_USER_API')
-SK_CREDIT_API = os.getenv('SK_CREDIT_API')
 
 def buildURL(*args):
   return '/'.join(args)
@@ -36,7 +22,21 @@ def buildPermission(prefix, provider, dataset):
 def validateAccessRights(permissionsNeeds: list, userPermissions: list):
   for permission in permissionsNeeds:
     if permission not in userPermissions: 
-      raise SpaceKnowError('User is unauthorized to perform the operation', 401)
+      raise SpaceKnowError('User is unauthorized to perform the operation', 403)
+
+def validateResponse(statusCode, jsonData):
+  """ Raises a SpaceKnowError if the status code of a SpaceKnow response is
+      an error, otherwise returns its json payload.
+  """
+  if statusCode >= 400:
+    if 'errorMessage' in jsonData:
+      raise SpaceKnowError(jsonData['errorMessage'], statusCode)
+    else:
+      spaceKnowLogger.error('Invalid error received from the server')
+      message = 'SpaceKnow not available at the moment. Retry later!' \
+        if statusCode >= 500 else 'Invalid Request'
+      raise SpaceKnowError(message, statusCode)
+  return jsonData
 
 def process(url, data='', token='', isGET=False):
   """ Sends a request at SpaceKnow API.
@@ -45,24 +45,29 @@ def process(url, data='', token='', isGET=False):
     data -- json object to provide at the endpoint
     token -- user token to fill up Authorization field
   """
-  headers = prepare_auth_header(token) if token else ''
-  
+  # requests is loaded by the first request, not by the import of utils
+  import requests
+  from transport import getTransport
+  headers = prepare_auth_header(token) if token else None
+  transport = getTransport()
+  metrics = getMetrics()
+  path = endpoint(url)
   try:
-    if not isGET:
-      response = requests.post(url, data=data, headers=headers)
-    else:
-      response = requests.get(url, data=data, headers=headers)
+    with metrics.timer('sk_request_seconds', endpoint=path):
+      if not isGET:
+        response = transport.post(url, data=data, headers=headers)
+      else:
+        response = transport.get(url, data=data, headers=headers)
+    metrics.add('sk_bytes_sent_total', len(response.request.body or ''),
+                kind='api')
+    metrics.add('sk_bytes_received_total', len(response.content), kind='api')
     if response.status_code >= 400:
-        errors = response.json()
-        if 'errorMessage' in errors:
-          raise SpaceKnowError(errors['errorMessage'], response.status_code)
-        else:
-          spaceKnowLogger.error('Invalid error received from the server')
-          message = 'SpaceKnow not available at the moment. Retry later!' \
-            if response.status_code >= 500 else 'Invalid Request'
-          raise SpaceKnowError(message, response.status_code)
-    return response.json()
-  except (ConnectionError, requests.Timeout, requests.TooManyRedirects):
+      metrics.add('sk_request_errors_total', endpoint=path,
+                  status=response.status_code)
+    return validateResponse(response.status_code, response.json())
+  except (requests.ConnectionError, requests.Timeout,
+          requests.TooManyRedirects):
+      metrics.add('sk_request_errors_total', endpoint=path, status=-1)
       spaceKnowLogger.error("Impossible to connect at %s" % url)
       raise SpaceKnowError('Impossible to connect at %s' % url, -1)
   except JSONDecodeError:
@@ -73,14 +78,15 @@ def process(url, data='', token='', isGET=False):
 def authenticate(user, password):
     """ Get a Token valid for 10 hours
     """
-    data = {"client_id": os.getenv('SPACEKNOW_CLIENT_ID'),
+    config = getConfig()
+    data = {"client_id": config.clientId,
             "username": user,
             "password": password,
             "connection": "Username-Password-Authentication",
             "grant_type": "password",
             "scope": "openid"}
     try:
-      authData = process(SK_AUTH0, data)
+      authData = process(config.auth0, data)
       if 'id_token' not in authData:
         raise SpaceKnowError('Token unavailable. Invalid credentials', 400)
       elif 'token_type'  not in authData or authData['token_type'] != 'bearer':
@@ -93,7 +99,7 @@ def authenticate(user, password):
 def getPermissions(token):
   """ Get a list of operations provided by SpaceKnowAPI available for the user
   """
-  url = SK_USER_API + "/info"
+  url = getConfig().userApi + "/info"
   try:
     jsonData = process(url, token=token)
     if 'permissions' not in jsonData:
@@ -103,19 +109,6 @@ def getPermissions(token):
   except SpaceKnowError as e:
     spaceKnowLogger.error("Error {}: {}".format(str(e.status_code), e.error))
 
-def stitchImages(images: list, filename):
-  """ Takes N PIL Images with same size and save in the file
-      Returns a new image that appends the images side-by-side. 
-  """
-  num_images = len(images)
-  finalWidth =  images[0].width * num_images
-  bigImage = Image.new(images[0].mode,(finalWidth, images[0].height), color='white')
-  pos = (0,0)
-  for img in images:
-    bigImage.paste(img, pos)
-    pos = (pos[0] + img.width, 0)
-  bigImage.save(filename)
-
 class SpaceKnowError(Exception):
   def __init__(self, error, status_code):
     self.error = error
@@ -0,0 +1,67 @@
+import json
+import os
+import threading
+import time
+
+from config import getConfig
+from detections import DetectionTable
+from tileset import TileSet
+
+PROCESS_WORKERS = getConfig().processWorkers
+SHARD_TILES = getConfig().shardTiles
+# start method of the workers: spawn is safe with the threads of the run
+PROCESS_START = getConfig().processStart
+
+
+def parseDetections(coords, bodies):
+  """ Runs in a worker process over a shard of tiles: parses the
+      detections.geojson body of every tile (None when it was not
+      downloaded) and returns a dict with:
+      - table: DetectionTable of the shard (NumPy columns)
+      - invalid: keys of the tiles whose body is not a valid resource
+      - seconds: time spent parsing
+      Only the columns go back to the parent: it still has the bodies,
+      e.g. to journal them in the run manifest.
+  """
+  start = time.perf_counter()
+  analysis, invalid = {}, []
+  for (z, x, y), body in zip(coords.tolist(), bodies):
+    if body is None:
+      continue
+    key = '%d_%d_%d' % (z, x, y)
+    try:
+      features = json.loads(body).get('features')
+    except (ValueError, AttributeError):
+      features = None
+    if features is None:
+      invalid.append(key)
+      continue
+    analysis[key] = features
+  return {'table': DetectionTable.fromAnalysis(TileSet(coords), analysis),
+          'invalid': invalid, 'seconds': time.perf_counter() - start}
+
+
+_pool = None
+_poolLock = threading.Lock()
+
+def getProcessPool(workers=None):
+  """ Returns the process pool shared by the whole process, created with
+      `workers` processes (SK_PROCESS_WORKERS) on first use
+  """
+  global _pool
+  with _poolLock:
+    if _pool is None:
+      # multiprocessing is only loaded by the runs which use the processes
+      import multiprocessing
+      from concurrent.futures import ProcessPoolExecutor
+      _pool = ProcessPoolExecutor(
+        max_workers=workers or PROCESS_WORKERS or os.cpu_count() or 2,
+        mp_context=multiprocessing.get_context(PROCESS_START))
+    return _pool
+
+def closeProcessPool():
+  global _pool
+  with _poolLock:
+    if _pool is not None:
+      _pool.shutdown()
+      _pool = None
@@ -0,0 +1,898 @@
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from config import getConfig, initLogging
+from detections import DetectionTable, summarise
+from kraken import CarsObject, describeScene, downloadMap, sceneTimestamp, \
+  storeResults
+from metrics import getMetrics, startInstrumentation, stopInstrumentation
+from runstore import RunStore
+from scheduler import CreditBudget
+from spatialindex import DetectionIndex
+from tileset import TileSet
+from utils import authenticate, SpaceKnowError, spaceKnowLogger
+
+QUEUE_LEASE = getConfig().queueLease
+QUEUE_ATTEMPTS = getConfig().queueAttempts
+QUEUE_POLL = getConfig().queuePoll
+QUEUE_SHARD_TILES = getConfig().queueShardTiles
+QUEUE_THREADS = getConfig().queueThreads
+QUEUE_TIMEOUT = getConfig().queueTimeout
+# seconds before a job which raised is claimable again
+RETRY_DELAY = 1.0
+# first wait of an idle reader of the queue, doubled up to QUEUE_POLL
+IDLE_WAIT = 0.005
+# kinds of jobs, run by the Worker method of the same name
+JOB_KINDS = ('release', 'shard')
+
+
+def finished(job, status, result=None, error=None):
+  """ Entry of a job which left the queue, as returned by collect(), with
+      the last state saved by the job
+  """
+  return {'id': job['id'], 'kind': job['kind'], 'key': job['key'],
+          'payload': job['payload'], 'attempts': job['attempts'],
+          'state': job.get('state') or {}, 'status': status,
+          'result': result, 'error': error}
+
+
+def runKey(run, key):
+  """ Key of a job of a run: the jobs of a run are the keys starting with
+      'run/'
+  """
+  return '%s/%s' % (run, key)
+
+
+def idleWait(idle, poll):
+  """ Seconds to wait after `idle` reads of the queue found nothing: the
+      first waits are short, so a job queued or finished right after a busy
+      read is seen at once, and an idle queue is read every `poll` seconds
+  """
+  return min(poll, IDLE_WAIT * 2 ** min(idle, 16))
+
+
+class SQLiteQueue():
+  """ Work queue in a SQLite file, shared by the processes of a host (or of
+      several hosts through a file system with working locks).
+
+      A claimed job stays in the queue with a lease of `lease` seconds that
+      its worker extends while it runs, and can save a state (e.g. the
+      pipeline it initiated) which the next attempts get back. When the
+      lease expires, e.g. the worker crashed, the job is claimable again; a job claimed or failed
+      `attempts` times is given up. Every job has a key: putting a key
+      already queued returns the job in the queue. Finished jobs (done or
+      failed) are read once by collect(). The jobs of a run have keys made
+      by runKey, so several runs can share the queue and its workers.
+
+      Arguments:
+      filename -- SQLite file of the queue
+      name -- queue in the file, so several runs can share it
+      attempts -- claims of a job before it fails (SK_QUEUE_ATTEMPTS)
+  """
+  def __init__(self, filename, name='spaceknow', attempts=None):
+    self.filename = filename
+    self.name = name
+    self.attempts = attempts or QUEUE_ATTEMPTS
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(filename, timeout=30, check_same_thread=False,
+                               isolation_level=None)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.execute('PRAGMA synchronous=NORMAL')
+    self._db.executescript('''
+      CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY, queue TEXT, key TEXT, kind TEXT,
+        payload TEXT, status TEXT, availableAt REAL, owner TEXT,
+        attempts INTEGER, result TEXT, error TEXT, state TEXT,
+        UNIQUE (queue, key));
+      CREATE INDEX IF NOT EXISTS jobsReady ON jobs (queue, status,
+                                                    availableAt);
+      CREATE TABLE IF NOT EXISTS queues (name TEXT PRIMARY KEY,
+                                         stopped INTEGER);
+    ''')
+
+  def _transaction(self, work):
+    with self._lock:
+      self._db.execute('BEGIN IMMEDIATE')
+      try:
+        result = work()
+        self._db.execute('COMMIT')
+        return result
+      except Exception:
+        self._db.execute('ROLLBACK')
+        raise
+
+  def _query(self, sql, args=()):
+    with self._lock:
+      return self._db.execute(sql, args).fetchall()
+
+  @staticmethod
+  def _job(row):
+    jobId, key, kind, payload, attempts = row
+    return {'id': jobId, 'key': key, 'kind': kind,
+            'payload': json.loads(payload), 'attempts': attempts}
+
+  def _scope(self, run):
+    """ SQL condition and arguments of the jobs of a run (every job of the
+        queue without run)
+    """
+    if run is None:
+      return 'queue = ?', (self.name,)
+    prefix = runKey(run, '')
+    return 'queue = ? AND substr(key, 1, ?) = ?', \
+      (self.name, len(prefix), prefix)
+
+  def reset(self, run=None):
+    """ Forgets the jobs of a run (every job of the queue without run) and
+        starts the queue again
+    """
+    def reset():
+      self._forget(run)
+      self._db.execute('INSERT OR REPLACE INTO queues VALUES (?, 0)',
+                       (self.name,))
+    self._transaction(reset)
+
+  def forget(self, run):
+    """ Drops the jobs of a run, finished or not: a job still running can
+        not complete anymore
+    """
+    self._transaction(lambda: self._forget(run))
+
+  def _forget(self, run):
+    scope, args = self._scope(run)
+    self._db.execute('DELETE FROM jobs WHERE %s' % scope, args)
+
+  def put(self, kind, payload, key):
+    """ Queues a job, returns its id
+    """
+    def put():
+      row = self._db.execute('SELECT id FROM jobs WHERE queue = ? AND '
+                             'key = ?', (self.name, key)).fetchone()
+      if row:
+        return row[0]
+      return self._db.execute(
+        "INSERT INTO jobs (queue, key, kind, payload, status, availableAt, "
+        "attempts) VALUES (?, ?, ?, ?, 'queued', 0, 0)",
+        (self.name, key, kind, json.dumps(payload))).lastrowid
+    return self._transaction(put)
+
+  def claim(self, worker, lease=None):
+    """ Leases the next job to `worker` for `lease` seconds; returns a dict
+        with id, key, kind, payload, attempts and state, or None when no
+        job is ready
+    """
+    lease = lease or QUEUE_LEASE
+    # idle workers read without the write lock the other writers wait for
+    if not self._query("SELECT 1 FROM jobs WHERE queue = ? AND status = "
+                       "'queued' AND availableAt <= ? LIMIT 1",
+                       (self.name, time.time())):
+      return None
+
+    def claim():
+      while True:
+        now = time.time()
+        row = self._db.execute(
+          "SELECT id, key, kind, payload, attempts, state FROM jobs WHERE "
+          "queue = ? AND status = 'queued' AND availableAt <= ? ORDER BY "
+          "availableAt, id LIMIT 1", (self.name, now)).fetchone()
+        if row is None:
+          return None
+        job = self._job(row[:5])
+        job['state'] = json.loads(row[5]) if row[5] else {}
+        if job['attempts'] >= self.attempts:
+          # the lease of its last attempt expired
+          self._db.execute("UPDATE jobs SET status = 'failed', owner = NULL, "
+                           "error = ? WHERE id = ?",
+                           ('lease expired %d times' % job['attempts'],
+                            job['id']))
+          continue
+        job['attempts'] += 1
+        self._db.execute('UPDATE jobs SET availableAt = ?, owner = ?, '
+                         'attempts = ? WHERE id = ?',
+                         (now + lease, worker, job['attempts'], job['id']))
+        return job
+    return self._transaction(claim)
+
+  def extend(self, jobId, worker, lease=None):
+    """ Extends the lease of a running job; False when the worker lost it
+    """
+    lease = lease or QUEUE_LEASE
+    return self._transaction(lambda: self._db.execute(
+      "UPDATE jobs SET availableAt = ? WHERE id = ? AND owner = ? AND "
+      "status = 'queued'", (time.time() + lease, jobId, worker)).rowcount > 0)
+
+  def save(self, jobId, worker, state):
+    """ Saves the state of a running job for its next attempts; False
+        when the worker lost the job
+    """
+    return self._transaction(lambda: self._db.execute(
+      "UPDATE jobs SET state = ? WHERE id = ? AND owner = ? AND "
+      "status = 'queued'", (json.dumps(state), jobId, worker)).rowcount > 0)
+
+  def complete(self, jobId, worker, result):
+    """ Records the result of a job; False when the worker lost the job, in
+        which case the result is dropped
+    """
+    return self._transaction(lambda: self._db.execute(
+      "UPDATE jobs SET status = 'done', owner = NULL, result = ? WHERE "
+      "id = ? AND owner = ? AND status = 'queued'",
+      (json.dumps(result), jobId, worker)).rowcount > 0)
+
+  def fail(self, jobId, worker, error):
+    """ Gives back a job which raised: it is retried after RETRY_DELAY
+        seconds, or failed after its last attempt
+    """
+    def fail():
+      row = self._db.execute("SELECT attempts FROM jobs WHERE id = ? AND "
+                             "owner = ? AND status = 'queued'",
+                             (jobId, worker)).fetchone()
+      if row is None:
+        return False
+      if row[0] >= self.attempts:
+        self._db.execute("UPDATE jobs SET status = 'failed', owner = NULL, "
+                         "error = ? WHERE id = ?", (error, jobId))
+      else:
+        self._db.execute('UPDATE jobs SET availableAt = ?, owner = NULL, '
+                         'error = ? WHERE id = ?',
+                         (time.time() + RETRY_DELAY, error, jobId))
+      return True
+    return self._transaction(fail)
+
+  def collect(self, run=None):
+    """ Finished jobs of a run (of the whole queue without run) not
+        collected yet, see finished()
+    """
+    scope, args = self._scope(run)
+    if not self._query("SELECT 1 FROM jobs WHERE %s AND status IN "
+                       "('done', 'failed') LIMIT 1" % scope, args):
+      return []
+
+    def collect():
+      rows = self._db.execute(
+        "SELECT id, key, kind, payload, attempts, status, result, error, "
+        "state FROM jobs WHERE %s AND status IN ('done', 'failed')" % scope,
+        args).fetchall()
+      self._db.execute("UPDATE jobs SET status = 'collected' || status, "
+                       "result = NULL WHERE %s AND status IN ('done', "
+                       "'failed')" % scope, args)
+      entries = []
+      for row in rows:
+        job = self._job(row[:5])
+        job['state'] = json.loads(row[8]) if row[8] else {}
+        entries.append(finished(job, row[5],
+                                json.loads(row[6]) if row[6] else None,
+                                row[7]))
+      return entries
+    return self._transaction(collect)
+
+  def stop(self):
+    """ Tells the workers waiting for jobs that the run is over
+    """
+    self._transaction(lambda: self._db.execute(
+      'INSERT OR REPLACE INTO queues VALUES (?, 1)', (self.name,)))
+
+  def stopped(self):
+    rows = self._query('SELECT stopped FROM queues WHERE name = ?',
+                       (self.name,))
+    return bool(rows and rows[0][0])
+
+  def stats(self):
+    """ Jobs claimable (queued), leased or waiting for a retry (leased) and
+        finished but not collected yet (finished)
+    """
+    stats = {'queued': 0, 'leased': 0, 'finished': 0}
+    for status, leased, count in self._query(
+        'SELECT status, availableAt > ?, COUNT(*) FROM jobs WHERE queue = ? '
+        "AND status IN ('queued', 'done', 'failed') GROUP BY 1, 2",
+        (time.time(), self.name)):
+      if status == 'queued':
+        stats['leased' if leased else 'queued'] += count
+      else:
+        stats['finished'] += count
+    return stats
+
+  def close(self):
+    with self._lock:
+      self._db.close()
+
+
+class RedisQueue():
+  """ Work queue on a Redis-compatible server (redis-py is loaded by the
+      first RedisQueue), with the semantics of SQLiteQueue so workers run
+      on any host which reaches the server.
+
+      Jobs are in a sorted set scored by the time they are claimable: 0
+      when queued, the end of the lease once claimed. Claims, lease
+      extensions and completions are WATCH / MULTI transactions, so two
+      workers never own the same job.
+
+      Arguments:
+      url -- redis://host:port/db
+      name -- prefix of the keys of the queue
+      attempts -- claims of a job before it fails (SK_QUEUE_ATTEMPTS)
+      client -- client to use instead of one connected to url
+  """
+  def __init__(self, url, name='spaceknow', attempts=None, client=None):
+    if client is None:
+      try:
+        import redis
+      except ImportError:
+        raise SpaceKnowError('The Redis queue needs redis-py (pip install '
+                             'redis)', 500)
+      client = redis.Redis.from_url(url, decode_responses=True)
+    self.url = url
+    self.name = name
+    self.attempts = attempts or QUEUE_ATTEMPTS
+    self._client = client
+    self._keys = {part: '%s:%s' % (name, part) for part in
+                  ('seq', 'jobs', 'keys', 'ready', 'owners', 'attempts',
+                   'states', 'finished', 'stopped')}
+
+  def _watch(self, keys, work):
+    """ Runs work(pipe) in a WATCH transaction on keys until no other
+        client changed them in between
+    """
+    from redis.exceptions import WatchError
+    with self._client.pipeline() as pipe:
+      while True:
+        try:
+          pipe.watch(*[self._keys[key] for key in keys])
+          return work(pipe)
+        except WatchError:
+          continue
+
+  @staticmethod
+  def _inRun(entry, run):
+    return run is None or \
+      json.loads(entry)['key'].startswith(runKey(run, ''))
+
+  def reset(self, run=None):
+    self.forget(run)
+    self._client.delete(self._keys['stopped'])
+
+  def forget(self, run):
+    keys = self._keys
+    if run is None:
+      self._client.delete(*[key for part, key in keys.items()
+                            if part != 'stopped'])
+      return
+    jobs = dict(self._client.hscan_iter(keys['keys'],
+                                        match=runKey(run, '*')))
+    pipe = self._client.pipeline()
+    if jobs:
+      jobIds = list(jobs.values())
+      pipe.hdel(keys['keys'], *jobs)
+      pipe.zrem(keys['ready'], *jobIds)
+      for part in ('jobs', 'owners', 'attempts', 'states'):
+        pipe.hdel(keys[part], *jobIds)
+    for entry in self._client.lrange(keys['finished'], 0, -1):
+      if self._inRun(entry, run):
+        pipe.lrem(keys['finished'], 1, entry)
+    pipe.execute()
+
+  def put(self, kind, payload, key):
+    keys = self._keys
+    jobId = '%012d' % self._client.incr(keys['seq'])
+    job = json.dumps({'id': jobId, 'key': key, 'kind': kind,
+                      'payload': payload})
+
+    def put(pipe):
+      existing = pipe.hget(keys['keys'], key)
+      if existing:
+        pipe.unwatch()
+        return existing
+      pipe.multi()
+      pipe.hset(keys['keys'], key, jobId)
+      pipe.hset(keys['jobs'], jobId, job)
+      pipe.zadd(keys['ready'], {jobId: 0})
+      pipe.execute()
+      return jobId
+    return self._watch(['keys'], put)
+
+  def claim(self, worker, lease=None):
+    lease = lease or QUEUE_LEASE
+    keys = self._keys
+
+    def claim(pipe):
+      now = time.time()
+      ready = pipe.zrangebyscore(keys['ready'], '-inf', now, start=0, num=1)
+      if not ready:
+        pipe.unwatch()
+        return None
+      jobId = ready[0]
+      job = pipe.hget(keys['jobs'], jobId)
+      if job is None:
+        # dropped by forget() meanwhile
+        pipe.unwatch()
+        return False
+      job = json.loads(job)
+      job['attempts'] = int(pipe.hget(keys['attempts'], jobId) or 0)
+      job['state'] = json.loads(pipe.hget(keys['states'], jobId) or '{}')
+      pipe.multi()
+      if job['attempts'] >= self.attempts:
+        # the lease of its last attempt expired
+        self._finish(pipe, job, 'failed', error='lease expired %d times' %
+                     job['attempts'])
+        pipe.execute()
+        return False
+      job['attempts'] += 1
+      pipe.zadd(keys['ready'], {jobId: now + lease})
+      pipe.hset(keys['owners'], jobId, worker)
+      pipe.hset(keys['attempts'], jobId, job['attempts'])
+      pipe.execute()
+      return job
+
+    while True:
+      job = self._watch(['ready'], claim)
+      if job is not False:
+        return job
+
+  def _finish(self, pipe, job, status, result=None, error=None):
+    pipe.zrem(self._keys['ready'], job['id'])
+    pipe.hdel(self._keys['owners'], job['id'])
+    pipe.hdel(self._keys['jobs'], job['id'])
+    pipe.hdel(self._keys['states'], job['id'])
+    pipe.rpush(self._keys['finished'],
+               json.dumps(finished(job, status, result, error)))
+
+  def _owned(self, jobId, worker, work):
+    """ Runs work(pipe, job) in a transaction if worker owns the job;
+        returns False otherwise
+    """
+    keys = self._keys
+
+    def owned(pipe):
+      if pipe.hget(keys['owners'], jobId) != worker:
+        pipe.unwatch()
+        return False
+      job = json.loads(pipe.hget(keys['jobs'], jobId))
+      job['attempts'] = int(pipe.hget(keys['attempts'], jobId) or 0)
+      job['state'] = json.loads(pipe.hget(keys['states'], jobId) or '{}')
+      pipe.multi()
+      work(pipe, job)
+      pipe.execute()
+      return True
+    return self._watch(['owners', 'ready'], owned)
+
+  def extend(self, jobId, worker, lease=None):
+    lease = lease or QUEUE_LEASE
+    return self._owned(jobId, worker, lambda pipe, job: pipe.zadd(
+      self._keys['ready'], {jobId: time.time() + lease}))
+
+  def save(self, jobId, worker, state):
+    return self._owned(jobId, worker, lambda pipe, job: pipe.hset(
+      self._keys['states'], jobId, json.dumps(state)))
+
+  def complete(self, jobId, worker, result):
+    return self._owned(jobId, worker, lambda pipe, job: self._finish(
+      pipe, job, 'done', result=result))
+
+  def fail(self, jobId, worker, error):
+    def fail(pipe, job):
+      if job['attempts'] >= self.attempts:
+        self._finish(pipe, job, 'failed', error=error)
+      else:
+        pipe.hdel(self._keys['owners'], jobId)
+        pipe.zadd(self._keys['ready'], {jobId: time.time() + RETRY_DELAY})
+    return self._owned(jobId, worker, fail)
+
+  def collect(self, run=None):
+    finishedKey = self._keys['finished']
+    pipe = self._client.pipeline()
+    if run is None:
+      pipe.lrange(finishedKey, 0, -1)
+      pipe.delete(finishedKey)
+      entries, _ = pipe.execute()
+      return [json.loads(entry) for entry in entries]
+    # the entries of the other runs stay in the list
+    entries = [entry for entry in self._client.lrange(finishedKey, 0, -1)
+               if self._inRun(entry, run)]
+    for entry in entries:
+      pipe.lrem(finishedKey, 1, entry)
+    pipe.execute()
+    return [json.loads(entry) for entry in entries]
+
+  def stop(self):
+    self._client.set(self._keys['stopped'], 1)
+
+  def stopped(self):
+    return bool(self._client.exists(self._keys['stopped']))
+
+  def stats(self):
+    ready = self._keys['ready']
+    now = time.time()
+    return {'queued': self._client.zcount(ready, '-inf', now),
+            'leased': self._client.zcount(ready, '(%r' % now, '+inf'),
+            'finished': self._client.llen(self._keys['finished'])}
+
+  def close(self):
+    self._client.close()
+
+
+def openQueue(url=None, name=None):
+  """ Queue of SK_QUEUE: a redis:// URL for RedisQueue, otherwise the file
+      of a SQLiteQueue. The queue name is SK_QUEUE_NAME.
+  """
+  url = url or getConfig().queue
+  name = name or getConfig().queueName
+  if url.startswith(('redis://', 'rediss://', 'unix://')):
+    return RedisQueue(url, name)
+  return SQLiteQueue(url, name)
+
+
+class Coordinator():
+  """ Distributes the car detection of a run over the workers of a queue.
+
+      The coordinator keeps the credit budget: it queues one release job
+      per scene in priority order while the budget covers it (see
+      CreditScheduler), and gives the credits of a failed release to the
+      scenes skipped before, unless the release was initiated (its job
+      saved a pipeline): that one may have been charged. Every released map is split in shard jobs of
+      `shardTiles` tiles; the DetectionTables the workers report back are
+      merged per map, indexed and stored as KrakenManager does, so the
+      coordinator stands in for it in spaceknow.analyseArea.
+
+      The jobs of the run have their own keys (see runKey): the run only
+      collects and drops its own jobs, so several coordinators can share a
+      queue. When for `timeout` seconds no job of the run finished and no
+      job of the queue is leased, e.g. no worker is running, the run fails
+      instead of waiting forever.
+
+      Arguments:
+      queue -- SQLiteQueue or RedisQueue
+      extent -- area of the analysis
+      logger -- logger of the run
+      shardTiles -- tiles of a shard job (SK_QUEUE_SHARD_TILES)
+      poll -- seconds between two reads of the finished jobs (SK_QUEUE_POLL)
+      timeout -- seconds without a finished or leased job before the run
+                 fails (SK_QUEUE_TIMEOUT)
+      run -- id of the run in the queue, a random one by default
+  """
+  def __init__(self, queue, extent, logger=spaceKnowLogger, shardTiles=None,
+               poll=None, timeout=None, run=None):
+    self.queue = queue
+    self.extent = extent
+    self.logger = logger
+    self.shardTiles = shardTiles or QUEUE_SHARD_TILES
+    self.poll = poll or QUEUE_POLL
+    self.timeout = timeout or QUEUE_TIMEOUT
+    self.run = run or uuid.uuid4().hex
+    self.detections = {}
+    self.index = DetectionIndex()
+    # the tiles are fetched by the workers: nothing is stored here
+    self.store = RunStore()
+    self.built = []
+    self.released = []
+    self.failedTiles = 0
+    self.skippedTiles = 0
+    self._scenes = {}
+    self._maps = {}
+
+  def summary(self):
+    return summarise(self.detections)
+
+  def _release(self, scheduler, scenes):
+    """ Queues the releases of the scenes the budget covers; returns the
+        skipped scenes
+    """
+    skipped = []
+    for scene in scenes:
+      cost = scheduler.costs[scene['sceneId']]['allocatedCredits']
+      if not scheduler.budget.reserve(cost):
+        skipped.append(scene)
+        continue
+      self._scenes[scene['sceneId']] = (scene, cost)
+      self.queue.put('release', {'mapType': 'cars',
+                                 'sceneId': scene['sceneId'],
+                                 'extent': self.extent},
+                     runKey(self.run, 'release/%s' % scene['sceneId']))
+    return skipped
+
+  def _shard(self, entry):
+    """ Queues the shard jobs of a released map; returns their number
+    """
+    scene, _ = self._scenes[entry['payload']['sceneId']]
+    jsonMap = describeScene(entry['result'], scene)
+    jsonMap['tiles'] = TileSet.fromList(jsonMap['tiles'])
+    self.released.append(scene['sceneId'])
+    self.skippedTiles += jsonMap['skippedTiles']
+    if jsonMap['skippedTiles']:
+      getMetrics().add('sk_tiles_outside_total', jsonMap['skippedTiles'],
+                       mapType='cars')
+    shards = 0
+    for shards, coords in enumerate(jsonMap['tiles'].batches(self.shardTiles),
+                                    1):
+      self.queue.put('shard', {'mapId': jsonMap['mapId'],
+                               'tiles': coords.tolist()},
+                     runKey(self.run, 'shard/%s/%d' % (jsonMap['mapId'],
+                                                       shards)))
+    self._maps[jsonMap['mapId']] = {'map': jsonMap, 'shards': shards,
+                                    'tables': []}
+    return shards
+
+  def _merge(self, mapId):
+    """ Merges the shards of a map: returns (mapId, cars, tiles with cars)
+    """
+    done = self._maps.pop(mapId)
+    jsonMap = done['map']
+    table = DetectionTable.concatenate(jsonMap['tiles'], done['tables'])
+    self.detections[mapId] = table
+    self.index.add(table, sceneTimestamp(jsonMap), mapId)
+    storeResults(jsonMap, table, self.logger)
+    return mapId, table.total, \
+      TileSet(table.tiles[table.tilesWithDetections()])
+
+  def _waiting(self, since):
+    """ Raises SpaceKnowError when the run waited `timeout` seconds since
+        its last finished job and no job of the queue is leased
+    """
+    if time.monotonic() - since < self.timeout or \
+      self.queue.stats()['leased']:
+      return
+    raise SpaceKnowError('No job of run %s finished in %.0f seconds and no '
+                         'worker is running: start the workers of the queue '
+                         '(python3 workqueue.py worker)' %
+                         (self.run, self.timeout), 504)
+
+  def stream(self, scheduler, scenes, credits, callback=None):
+    """ Releases and analyses the scenes within `credits` on the workers
+        and yields (mapId, cars, tiles) as soon as every shard of a map is
+        back. scheduler is the CreditScheduler which estimated the scenes:
+        its budget and skipped scenes are updated as by iterRelease.
+    """
+    self.queue.reset(self.run)
+    scheduler.budget = CreditBudget(credits)
+    try:
+      skipped = self._release(scheduler, scheduler.order(scenes))
+      outstanding = len(self._scenes)
+      idle = 0
+      progress = time.monotonic()
+      while outstanding:
+        entries = self.queue.collect(self.run)
+        if not entries:
+          self._waiting(progress)
+          time.sleep(idleWait(idle, self.poll))
+          idle += 1
+          continue
+        idle = 0
+        progress = time.monotonic()
+        for entry in entries:
+          outstanding -= 1
+          getMetrics().add('sk_queue_jobs_total', kind=entry['kind'],
+                           status=entry['status'])
+          payload = entry['payload']
+          if entry['kind'] == 'release':
+            if entry['status'] == 'done':
+              shards = self._shard(entry)
+              outstanding += shards
+              if shards:
+                continue
+              result = self._merge(entry['result']['mapId'])
+            else:
+              self.logger.error("Release of scene %s failed after %d "
+                                "attempts: %s" % (payload['sceneId'],
+                                                  entry['attempts'],
+                                                  entry['error']))
+              _, cost = self._scenes.pop(payload['sceneId'])
+              if entry['state'].get('pipelineId'):
+                # initiated: the release may be charged, its credits stay
+                continue
+              scheduler.budget.refund(cost)
+              # the credits can pay for scenes skipped before
+              released = len(self._scenes)
+              skipped = self._release(scheduler, skipped)
+              outstanding += len(self._scenes) - released
+              continue
+          else:
+            done = self._maps[payload['mapId']]
+            done['shards'] -= 1
+            if entry['status'] == 'done':
+              done['tables'].append(DetectionTable.fromdict(entry['result']))
+            else:
+              self.failedTiles += len(payload['tiles'])
+              self.logger.error("%d tiles of map %s not analysed after %d "
+                                "attempts: %s" % (len(payload['tiles']),
+                                                  payload['mapId'],
+                                                  entry['attempts'],
+                                                  entry['error']))
+            if done['shards']:
+              continue
+            result = self._merge(payload['mapId'])
+          if callback:
+            callback(*result)
+          yield result
+      scheduler.skipped = skipped
+    finally:
+      self.queue.stop()
+      # a job left by a run which failed is not run, nor charged, later
+      self.queue.forget(self.run)
+
+
+class JobJournal():
+  """ Journal of the release pipeline of a job, saved in the queue with
+      the job (see Pipeline): a retry of the job, e.g. after its worker
+      died, reattaches the pipeline of the first attempt instead of
+      initiating, and paying for, a new release. A pipeline which can not
+      be reattached fails the attempt; no other release is initiated.
+  """
+  def __init__(self, queue, job, worker):
+    self.queue = queue
+    self.job = job
+    self.worker = worker
+
+  def pipeline(self, url, request):
+    pipelineId = self.job['state'].get('pipelineId')
+    return (pipelineId, 'PROCESSING', None) if pipelineId else None
+
+  def startPipeline(self, url, request, pipelineId):
+    self.job['state']['pipelineId'] = pipelineId
+    if not self.queue.save(self.job['id'], self.worker, self.job['state']):
+      spaceKnowLogger.error("Pipeline %s of job %s not saved: lease lost" %
+                            (pipelineId, self.job['key']))
+
+  def resolvePipeline(self, url, request, pipelineId, result):
+    pass
+
+  def forgetPipeline(self, url, request):
+    raise SpaceKnowError('Release pipeline %s of job %s can not be resumed' %
+                         (self.job['state'].get('pipelineId'),
+                          self.job['key']), 502)
+
+
+class Worker():
+  """ Runs the jobs of a queue with the logic of the single-process run:
+      release jobs call kraken.downloadMap, with their pipeline journaled
+      in the job (see JobJournal), shard jobs CarsObject over their tiles,
+      and the DetectionTable goes back as the result.
+
+      `threads` jobs run at the same time; the lease of every job is
+      extended every lease / 3 seconds while it runs, so only the jobs of
+      a worker which died are claimed again by the others.
+
+      Arguments:
+      queue -- SQLiteQueue or RedisQueue
+      name -- of the worker in the leases, host-pid by default
+      threads -- jobs run at the same time (SK_QUEUE_THREADS)
+      lease -- seconds of a lease (SK_QUEUE_LEASE)
+  """
+  def __init__(self, queue, name=None, threads=None, lease=None,
+               logger=spaceKnowLogger):
+    self.queue = queue
+    self.name = name or '%s-%d' % (socket.gethostname(), os.getpid())
+    self.threads = threads or QUEUE_THREADS
+    self.lease = lease or QUEUE_LEASE
+    self.logger = logger
+    self.store = RunStore()
+    self.jobs = 0
+    self._token = None
+    self._tokenExpiry = 0
+    self._lock = threading.Lock()
+
+  def token(self, renew=False):
+    """ Bearer token of the worker's own credentials (USERNAME, PASSWORD)
+    """
+    with self._lock:
+      if renew or not self._token or time.monotonic() >= self._tokenExpiry:
+        config = getConfig()
+        self._token = authenticate(config.username, config.password)
+        if not self._token:
+          raise SpaceKnowError('Authentication failed', 401)
+        self._tokenExpiry = time.monotonic() + config.tokenTTL
+      return self._token
+
+  def release(self, job):
+    payload = job['payload']
+    jsonMap = downloadMap(payload['mapType'], payload['sceneId'],
+                          payload['extent'], self.token(),
+                          JobJournal(self.queue, job, self.name))
+    if not jsonMap:
+      raise SpaceKnowError('Release of scene %s failed' % payload['sceneId'],
+                           503)
+    return {'mapId': jsonMap['mapId'], 'maxZoom': jsonMap['maxZoom'],
+            'tiles': jsonMap['tiles'].tolist(),
+            'skippedTiles': jsonMap['skippedTiles']}
+
+  def shard(self, job):
+    payload = job['payload']
+    carsDetector = CarsObject(store=self.store)
+    carsDetector.detectCars(payload['mapId'],
+                            TileSet.fromList(payload['tiles']))
+    return carsDetector.detections.asdict()
+
+  def run_job(self, job):
+    stop = threading.Event()
+
+    def heartbeat():
+      while not stop.wait(self.lease / 3):
+        if not self.queue.extend(job['id'], self.name, self.lease):
+          self.logger.error("Lease of job %s lost" % job['key'])
+          return
+
+    beat = threading.Thread(target=heartbeat, daemon=True,
+                            name='Lease-%s' % job['id'])
+    beat.start()
+    try:
+      if job['kind'] not in JOB_KINDS:
+        raise SpaceKnowError('Unknown job %s' % job['kind'], 400)
+      with getMetrics().timer('sk_queue_job_seconds', kind=job['kind']):
+        result = getattr(self, job['kind'])(job)
+    except Exception as e:
+      error = e.error if isinstance(e, SpaceKnowError) else str(e)
+      self.logger.error("Job %s failed (attempt %d): %s" %
+                        (job['key'], job['attempts'], error))
+      if isinstance(e, SpaceKnowError) and e.status_code == 401:
+        # the token was revoked before its expiry
+        self._token = None
+      self.queue.fail(job['id'], self.name, error)
+      return
+    finally:
+      stop.set()
+      beat.join()
+    if not self.queue.complete(job['id'], self.name, result):
+      self.logger.error("Result of job %s dropped: its lease expired" %
+                        job['key'])
+    with self._lock:
+      self.jobs += 1
+
+  def run(self, untilStopped=False):
+    """ Claims and runs jobs; with untilStopped, returns once the queue is
+        stopped and no job is left to claim
+    """
+    def loop():
+      idle = 0
+      while True:
+        job = self.queue.claim(self.name, self.lease)
+        if job is None:
+          if untilStopped and self.queue.stopped():
+            return
+          time.sleep(idleWait(idle, QUEUE_POLL))
+          idle += 1
+          continue
+        idle = 0
+        self.run_job(job)
+
+    threads = [threading.Thread(target=loop, name='Worker-%d' % index)
+               for index in range(self.threads)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    return self.jobs
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Worker of the distributed engine (SK_ENGINE=distributed)')
+  parser.add_argument('command', choices=['worker', 'stats'])
+  parser.add_argument('--queue', help='SQLite file or redis:// URL '
+                      '(SK_QUEUE)')
+  parser.add_argument('--name', help='queue name (SK_QUEUE_NAME)')
+  parser.add_argument('--threads', type=int, default=QUEUE_THREADS)
+  parser.add_argument('--exit', action='store_true',
+                      help='exit once the coordinator stopped the queue')
+  args = parser.parse_args()
+
+  queue = openQueue(args.queue, args.name)
+  if args.command == 'stats':
+    print(json.dumps(queue.stats()))
+    queue.close()
+    return
+  initLogging()
+  startInstrumentation()
+  worker = Worker(queue, threads=args.threads)
+  spaceKnowLogger.info("Worker %s waiting for jobs" % worker.name)
+  try:
+    jobs = worker.run(untilStopped=args.exit)
+  finally:
+    queue.close()
+    stopInstrumentation()
+  spaceKnowLogger.info("Worker %s ran %d jobs" % (worker.name, jobs))
+
+
+if __name__ == "__main__":
+  main()